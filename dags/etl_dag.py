@@ -7,7 +7,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from airflow import DAG
 from airflow.operators.python import PythonOperator
 from datetime import datetime, timedelta
-from etl.main import run_etl_pipeline
+from etl.main import FACT_SOURCES, plan_windows, stage_raw_data, run_fact_window, finish_windows
 
 default_args = {
     'owner': 'admin',
@@ -19,17 +19,60 @@ default_args = {
     'retry_delay': timedelta(minutes=5),
 }
 
+# Pool bounding the tasks that load into PostgreSQL at once, created by the airflow-scheduler service
+DB_POOL = 'etl_postgres'
+
+# Each run loads its data interval. To backfill a range in a single run, trigger the DAG with
+# {"start": "2020-01-01", "end": "2021-01-01"} as its configuration
+WINDOW = {
+    'start': "{{ dag_run.conf.get('start', data_interval_start) }}",
+    'end': "{{ dag_run.conf.get('end', data_interval_end) }}",
+}
+
 with DAG(
     'daily_incremental_etl',
     default_args=default_args,
     description='Daily ETL for incremental updates',
     schedule_interval='@daily',
     catchup=False,
+    max_active_runs=4,
 ) as dag:
 
-    run_incremental_etl = PythonOperator(
-        task_id='run_incremental_etl',
-        python_callable=run_etl_pipeline,
+    # Staging reads the raw rows appended since the previous run and loads the dimensions and Dim_User of
+    # the new rows. It updates shared state, so it runs for one DAG run at a time, in order
+    stage_raw = PythonOperator(
+        task_id='stage_raw_data',
+        python_callable=stage_raw_data,
+        pool=DB_POOL,
+        depends_on_past=True,
+    )
+
+    # Split the run's interval and the event dates it staged (late rows, the history on the first run)
+    # into windows, each fact table is loaded by one mapped task per window
+    windows = PythonOperator(
+        task_id='plan_windows',
+        python_callable=plan_windows,
+        op_kwargs={**WINDOW, 'staged_ranges': stage_raw.output},
+    )
+
+    load_facts = [
+        PythonOperator.partial(
+            task_id=f'load_{table_name}',
+            python_callable=run_fact_window,
+            op_args=[source],
+            pool=DB_POOL,
+        ).expand(op_kwargs=windows.output)
+        for source, (_, table_name) in FACT_SOURCES.items()
+    ]
+
+    # Rollups are refreshed by one run at a time, as concurrent runs can touch the same users
+    refresh_rollups = PythonOperator(
+        task_id='refresh_rollups',
+        python_callable=finish_windows,
+        op_kwargs={'windows': windows.output},
+        pool=DB_POOL,
+        max_active_tis_per_dag=1,
     )
 
-    run_incremental_etl
+    stage_raw >> windows >> load_facts
+    load_facts >> refresh_rollups
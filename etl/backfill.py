@@ -0,0 +1,128 @@
+import sys
+import os
+
+# Add the project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from main import (
+    FACT_SOURCES, plan_windows, stage_raw_data, transform_fact_window, load_fact_window,
+    refresh_loaded_facts, report_run, release_database_connections, init_worker_process, config
+)
+from scripts.rollups import rollup_scope
+from scripts.state import read_pending_scopes, update_pending_scopes
+from utils.instrumentation import collect_records, add_records, reset_records
+from utils.scheduler import PROCESS_START_METHOD
+
+# Windows already loaded by an interrupted backfill, so re-running the same command resumes it
+PROGRESS_FILE = 'backfill_progress.json'
+
+def read_progress(backfill_range):
+    """Returns the steps done by an earlier run of the same backfill range and the date ranges its
+    staging step staged, or none for another range."""
+    if not os.path.exists(PROGRESS_FILE):
+        return set(), []
+    with open(PROGRESS_FILE) as file:
+        progress = json.load(file)
+    if progress.get('range') != backfill_range:
+        logging.info(f"Ignoring the progress of the backfill of {progress.get('range')}.")
+        return set(), []
+    return set(progress['done']), progress.get('staged_ranges', [])
+
+def update_progress(backfill_range, done, staged_ranges):
+    """Stores the steps done so far, replacing the progress file atomically."""
+    with open(PROGRESS_FILE + '.tmp', 'w') as file:
+        json.dump({'range': backfill_range, 'done': sorted(done), 'staged_ranges': staged_ranges}, file)
+    os.replace(PROGRESS_FILE + '.tmp', PROGRESS_FILE)
+
+def transform_window_task(source, start, end):
+    """Transforms the facts of a window in a worker process, returning them with the records of its
+    instrumented calls for the run report."""
+    with collect_records() as records:
+        fact_df = transform_fact_window(source, start, end)
+    return fact_df, records
+
+def run_backfill(start, end, workers=None, freq=None, max_in_flight=None):
+    """Reprocesses the facts of [start, end) window by window, transforming the windows in a pool of
+    worker processes and loading them one at a time, with at most max_in_flight windows transformed
+    or waiting to be loaded at once. The rollups are refreshed at the end for the days and users of the
+    loaded windows, collected as they are loaded rather than read back from PostgreSQL."""
+    started_at, succeeded = time.time(), False
+    reset_records()
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    try:
+        backfill_range = [start, end, freq]
+        done, staged_ranges = read_progress(backfill_range)
+
+        # Stage the raw rows not staged yet chunk by chunk, assigning the keys of their dimension members,
+        # so each window worker only reads its staged dates and resolves keys
+        if 'staging' not in done:
+            staged_ranges = stage_raw_data()
+            done.add('staging')
+            update_progress(backfill_range, done, staged_ranges)
+
+        # The staged rows outside of the range are loaded too, as no later run would stage them again
+        windows = plan_windows(start, end, freq, staged_ranges)
+        logging.info(f"Starting backfill of {len(windows)} windows with {workers} workers ({len(done)} steps already done)...")
+
+        # Days and users of the loaded windows, kept in the state file so a resumed backfill refreshes them too
+        scopes = read_pending_scopes()
+        tasks = iter([(source, window) for window in windows for source in FACT_SOURCES
+                      if f"{source}:{window['start']}" not in done])
+        running = {}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD),
+                                 initializer=init_worker_process, initargs=(config,)) as executor:
+            def submit_next():
+                task = next(tasks, None)
+                if task is not None:
+                    source, window = task
+                    running[executor.submit(transform_window_task, source, window['start'], window['end'])] = task
+
+            for _ in range(max_in_flight):
+                submit_next()
+
+            # Load each window as soon as it is transformed, then start the next one in its place
+            while running:
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    source, window = running.pop(future)
+                    fact_df, records = future.result()
+                    add_records(records)
+                    table_name = FACT_SOURCES[source][1]
+                    rows = load_fact_window(fact_df, table_name, window['start'])
+                    scopes[table_name] = rollup_scope(fact_df, scopes.get(table_name))
+                    update_pending_scopes(scopes)
+                    done.add(f"{source}:{window['start']}")
+                    update_progress(backfill_range, done, staged_ranges)
+                    logging.info(f"Backfilled {rows} rows of {source} between {window['start']} and {window['end']}.")
+                    submit_next()
+
+        refresh_loaded_facts(scopes)
+        update_pending_scopes({})
+        os.remove(PROGRESS_FILE)
+        logging.info("Backfill completed successfully.")
+        succeeded = True
+    except Exception as e:
+        logging.error(f"Backfill failed: {e}")
+    finally:
+        report_run(started_at, succeeded, 'backfill')
+        release_database_connections()
+    return succeeded
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocesses the facts of a time range in parallel, window by window.")
+    parser.add_argument('--from', dest='start', required=True, help="first timestamp of the range, e.g. 2020-01-01")
+    parser.add_argument('--to', dest='end', required=True, help="end of the range (excluded), e.g. 2021-01-01")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--freq', default=None, help="window frequency, D for days or MS for months (default: dag.window_freq)")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="windows transformed or waiting to be loaded at once (default: twice the workers)")
+    args = parser.parse_args()
+
+    if not run_backfill(args.start, args.end, args.workers, args.freq, args.max_in_flight):
+        sys.exit(1)
@@ -0,0 +1,186 @@
+import sys
+import os
+
+# Add the project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import binascii
+import logging
+import numpy as np
+import pandas as pd
+
+# Raw sample files the generated data is profiled on, relative to the etl directory
+SAMPLE_PATH = 'data/raw/'
+
+# File written for each source, as read by main.py
+SOURCE_FILES = {
+    'user_id': 'user_id_sample_data.csv',
+    'user_level': 'user_level_sample_data.csv',
+    'withdrawals': 'withdrawals_sample_data.csv',
+    'deposits': 'deposit_sample_data.csv',
+    'events': 'event_sample_data.csv',
+}
+
+# Rows of each source at scale 1, matching the sample files (the sources missing from the repo are
+# sized relative to the withdrawals and users)
+BASE_ROWS = {
+    'user_id': 25699,
+    'user_level': 30000,
+    'withdrawals': 5098,
+    'deposits': 8000,
+    'events': 40000,
+}
+
+# Profile of the sources without a sample file in the repo
+DEPOSIT_STATUSES = {'complete': 0.8, 'failed': 0.2}
+EVENT_NAMES = {'login': 0.6, '2falogin_success': 0.25, '2falogin_failed': 0.05, 'level_up': 0.1}
+JURISDICTIONS = {'mx': 0.7, 'br': 0.15, 'ar': 0.1, 'co': 0.05}
+LEVELS = {0: 0.3, 1: 0.3, 2: 0.25, 3: 0.15}
+
+# Rows generated and written at a time, bounding memory at any scale
+CHUNK_ROWS = 1000000
+
+def profile_withdrawals(sample_file):
+    """Returns the category frequencies, per-currency log-normal amount parameters, time range and
+    share of transacting users of the withdrawals sample."""
+    sample = pd.read_csv(sample_file)
+    timestamps = pd.to_datetime(sample['event_timestamp'], utc=True, format='ISO8601').dt.tz_localize(None)
+    log_amounts = np.log(sample['amount'][sample['amount'] > 0])
+    amount_params = log_amounts.groupby(sample['currency']).agg(['mean', 'std']).fillna(0.0)
+    return {
+        'currency': sample['currency'].value_counts(normalize=True).to_dict(),
+        'interface': sample['interface'].value_counts(normalize=True).to_dict(),
+        'tx_status': sample['tx_status'].value_counts(normalize=True).to_dict(),
+        'amount_mean': amount_params['mean'].to_dict(),
+        'amount_std': amount_params['std'].to_dict(),
+        'start': timestamps.min(),
+        'end': timestamps.max(),
+        'active_share': sample['user_id'].nunique() / BASE_ROWS['user_id'],
+    }
+
+def user_ids(rng, count):
+    """Returns count random 32-character hexadecimal user ids, like the ones of the raw files."""
+    return np.frombuffer(binascii.hexlify(rng.bytes(16 * count)), dtype='S32').astype(str)
+
+def choice(rng, frequencies, count):
+    """Draws count values of a {value: frequency} distribution."""
+    values = list(frequencies)
+    weights = np.array([frequencies[value] for value in values], dtype='float64')
+    return np.array(values, dtype=object)[rng.choice(len(values), size=count, p=weights / weights.sum())]
+
+def format_timestamps(timestamps):
+    """Formats timestamps like the raw files, with milliseconds trimmed of trailing zeros and a +00 offset."""
+    formatted = pd.Series(timestamps).dt.floor('ms').dt.strftime('%Y-%m-%d %H:%M:%S.%f').str.rstrip('0').str.rstrip('.')
+    return (formatted + '+00').to_numpy()
+
+def sorted_timestamps(rng, start, end, count, offset, total):
+    """Returns the sorted timestamps of rows [offset, offset + count) of total rows spread uniformly over [start, end]."""
+    span = (end - start) / total
+    positions = np.sort(rng.uniform(offset, offset + count, count))
+    return start + pd.to_timedelta(positions * span.value, unit='ns')
+
+def skewed_users(rng, users, count, skew, active_share):
+    """Draws the users of count transactions: a share of the users is active and their activity follows
+    a Zipf-like distribution, the larger skew the more a few users dominate."""
+    active = users[:max(1, int(len(users) * active_share))]
+    weights = 1.0 / np.arange(1, len(active) + 1) ** skew
+    return active[rng.choice(len(active), size=count, p=weights / weights.sum())]
+
+def write_chunks(frames, file_path, compression=None):
+    """Writes a stream of DataFrames to a single CSV file, with the header only once."""
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    rows = 0
+    for index, frame in enumerate(frames):
+        frame.to_csv(file_path, index=False, header=index == 0, mode='a' if index else 'w', compression=compression)
+        rows += len(frame)
+    logging.info(f"Generated {rows} rows in {file_path}")
+    return rows
+
+def generate_transactions(rng, profile, users, count, skew, with_interface, statuses):
+    """Yields chunks of withdrawal or deposit rows, sorted by event_timestamp with increasing ids."""
+    for offset in range(0, count, CHUNK_ROWS):
+        rows = min(CHUNK_ROWS, count - offset)
+        currencies = choice(rng, profile['currency'], rows)
+        means = pd.Series(currencies).map(profile['amount_mean']).to_numpy(dtype='float64')
+        stds = pd.Series(currencies).map(profile['amount_std']).to_numpy(dtype='float64')
+        chunk = {
+            'id': np.arange(offset + 1, offset + rows + 1),
+            'event_timestamp': format_timestamps(sorted_timestamps(rng, profile['start'], profile['end'], rows, offset, count)),
+            'user_id': skewed_users(rng, users, rows, skew, profile['active_share']),
+            'amount': np.round(np.exp(rng.normal(means, stds)), 8),
+        }
+        if with_interface:
+            chunk['interface'] = choice(rng, profile['interface'], rows)
+        chunk['currency'] = currencies
+        chunk['tx_status'] = choice(rng, statuses, rows)
+        yield pd.DataFrame(chunk)
+
+def generate_events(rng, profile, users, count, skew):
+    """Yields chunks of event rows, sorted by event_timestamp with increasing ids."""
+    for offset in range(0, count, CHUNK_ROWS):
+        rows = min(CHUNK_ROWS, count - offset)
+        yield pd.DataFrame({
+            'id': np.arange(offset + 1, offset + rows + 1),
+            'event_timestamp': format_timestamps(sorted_timestamps(rng, profile['start'], profile['end'], rows, offset, count)),
+            'user_id': skewed_users(rng, users, rows, skew, min(1.0, profile['active_share'] * 10)),
+            'event_name': choice(rng, EVENT_NAMES, rows),
+        })
+
+def generate_user_levels(rng, profile, users, count):
+    """Yields chunks of user level rows: a first level for every user, then level changes of random users."""
+    jurisdictions = choice(rng, JURISDICTIONS, len(users))
+    for offset in range(0, count, CHUNK_ROWS):
+        rows = min(CHUNK_ROWS, count - offset)
+        positions = np.arange(offset, offset + rows)
+        user_positions = np.where(positions < len(users), positions % len(users), rng.integers(0, len(users), rows))
+        yield pd.DataFrame({
+            'event_timestamp': format_timestamps(sorted_timestamps(rng, profile['start'], profile['end'], rows, offset, count)),
+            'user_id': users[user_positions],
+            'jurisdiction': jurisdictions[user_positions],
+            'level': choice(rng, LEVELS, rows),
+        })
+
+def generate_data(output_path, scale=1.0, skew=1.0, compression=None, seed=42, sample_path=SAMPLE_PATH):
+    """Generates the five raw sources at scale times the sample size in output_path and returns their row counts."""
+    try:
+        os.makedirs(output_path, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        profile = profile_withdrawals(os.path.join(sample_path, SOURCE_FILES['withdrawals']))
+        counts = {source: max(1, int(rows * scale)) for source, rows in BASE_ROWS.items()}
+        counts['user_level'] = max(counts['user_level'], counts['user_id'])
+        suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+
+        def file_path(source):
+            return os.path.join(output_path, SOURCE_FILES[source] + suffix)
+
+        users = user_ids(rng, counts['user_id'])
+        rows = {
+            'user_id': write_chunks(
+                (pd.DataFrame({'user_id': users[offset:offset + CHUNK_ROWS]}) for offset in range(0, len(users), CHUNK_ROWS)),
+                file_path('user_id'), compression),
+            'user_level': write_chunks(generate_user_levels(rng, profile, users, counts['user_level']), file_path('user_level'), compression),
+            'withdrawals': write_chunks(generate_transactions(rng, profile, users, counts['withdrawals'], skew, True, profile['tx_status']),
+                                        file_path('withdrawals'), compression),
+            'deposits': write_chunks(generate_transactions(rng, profile, users, counts['deposits'], skew, False, DEPOSIT_STATUSES),
+                                     file_path('deposits'), compression),
+            'events': write_chunks(generate_events(rng, profile, users, counts['events'], skew), file_path('events'), compression),
+        }
+        logging.info(f"Generated scale {scale} data in {output_path}: {rows}")
+        return rows
+    except Exception as e:
+        logging.error(f"Error generating data: {e}")
+        raise
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic raw data shaped like the sample files.")
+    parser.add_argument('--output', default='data/benchmark/raw/', help="directory of the generated files")
+    parser.add_argument('--scale', type=float, default=1.0, help="size as a multiple of the sample files")
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the activity per user")
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help="compress the generated CSV files")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    generate_data(args.output, args.scale, args.skew, args.compression, args.seed)
@@ -0,0 +1,175 @@
+import sys
+import os
+
+# Add the project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import time
+import shutil
+import argparse
+import logging
+import statistics
+import subprocess
+from sqlalchemy import inspect
+from benchmarks.generate_data import generate_data
+from utils.db_connection import get_postgres_engine, dispose_engines
+from scripts.metrics import DASHBOARD_QUERIES_FILE, read_dashboard_queries
+
+RESULTS_PATH = 'benchmarks/results/'
+
+# Stage figures kept in the benchmark results and compared between commits
+STAGE_FIELDS = ['calls', 'wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out', 'peak_rss_bytes', 'rows_per_second']
+
+def git_commit():
+    """Returns the short hash of the current commit, or 'unknown' outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+def reset_database():
+    """Drops the fact, dimension and rollup tables, so every scale is loaded into an empty database."""
+    engine = get_postgres_engine()
+    tables = [table for table in inspect(engine).get_table_names() if table.startswith(('fact_', 'dim_', 'rollup_'))]
+    with engine.begin() as connection:
+        for table in tables:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{table}" CASCADE')
+    logging.info(f"Dropped {len(tables)} tables before the benchmark run.")
+
+def time_queries(queries, repeats=3):
+    """Runs every dashboard query repeats times and returns its fastest and median time and row count."""
+    engine = get_postgres_engine()
+    timings = {}
+    for name, query in queries.items():
+        durations = []
+        with engine.connect() as connection:
+            for _ in range(repeats):
+                started = time.perf_counter()
+                rows = len(connection.exec_driver_sql(query).fetchall())
+                durations.append(time.perf_counter() - started)
+        timings[name] = {'min_seconds': min(durations), 'median_seconds': statistics.median(durations), 'rows': rows}
+        logging.info(f"Query {name} returned {rows} rows in {min(durations):.4f}s (best of {repeats}).")
+    return timings
+
+def run_scale(scale, args):
+    """Generates the data of one scale factor, runs the pipeline on it and times the dashboard queries."""
+    import main
+    import scripts.state as state
+    import scripts.dimensions as dimensions
+
+    scale_path = os.path.join(args.data_path, f'scale_{scale:g}')
+    raw_path = os.path.join(scale_path, 'raw/')
+    if args.regenerate or not os.path.isdir(raw_path):
+        rows = generate_data(raw_path, scale, args.skew, args.compression, args.seed)
+    else:
+        rows = None
+
+    # Start from an empty state, output and (optionally) database, so every run loads the whole data
+    for path in ['processed', 'id_index', 'last_update.json']:
+        path = os.path.join(scale_path, path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    state.STATE_FILE = os.path.join(scale_path, 'last_update.json')
+    state.ID_INDEX_DIR = os.path.join(scale_path, 'id_index')
+    dimensions._cache.clear()
+    if args.reset_db:
+        reset_database()
+
+    report_path = os.path.join(scale_path, 'run_report.json')
+    main.config.update({
+        'input_data_path': raw_path,
+        'output_data_path': os.path.join(scale_path, 'processed/'),
+        'instrumentation': {'report_path': report_path},
+    })
+    main.config.setdefault('extract', {})['mode'] = args.mode
+
+    started = time.perf_counter()
+    main.run_etl_pipeline()
+    elapsed = time.perf_counter() - started
+    with open(report_path) as file:
+        report = json.load(file)
+
+    result = {
+        'rows': rows,
+        'succeeded': report['succeeded'],
+        'duration_seconds': elapsed,
+        'stages': {name: {field: stage[field] for field in STAGE_FIELDS} for name, stage in report['stages'].items()},
+    }
+    if not args.skip_queries:
+        result['queries'] = time_queries(read_dashboard_queries(args.queries), args.query_repeats)
+        dispose_engines()
+    return result
+
+def compare_results(previous, current, threshold=0.2, min_seconds=0.05):
+    """Returns the stages and queries at least threshold slower than in the previous results.
+
+    Timings under min_seconds in both runs are ignored, as they are mostly noise.
+    """
+    regressions = []
+    for scale, scale_result in current['scales'].items():
+        previous_scale = previous['scales'].get(scale)
+        if not previous_scale:
+            continue
+        pairs = [('total', previous_scale['duration_seconds'], scale_result['duration_seconds'])]
+        pairs += [(f'stage {name}', previous_scale['stages'][name]['wall_seconds'], stage['wall_seconds'])
+                  for name, stage in scale_result['stages'].items() if name in previous_scale['stages']]
+        pairs += [(f'query {name}', previous_scale.get('queries', {})[name]['min_seconds'], query['min_seconds'])
+                  for name, query in scale_result.get('queries', {}).items() if name in previous_scale.get('queries', {})]
+
+        for name, before, after in pairs:
+            if max(before, after) < min_seconds:
+                continue
+            change = (after - before) / before if before else float('inf')
+            line = f"scale {scale} {name}: {before:.4f}s -> {after:.4f}s ({change:+.1%})"
+            if change >= threshold:
+                regressions.append(line)
+                logging.warning(f"Regression: {line}")
+            else:
+                logging.info(line)
+    return regressions
+
+def run_benchmarks(args):
+    """Runs the benchmark at every scale factor, stores the results and compares them to a previous run."""
+    results = {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'mode': args.mode,
+        'skew': args.skew,
+        'compression': args.compression,
+        'scales': {f'{scale:g}': run_scale(scale, args) for scale in args.scales},
+    }
+
+    os.makedirs(args.results_path, exist_ok=True)
+    results_file = os.path.join(args.results_path, f"{results['created_at'].replace(':', '')}-{results['commit']}.json")
+    with open(results_file, 'w') as file:
+        json.dump(results, file, indent=2)
+    logging.info(f"Benchmark results saved to {results_file}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare_results(json.load(file), results, args.threshold)
+        if regressions:
+            logging.warning(f"{len(regressions)} regressions against {args.compare}.")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the ETL stages and dashboard queries on synthetic data.")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100], help="scale factors of the sample size")
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the activity per user")
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help="compress the generated CSV files")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mode', choices=['batch', 'streaming'], default='batch', help="extract mode of the pipeline")
+    parser.add_argument('--data-path', default='data/benchmark/', help="directory of the generated data and run outputs")
+    parser.add_argument('--regenerate', action='store_true', help="regenerate data already generated for a scale")
+    parser.add_argument('--reset-db', action='store_true', help="drop the pipeline tables before each scale")
+    parser.add_argument('--queries', default=DASHBOARD_QUERIES_FILE, help="SQL file of the dashboard queries")
+    parser.add_argument('--query-repeats', type=int, default=3)
+    parser.add_argument('--skip-queries', action='store_true', help="do not time the dashboard queries")
+    parser.add_argument('--results-path', default=RESULTS_PATH, help="directory the results are saved to")
+    parser.add_argument('--compare', help="previous results file to compare against, failing on regressions")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown reported as a regression")
+    sys.exit(run_benchmarks(parser.parse_args()))
@@ -4,16 +4,39 @@ import os
 # Add the project root to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import time
 import logging
+import argparse
 import yaml
-from scripts.extract import load_csv_incremental
+import pandas as pd
+from functools import partial
+from scripts.extract import load_csv_incremental, iter_csv_incremental, load_postgres_table, concat_raw_frames
 from scripts.transform import (
     transform_user_data, transform_fact_withdrawals, transform_fact_events,
     transform_fact_deposits, transform_dim_currency, transform_dim_interface,
-    transform_dim_time, transform_dim_event_type
+    transform_dim_time_extension, transform_dim_time_from_facts, transform_dim_event_type, transform_chunks,
+    assign_dimension_keys, resolve_surrogate_keys, resolve_chunk_keys, merge_amount_sketches,
+    drop_loaded_ids, drop_loaded_chunk_ids
 )
-from scripts.load import save_to_postgres
-from scripts.state import read_last_update_timestamp, update_last_update_timestamp
+from scripts.load import upsert_to_postgres, save_chunks_to_postgres, save_to_parquet, save_chunks_to_parquet, save_to_staging, index_fact_tables
+from scripts.state import (
+    read_last_update_timestamp, update_last_update_timestamp,
+    read_file_checkpoints, update_file_checkpoints, read_amount_sketches, update_amount_sketches,
+    read_id_index, update_id_index, update_refreshed_at, read_staging_checkpoints, update_staging_state,
+    read_pending_scopes, update_pending_scopes
+)
+from scripts.id_index import add_to_id_index
+from scripts.quality import check_quality, check_chunks_quality
+from scripts.rollups import rollup_scope, refresh_rollups, ROLLUP_SCOPE_COLUMNS
+from scripts.timestamps import to_naive_utc
+from scripts.plans import set_transform_engine, staged_window
+from scripts.metrics import prewarm_metrics_cache
+from scripts.dimensions import (
+    load_dimension_keys, commit_dimension_keys, load_time_bounds, commit_time_bounds, load_user_versions
+)
+from utils.db_connection import get_pool_metrics, dispose_engines
+from utils.scheduler import run_task_graph, IO_TASK, CPU_TASK
+from utils.instrumentation import reset_records, write_run_report
 from utils.logging import setup_logging
 
 # Load configuration
@@ -23,53 +46,583 @@ with open('config/config.yml') as file:
 # Setup logging
 setup_logging(config['log_file'])
 
+# Select the engine running the fact transformations of the staged windows
+set_transform_engine(config.get('transform', {}).get('engine', 'pandas'))
+
+def parquet_options():
+    """Returns the output path and compression used to persist the processed tables as Parquet."""
+    return {'output_path': config['output_data_path'], 'compression': config.get('parquet', {}).get('compression', 'zstd')}
+
+FACT_TABLES = ['fact_withdrawals', 'fact_deposits', 'fact_events']
+
+# Fact transformation and fact table of each fact source
+FACT_SOURCES = {
+    'withdrawals': (transform_fact_withdrawals, 'fact_withdrawals'),
+    'deposits': (transform_fact_deposits, 'fact_deposits'),
+    'events': (transform_fact_events, 'fact_events'),
+}
+
+# Raw files of each source under input_data_path, unless extract.sources in config.yml sets other glob patterns
+SOURCE_FILES = {
+    'user_id': 'user_id_sample_data.csv',
+    'user_level': 'user_level_sample_data.csv',
+    'withdrawals': 'withdrawals_sample_data.csv',
+    'deposits': 'deposit_sample_data.csv',
+    'events': 'event_sample_data.csv',
+}
+
+def source_files(source):
+    """Returns the glob pattern of the raw files of a source."""
+    pattern = config.get('extract', {}).get('sources', {}).get(source, SOURCE_FILES[source])
+    return os.path.join(config['input_data_path'], pattern)
+
+def staging_options():
+    """Returns the path and compression of the raw fact rows staged by event date for the windowed runs."""
+    return {'staging_path': config.get('staging_data_path', 'data/staged/'), 'compression': parquet_options()['compression']}
+
+def extract_workers():
+    """Returns how many raw files of a source are read at a time."""
+    return config.get('extract', {}).get('max_workers', 4)
+
+def quality_options(reports):
+    """Returns the options of the data-quality checks run before loading, collecting their reports."""
+    return {'reports': reports, **config.get('quality', {})}
+
+def log_quality_summary(reports):
+    """Logs how many of the data-quality checks of the run failed."""
+    failed = [report['table'] for report in reports if not report['passed']]
+    logging.info(f"Data-quality checks: {len(reports) - len(failed)} of {len(reports)} passed" + (f", failed on {', '.join(failed)}." if failed else "."))
+
+def report_run(started_at, succeeded, mode):
+    """Writes the instrumentation report of the run as JSON and as a Prometheus textfile."""
+    write_run_report(started_at, succeeded, mode=mode, pool_metrics=get_pool_metrics(), **config.get('instrumentation', {}))
+
+def release_database_connections():
+    """Logs the connection pool metrics of the run and closes its pooled connections."""
+    for url, metrics in get_pool_metrics().items():
+        logging.info(f"Connection pool metrics for {url}: {metrics}")
+    dispose_engines()
+
+def init_worker_process(run_config):
+    """Applies the configuration of the run, and its logging, in a worker process started for the CPU tasks."""
+    config.update(run_config)
+    setup_logging(config['log_file'])
+    set_transform_engine(config.get('transform', {}).get('engine', 'pandas'))
+
 def run_etl_pipeline():
     """Runs the full ETL pipeline."""
+    if config.get('extract', {}).get('mode') == 'streaming':
+        return run_streaming_etl_pipeline()
+
+    started_at, succeeded = time.time(), False
+    reset_records()
     try:
         logging.info("Starting ETL pipeline...")
 
-        # Get last update timestamp from state file
+        # Get last update timestamp and raw file checkpoints from state file
         last_update = read_last_update_timestamp()
-        
+        checkpoints = read_file_checkpoints()
+
+        # Extract the new rows of every source as the first tasks of the batch
+        load_batch({
+            f'extract_{source}': (partial(load_csv_incremental, source_files(source), last_update, checkpoints, source, extract_workers()), [], IO_TASK)
+            for source in SOURCE_FILES
+        }, checkpoints)
+
+        logging.info("ETL pipeline completed successfully.")
+        succeeded = True
+    except Exception as e:
+        logging.error(f"ETL pipeline failed: {e}")
+    finally:
+        report_run(started_at, succeeded, 'batch')
+        release_database_connections()
+
+def load_batch(extract_tasks, checkpoints, pending_scopes=None):
+    """Transforms and loads the raw rows returned by the extract_<source> tasks, then commits the state
+    of the batch: watermark, file checkpoints, amount digests, id indexes and dimension keys.
+
+    checkpoints are the file checkpoints of the extracted rows, stored once the batch is loaded.
+    With pending_scopes (follow mode), the rollup scopes of the batch are added to them for a later
+    refresh_loaded_facts instead of refreshing the rollups and metrics after the batch.
+    Returns the rows loaded into each fact table.
+    """
+    # Get the current dimension keys and calendar bounds, so only new dimension rows are written
+    previous_keys = load_dimension_keys()
+    dimension_keys = load_dimension_keys()
+    time_bounds = load_time_bounds()
+
+    # Get the per-currency digests of the withdrawal amounts, which set the outlier cut-off
+    amount_sketches = read_amount_sketches()
+
+    # Get the ids already loaded into each fact table, so re-delivered rows are dropped before loading
+    id_indexes = {table_name: read_id_index(table_name) for table_name in FACT_TABLES}
+
+    # Extract, transform and load as a task graph, running independent steps concurrently
+    tasks = {
         # Extract data
-        user_id_df = load_csv_incremental(config['input_data_path'] + 'user_id_sample_data.csv', last_update)
-        user_level_df = load_csv_incremental(config['input_data_path'] + 'user_level_sample_data.csv', last_update)
-        withdrawals_df = load_csv_incremental(config['input_data_path'] + 'withdrawals_sample_data.csv', last_update)
-        deposits_df = load_csv_incremental(config['input_data_path'] + 'deposit_sample_data.csv', last_update)
-        events_df = load_csv_incremental(config['input_data_path'] + 'event_sample_data.csv', last_update)
+        **extract_tasks,
 
         # Transform data
-        fact_withdrawals_table = transform_fact_withdrawals(withdrawals_df)
-        fact_deposits_table = transform_fact_deposits(deposits_df)
-        fact_events_table = transform_fact_events(events_df)
-        dim_user_table = transform_user_data(user_id_df, user_level_df)
-        dim_currency_table = transform_dim_currency(fact_withdrawals_table, fact_deposits_table)
-        dim_interface_table = transform_dim_interface(fact_withdrawals_table)
+        'amount_sketches': (partial(merge_amount_sketches, amount_sketches), ['extract_withdrawals'], IO_TASK),
+        'transform_withdrawals': (transform_fact_withdrawals, ['extract_withdrawals', 'amount_sketches'], CPU_TASK),
+        'transform_deposits': (transform_fact_deposits, ['extract_deposits'], CPU_TASK),
+        'transform_events': (transform_fact_events, ['extract_events'], CPU_TASK),
+        'user_versions': (load_user_versions, ['extract_user_id', 'extract_user_level'], IO_TASK),
+        'dim_user': (transform_user_data, ['extract_user_id', 'extract_user_level', 'user_versions'], CPU_TASK),
+
+        # Drop the rows whose id was already loaded by an earlier run
+        'new_withdrawals': (partial(drop_loaded_ids, id_index=id_indexes['fact_withdrawals']), ['transform_withdrawals'], CPU_TASK),
+        'new_deposits': (partial(drop_loaded_ids, id_index=id_indexes['fact_deposits']), ['transform_deposits'], CPU_TASK),
+        'new_events': (partial(drop_loaded_ids, id_index=id_indexes['fact_events']), ['transform_events'], CPU_TASK),
+
+        # Assign keys to new dimension members (in-process, as it updates dimension_keys) and
+        # replace the dimension columns of the facts with those keys
+        'dimension_keys': (partial(assign_dimension_keys, dimension_keys), ['new_withdrawals', 'new_deposits', 'new_events'], IO_TASK),
+        'fact_withdrawals': (resolve_surrogate_keys, ['new_withdrawals', 'dimension_keys'], CPU_TASK),
+        'fact_deposits': (resolve_surrogate_keys, ['new_deposits', 'dimension_keys'], CPU_TASK),
+        'fact_events': (resolve_surrogate_keys, ['new_events', 'dimension_keys'], CPU_TASK),
+        'dim_currency': (partial(transform_dim_currency, previous_keys=previous_keys), ['dimension_keys'], CPU_TASK),
+        'dim_interface': (partial(transform_dim_interface, previous_keys=previous_keys), ['dimension_keys'], CPU_TASK),
+        'dim_time': (partial(transform_dim_time_from_facts, time_bounds=time_bounds), ['fact_withdrawals', 'fact_deposits', 'fact_events'], CPU_TASK),
+        'dim_event_type': (partial(transform_dim_event_type, previous_keys=previous_keys), ['dimension_keys'], CPU_TASK),
+    }
+
+    # Check the data quality of the fact tables (in-process, as it collects the reports) before loading them
+    quality_reports = []
+    for table_name in FACT_TABLES:
+        tasks[f'check_{table_name}'] = (partial(check_quality, table_name=table_name, **quality_options(quality_reports)), [table_name, 'dimension_keys'], IO_TASK)
+
+    # Load data into PostgreSQL and persist it as Parquet
+    for table_name in ['fact_withdrawals', 'fact_deposits', 'fact_events', 'dim_user',
+                       'dim_currency', 'dim_interface', 'dim_time', 'dim_event_type']:
+        source = f'check_{table_name}' if f'check_{table_name}' in tasks else table_name
+        tasks[f'load_{table_name}'] = (partial(upsert_to_postgres, table_name=table_name), [source], IO_TASK)
+        tasks[f'persist_{table_name}'] = (partial(save_to_parquet, table_name=table_name, **parquet_options()), [source], IO_TASK)
+
+    results = run_task_graph(tasks, initializer=init_worker_process, initargs=(config,), **config.get('scheduler', {}))
+    log_quality_summary(quality_reports)
+
+    if pending_scopes is None:
+        # Index the loaded fact tables and analyze their touched partitions, then refresh the rollup
+        # tables for the days and users of the loaded facts
+        scopes = {table_name: rollup_scope(results[table_name]) for table_name in FACT_TABLES}
+        index_fact_tables(scopes)
+        refresh_rollups(scopes)
+    else:
+        # Keep the days and users of the loaded facts for the next refresh, before committing the batch
+        for table_name in FACT_TABLES:
+            pending_scopes[table_name] = rollup_scope(results[table_name], pending_scopes.get(table_name))
+        update_pending_scopes(pending_scopes)
+
+    # Update the last update timestamp
+    update_last_update_timestamp(results['fact_withdrawals'], results['fact_deposits'], results['fact_events'])
+    update_file_checkpoints(checkpoints)
+    update_amount_sketches(amount_sketches)
+    for table_name in FACT_TABLES:
+        if not results[table_name].empty:
+            update_id_index(table_name, add_to_id_index(id_indexes[table_name], results[table_name]['id'].to_numpy()))
+    commit_dimension_keys(dimension_keys)
+    commit_time_bounds(time_bounds, results['dim_time'])
+    if pending_scopes is None:
+        update_refreshed_at()
+
+        # Recompute the served metrics at the new watermark
+        prewarm_metrics_cache(config.get('api', {}).get('url'))
+    return {table_name: len(results[table_name]) for table_name in FACT_TABLES}
+
+def refresh_loaded_facts(scopes):
+    """Indexes and analyzes the fact tables, refreshes the rollups for the days and users of the loaded
+    facts in scopes, then moves the watermark and recomputes the served metrics."""
+    index_fact_tables(scopes)
+    refresh_rollups(scopes)
+    update_refreshed_at()
+
+    # Recompute the served metrics at the new watermark
+    prewarm_metrics_cache(config.get('api', {}).get('url'))
+
+def summarize_chunks(chunks, summary):
+    """Yields the chunks unchanged while collecting their event_timestamp range and rollup scope."""
+    summary['rollup_scope'] = rollup_scope(pd.DataFrame())
+    for chunk in chunks:
+        rollup_scope(chunk, summary['rollup_scope'])
+        chunk_min, chunk_max = chunk['event_timestamp'].min(), chunk['event_timestamp'].max()
+        summary['min_timestamp'] = min(summary.get('min_timestamp', chunk_min), chunk_min)
+        summary['max_timestamp'] = max(summary.get('max_timestamp', chunk_max), chunk_max)
+        yield chunk
+
+def stream_fact_table(source, transform_func, table_name, last_update, checkpoints, dimension_keys, quality_reports, id_index, amount_sketches=None):
+    """Streams the raw files of a source through its fact transformation into PostgreSQL and returns its summary."""
+    summary = {}
+    chunks = iter_csv_incremental(source_files(source), last_update, config['extract']['chunk_size'], checkpoints, source)
+    if amount_sketches is not None:
+        transform_func = partial(transform_func, amount_sketches=amount_sketches)
+    chunks = drop_loaded_chunk_ids(transform_chunks(chunks, transform_func), id_index)
+    chunks = resolve_chunk_keys(chunks, dimension_keys)
+    chunks = check_chunks_quality(chunks, dimension_keys, table_name, **quality_options(quality_reports))
+    chunks = save_chunks_to_parquet(chunks, table_name, **parquet_options())
+    save_chunks_to_postgres(summarize_chunks(chunks, summary), table_name)
+    return summary
+
+def run_streaming_etl_pipeline():
+    """Runs the ETL pipeline streaming the fact sources chunk by chunk to keep memory bounded."""
+    started_at, succeeded = time.time(), False
+    reset_records()
+    try:
+        logging.info("Starting streaming ETL pipeline...")
+
+        # Get last update timestamp and raw file checkpoints from state file
+        last_update = read_last_update_timestamp()
+        checkpoints = read_file_checkpoints()
+
+        # Get the current dimension keys and calendar bounds, so only new dimension rows are written
+        previous_keys = load_dimension_keys()
+        dimension_keys = load_dimension_keys()
+        time_bounds = load_time_bounds()
+
+        # Get the per-currency digests of the withdrawal amounts, which set the outlier cut-off, and merge
+        # the amounts of the whole delta into them first (without advancing the checkpoints), so every
+        # chunk is cut against the same cut-offs, whatever its position in the stream
+        amount_sketches = read_amount_sketches()
+        for chunk in iter_csv_incremental(source_files('withdrawals'), last_update, config['extract']['chunk_size'], dict(checkpoints), 'withdrawals'):
+            merge_amount_sketches(amount_sketches, chunk)
+
+        # Get the ids already loaded into each fact table, so re-delivered rows are dropped before loading
+        id_indexes = {table_name: read_id_index(table_name) for table_name in FACT_TABLES}
+
+        # Extract, transform, check and load the fact tables chunk by chunk, streaming them concurrently
+        quality_reports = []
+        summaries = run_task_graph({
+            'stream_withdrawals': (partial(stream_fact_table, 'withdrawals', transform_fact_withdrawals, 'fact_withdrawals', last_update, checkpoints, dimension_keys, quality_reports, id_indexes['fact_withdrawals'], amount_sketches), [], IO_TASK),
+            'stream_deposits': (partial(stream_fact_table, 'deposits', transform_fact_deposits, 'fact_deposits', last_update, checkpoints, dimension_keys, quality_reports, id_indexes['fact_deposits']), [], IO_TASK),
+            'stream_events': (partial(stream_fact_table, 'events', transform_fact_events, 'fact_events', last_update, checkpoints, dimension_keys, quality_reports, id_indexes['fact_events']), [], IO_TASK),
+        }, max_workers=config.get('scheduler', {}).get('max_workers', 4))
+        log_quality_summary(quality_reports)
+
+        # User sources are small enough to be loaded at once
+        user_id_df = load_csv_incremental(source_files('user_id'), last_update, checkpoints, 'user_id', extract_workers())
+        user_level_df = load_csv_incremental(source_files('user_level'), last_update, checkpoints, 'user_level', extract_workers())
+        dim_user_table = transform_user_data(user_id_df, user_level_df, load_user_versions(user_id_df, user_level_df))
+
+        # Build the new dimension rows from the keys assigned while streaming
+        dim_currency_table = transform_dim_currency(dimension_keys, previous_keys)
+        dim_interface_table = transform_dim_interface(dimension_keys, previous_keys)
+        dim_event_type_table = transform_dim_event_type(dimension_keys, previous_keys)
 
         # Get date range for Dim_Time
-        min_date = min(fact_withdrawals_table['event_timestamp'].min(), fact_events_table['event_timestamp'].min())
-        max_date = max(fact_withdrawals_table['event_timestamp'].max(), fact_events_table['event_timestamp'].max())
-        dim_time_table = transform_dim_time(min_date, max_date)
-
-        dim_event_type_table = transform_dim_event_type(fact_events_table)
-
-        # Load data
-        save_to_postgres(fact_withdrawals_table, 'fact_withdrawals')
-        save_to_postgres(fact_deposits_table, 'fact_deposits')
-        save_to_postgres(fact_events_table, 'fact_events')
-        save_to_postgres(dim_user_table, 'dim_user')
-        save_to_postgres(dim_currency_table, 'dim_currency')
-        save_to_postgres(dim_interface_table, 'dim_interface')
-        save_to_postgres(dim_time_table, 'dim_time')
-        save_to_postgres(dim_event_type_table, 'dim_event_type')
+        min_date = min((s['min_timestamp'] for s in summaries.values() if 'min_timestamp' in s), default=None)
+        max_date = max((s['max_timestamp'] for s in summaries.values() if 'max_timestamp' in s), default=None)
+        dim_time_table = transform_dim_time_extension(min_date, max_date, time_bounds)
+
+        # Load dimensions
+        upsert_to_postgres(dim_user_table, 'dim_user')
+        upsert_to_postgres(dim_currency_table, 'dim_currency')
+        upsert_to_postgres(dim_interface_table, 'dim_interface')
+        upsert_to_postgres(dim_time_table, 'dim_time')
+        upsert_to_postgres(dim_event_type_table, 'dim_event_type')
+        save_to_parquet(dim_user_table, 'dim_user', **parquet_options())
+        save_to_parquet(dim_currency_table, 'dim_currency', **parquet_options())
+        save_to_parquet(dim_interface_table, 'dim_interface', **parquet_options())
+        save_to_parquet(dim_time_table, 'dim_time', **parquet_options())
+        save_to_parquet(dim_event_type_table, 'dim_event_type', **parquet_options())
+
+        # Index the streamed fact tables and analyze their touched partitions, then refresh the rollup
+        # tables for the days and users of the streamed facts
+        scopes = {
+            'fact_withdrawals': summaries['stream_withdrawals']['rollup_scope'],
+            'fact_deposits': summaries['stream_deposits']['rollup_scope'],
+            'fact_events': summaries['stream_events']['rollup_scope'],
+        }
+        index_fact_tables(scopes)
+        refresh_rollups(scopes)
 
         # Update the last update timestamp
-        update_last_update_timestamp(fact_withdrawals_table, fact_deposits_table, fact_events_table)
-        
-        logging.info("ETL pipeline completed successfully.")
+        update_last_update_timestamp(*[
+            pd.DataFrame({'event_timestamp': [summary['max_timestamp']]})
+            for summary in summaries.values() if 'max_timestamp' in summary
+        ])
+        update_file_checkpoints(checkpoints)
+        update_amount_sketches(amount_sketches)
+        for table_name in FACT_TABLES:
+            update_id_index(table_name, id_indexes[table_name])
+        commit_dimension_keys(dimension_keys)
+        commit_time_bounds(time_bounds, dim_time_table)
+        update_refreshed_at()
+
+        # Recompute the served metrics at the new watermark
+        prewarm_metrics_cache(config.get('api', {}).get('url'))
+
+        logging.info("Streaming ETL pipeline completed successfully.")
+        succeeded = True
     except Exception as e:
-        logging.error(f"ETL pipeline failed: {e}")
+        logging.error(f"Streaming ETL pipeline failed: {e}")
+    finally:
+        report_run(started_at, succeeded, 'streaming')
+        release_database_connections()
+
+def run_micro_batch(frames, checkpoints, pending_scopes):
+    """Loads the raw rows read by the follow mode since the last micro-batch and commits its state,
+    adding the rollup scopes of its facts to pending_scopes."""
+    started_at, succeeded = time.time(), False
+    reset_records()
+    try:
+        loaded = load_batch({f'extract_{source}': (partial(frames.get, source), [], IO_TASK) for source in SOURCE_FILES}, checkpoints, pending_scopes)
+        logging.info(f"Micro-batch of {sum(map(len, frames.values()))} raw rows loaded: {loaded}")
+        succeeded = True
+    finally:
+        report_run(started_at, succeeded, 'follow')
+    return succeeded
+
+def run_follow_refresh(pending_scopes):
+    """Refreshes the rollups and metrics over the micro-batches loaded since the last refresh of the follow mode."""
+    started_at, succeeded = time.time(), False
+    reset_records()
+    try:
+        refresh_loaded_facts(pending_scopes)
+        update_pending_scopes({})
+        pending_scopes.clear()
+        succeeded = True
+    finally:
+        report_run(started_at, succeeded, 'follow_refresh')
+    return succeeded
+
+def run_follow_pipeline(max_rows=None, max_seconds=None, poll_seconds=None, refresh_seconds=None):
+    """Tails the raw files until interrupted, loading their appended rows and new files in micro-batches.
+
+    A micro-batch is loaded once max_rows raw rows are waiting or the oldest one has waited max_seconds
+    (follow in config.yml). The rows are read after the byte checkpoints rather than the last update
+    timestamp, so rows of a source arriving later than newer rows of another source are not dropped.
+    Each micro-batch commits its checkpoints and watermark, so a restart resumes after the last one loaded.
+    The fact indexes, partition statistics, rollups and metrics cache are refreshed at most once every
+    refresh_seconds, over the days and users of the micro-batches loaded since the last refresh.
+    """
+    follow_config = config.get('follow', {})
+    max_rows = max_rows or follow_config.get('max_rows', 50000)
+    max_seconds = max_seconds or follow_config.get('max_seconds', 5)
+    poll_seconds = poll_seconds or follow_config.get('poll_seconds', 1)
+    refresh_seconds = refresh_seconds or follow_config.get('refresh_seconds', 60)
+    logging.info(f"Following {config['input_data_path']} in micro-batches of {max_rows} rows or {max_seconds}s, "
+                 f"refreshing the rollups every {refresh_seconds}s...")
+
+    checkpoints = read_file_checkpoints()
+    pending, empty, waiting_since = {source: [] for source in SOURCE_FILES}, {}, None
+    # Scopes committed before a restart are refreshed on the first poll
+    pending_scopes, refreshed_at = read_pending_scopes(), time.monotonic() - refresh_seconds
+    try:
+        while True:
+            # Read the complete rows written since the last poll, advancing the checkpoints of the micro-batch
+            try:
+                for source in SOURCE_FILES:
+                    df = load_csv_incremental(source_files(source), None, checkpoints, source, extract_workers(), complete_rows_only=True)
+                    if len(df):
+                        pending[source].append(df)
+                    empty[source] = df.iloc[:0]
+            except Exception as e:
+                logging.warning(f"Reading the raw files failed, retrying on the next poll: {e}")
+
+            pending_rows = sum(len(df) for dfs in pending.values() for df in dfs)
+            if pending_rows and waiting_since is None:
+                waiting_since = time.monotonic()
+            ready = pending_rows >= max_rows or (pending_rows and time.monotonic() - waiting_since >= max_seconds)
+            # Every source must have been read once, for the columns of the sources without new rows
+            loaded = False
+            if ready and len(empty) == len(SOURCE_FILES):
+                frames = {source: concat_raw_frames(dfs) if dfs else empty[source] for source, dfs in pending.items()}
+                try:
+                    run_micro_batch(frames, checkpoints, pending_scopes)
+                    pending, waiting_since, loaded = {source: [] for source in SOURCE_FILES}, None, True
+                except Exception as e:
+                    # The rows stay pending and are loaded with the next micro-batch
+                    logging.error(f"Micro-batch failed, retrying on the next poll: {e}")
+
+            # Refresh the rollups and metrics once per refresh interval rather than after every micro-batch
+            if pending_scopes and time.monotonic() - refreshed_at >= refresh_seconds:
+                try:
+                    run_follow_refresh(pending_scopes)
+                    refreshed_at = time.monotonic()
+                except Exception as e:
+                    # The scopes stay pending and are refreshed on the next poll
+                    logging.error(f"Refreshing the rollups failed, retrying on the next poll: {e}")
+            if not loaded:
+                time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        logging.info("Follow mode stopped, rows read since the last micro-batch will be read again on restart.")
+        # Refresh the rollups of the micro-batches loaded since the last refresh before exiting
+        if pending_scopes:
+            try:
+                run_follow_refresh(pending_scopes)
+            except Exception as e:
+                logging.error(f"Refreshing the rollups failed, they will be refreshed on restart: {e}")
+    finally:
+        release_database_connections()
+
+# Name of the Parquet files of the fact windows in each event date partition. Windows cover whole days,
+# so loading a day again replaces its files, whichever window it is part of
+WINDOW_FILE_NAME = 'window'
+
+def date_ranges(days):
+    """Merges event days into contiguous [start, end) ranges, returned as {'start', 'end'} ISO strings."""
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + pd.Timedelta(days=1)
+        else:
+            ranges.append([day, day + pd.Timedelta(days=1)])
+    return [{'start': start.isoformat(), 'end': end.isoformat()} for start, end in ranges]
+
+def plan_windows(start, end, freq=None, staged_ranges=None):
+    """Splits [start, end) and the event date ranges staged by stage_raw_data into windows aligned on
+    freq (dag.window_freq in config.yml), returned as {'start', 'end'} ISO strings for the task mapping
+    of the Airflow DAG.
+
+    The staged ranges hold the late rows of earlier days and, on the first run, the history, which the
+    interval alone would leave staged but never loaded. The ranges are widened to whole days and merged
+    where they overlap or touch.
+    """
+    freq = freq or config.get('dag', {}).get('window_freq', 'MS')
+    ranges = sorted((to_naive_utc(bounds['start']).floor('D'), to_naive_utc(bounds['end']).ceil('D'))
+                    for bounds in [{'start': start, 'end': end}, *(staged_ranges or [])])
+    merged = []
+    for left, right in ranges:
+        if merged and left <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], right)
+        elif left < right:
+            merged.append([left, right])
+
+    windows = []
+    for left, right in merged:
+        bounds = sorted({left, right, *pd.date_range(left, right, freq=freq)})
+        windows.extend({'start': first.isoformat(), 'end': last.isoformat()} for first, last in zip(bounds, bounds[1:]))
+    logging.info(f"Planned {len(windows)} windows between {start} and {end} and {len(staged_ranges or [])} staged date ranges.")
+    return windows
+
+def stage_raw_data():
+    """Stages the raw fact rows appended since the last staging by event date, so each window reads only
+    its own dates, and loads the dimensions of the new rows: dimension keys, calendar days, outlier
+    digests and the Dim_User versions of the new user rows.
+
+    Only the bytes after the staging checkpoints of the raw files are read, chunk by chunk, so a
+    scheduled run costs its new data rather than a scan of the raw history, and the fact windows only
+    resolve keys. The digests are stored with the checkpoints, so each amount is merged once, before
+    any window is cut, however often a window is re-run. It updates the shared state file, so the DAG
+    runs it for one run at a time.
+
+    Returns the event date ranges of the staged rows, for plan_windows.
+    """
+    try:
+        checkpoints = read_staging_checkpoints()
+        amount_sketches = read_amount_sketches()
+        previous_keys = load_dimension_keys()
+        dimension_keys = load_dimension_keys()
+        time_bounds = load_time_bounds()
+
+        staged_days = set()
+        for source in FACT_SOURCES:
+            staged_rows = 0
+            for chunk in iter_csv_incremental(source_files(source), None, config['extract']['chunk_size'], checkpoints, source):
+                # Rows without an event_timestamp belong to no window
+                chunk = chunk.dropna(subset=['event_timestamp'])
+                if chunk.empty:
+                    continue
+                if source == 'withdrawals':
+                    merge_amount_sketches(amount_sketches, chunk)
+                assign_dimension_keys(dimension_keys, chunk)
+                save_to_staging(chunk, source, **staging_options())
+                staged_days.update(chunk['event_timestamp'].dt.normalize().unique())
+                staged_rows += len(chunk)
+            logging.info(f"Staged {staged_rows} new rows of {source}.")
+
+        # Load the dimension rows of the new members and days, so the fact windows only resolve keys
+        min_date = min(staged_days, default=None)
+        max_date = max(staged_days, default=None)
+        dim_time_table = transform_dim_time_extension(min_date, max_date, time_bounds)
+        dimension_tables = {
+            'dim_currency': transform_dim_currency(dimension_keys, previous_keys),
+            'dim_interface': transform_dim_interface(dimension_keys, previous_keys),
+            'dim_time': dim_time_table,
+            'dim_event_type': transform_dim_event_type(dimension_keys, previous_keys),
+        }
+        for table_name, df in dimension_tables.items():
+            upsert_to_postgres(df, table_name)
+            save_to_parquet(df, table_name, **parquet_options())
+
+        # Level changes are merged into the stored versions of their users, so they need no window
+        user_id_df = load_csv_incremental(source_files('user_id'), None, checkpoints, 'user_id', extract_workers())
+        user_level_df = load_csv_incremental(source_files('user_level'), None, checkpoints, 'user_level', extract_workers())
+        dim_user_table = transform_user_data(user_id_df, user_level_df, load_user_versions(user_id_df, user_level_df))
+        upsert_to_postgres(dim_user_table, 'dim_user')
+        save_to_parquet(dim_user_table, 'dim_user', **parquet_options())
+
+        commit_dimension_keys(dimension_keys)
+        commit_time_bounds(time_bounds, dim_time_table)
+        update_staging_state(checkpoints, amount_sketches)
+        return date_ranges(staged_days)
+    except Exception as e:
+        logging.error(f"Staging raw data failed: {e}")
+        raise
+    finally:
+        release_database_connections()
+
+def transform_fact_window(source, start, end):
+    """Extracts, transforms and checks the staged facts of one source in [start, end), once their
+    dimension keys have been assigned by stage_raw_data."""
+    transform_func, table_name = FACT_SOURCES[source]
+    df = staged_window(source, staging_options()['staging_path'], start, end)
+    if source == 'withdrawals':
+        transform_func = partial(transform_func, amount_sketches=read_amount_sketches())
+
+    dimension_keys = load_dimension_keys()
+    fact_df = resolve_surrogate_keys(transform_func(df).drop_duplicates(subset=['id']), dimension_keys)
+    return check_quality(fact_df, dimension_keys, table_name, **quality_options([]))
+
+def load_fact_window(fact_df, table_name, start):
+    """Loads the facts of the window starting at start into PostgreSQL and Parquet.
+
+    Rows are merged on their keys and the Parquet files of each day are named the same by every window,
+    so a window can be re-run or loaded concurrently with the other windows.
+    """
+    upsert_to_postgres(fact_df, table_name)
+    save_to_parquet(fact_df, table_name, file_name=WINDOW_FILE_NAME, **parquet_options())
+    return len(fact_df)
+
+def run_fact_window(source, start, end):
+    """Extracts, transforms, checks and loads the facts of one source in [start, end), returning the rows loaded."""
+    try:
+        table_name = FACT_SOURCES[source][1]
+        rows = load_fact_window(transform_fact_window(source, start, end), table_name, start)
+        logging.info(f"Loaded {rows} rows of {table_name} between {start} and {end}.")
+        return rows
+    except Exception as e:
+        logging.error(f"{source} window {start} - {end} failed: {e}")
+        raise
+    finally:
+        release_database_connections()
+
+def finish_windows(windows):
+    """Indexes the fact tables loaded in the windows planned by plan_windows, analyzes their touched
+    partitions, refreshes the rollup rows of their days and users and warms the metrics API at the new
+    watermark. The days and users are read one window at a time, so only their distinct keys are kept."""
+    try:
+        scopes = {table_name: rollup_scope(pd.DataFrame(columns=ROLLUP_SCOPE_COLUMNS)) for table_name in FACT_TABLES}
+        for window in windows:
+            params = {'start': to_naive_utc(window['start']).to_pydatetime(), 'end': to_naive_utc(window['end']).to_pydatetime()}
+            for table_name in FACT_TABLES:
+                rollup_scope(load_postgres_table(table_name, ROLLUP_SCOPE_COLUMNS, 'event_timestamp >= %(start)s AND event_timestamp < %(end)s', params),
+                             scopes[table_name])
+        refresh_loaded_facts(scopes)
+    except Exception as e:
+        logging.error(f"Finishing {len(windows)} windows failed: {e}")
+        raise
+    finally:
+        release_database_connections()
 
 if __name__ == "__main__":
-    run_etl_pipeline()
+    parser = argparse.ArgumentParser(description="Runs the ETL pipeline once, or continuously with --follow.")
+    parser.add_argument('--follow', action='store_true', help="tail the raw files and load their new rows in micro-batches until interrupted")
+    parser.add_argument('--max-rows', type=int, default=None, help="raw rows that trigger a micro-batch (default: follow.max_rows)")
+    parser.add_argument('--max-seconds', type=float, default=None, help="longest wait of a row before its micro-batch (default: follow.max_seconds)")
+    args = parser.parse_args()
 
+    if args.follow:
+        run_follow_pipeline(args.max_rows, args.max_seconds)
+    else:
+        run_etl_pipeline()
@@ -0,0 +1,86 @@
+import copy
+import logging
+import threading
+import pandas as pd
+from scripts.extract import load_postgres_table
+from scripts.transform import DIM_USER_COLUMNS
+from scripts.state import read_dimension_keys, update_dimension_keys, read_time_bounds, update_time_bounds
+
+# Dimensions identified by surrogate keys: dimension -> (table, member column, key column)
+DIMENSION_TABLES = {
+    'currency': ('dim_currency', 'currency_name', 'currency_id'),
+    'interface': ('dim_interface', 'interface_name', 'interface_id'),
+    'event_type': ('dim_event_type', 'event_type_name', 'event_type_id'),
+}
+
+# Dimension keys and calendar bounds cached in-process, so a long-lived worker reads them only once
+_cache = {}
+_cache_lock = threading.Lock()
+
+def load_dimension_keys():
+    """Returns a copy of the dimension key maps.
+
+    They are read from the state file, or once from PostgreSQL for dimensions missing from it,
+    and then cached in-process for the following runs.
+    """
+    try:
+        with _cache_lock:
+            if 'dimension_keys' not in _cache:
+                dimension_keys = read_dimension_keys()
+                for dimension, (table_name, name_column, id_column) in DIMENSION_TABLES.items():
+                    if dimension not in dimension_keys:
+                        existing = load_postgres_table(table_name, [name_column, id_column])
+                        dimension_keys[dimension] = {str(name): int(key) for name, key in zip(existing[name_column], existing[id_column])}
+                _cache['dimension_keys'] = dimension_keys
+            return copy.deepcopy(_cache['dimension_keys'])
+    except Exception as e:
+        logging.error(f"Error loading dimension keys: {e}")
+        raise
+
+def commit_dimension_keys(dimension_keys):
+    """Persists the dimension key maps once the new members have been loaded."""
+    with _cache_lock:
+        update_dimension_keys(dimension_keys)
+        _cache['dimension_keys'] = copy.deepcopy(dimension_keys)
+
+def load_time_bounds():
+    """Returns the [first, last] date covered by Dim_Time, from the state file or once from PostgreSQL."""
+    try:
+        with _cache_lock:
+            if 'time_bounds' not in _cache:
+                time_bounds = read_time_bounds()
+                if time_bounds is None:
+                    existing = load_postgres_table('dim_time', ['date'])
+                    if not existing.empty:
+                        time_bounds = [str(existing['date'].min()), str(existing['date'].max())]
+                _cache['time_bounds'] = time_bounds
+            return _cache['time_bounds']
+    except Exception as e:
+        logging.error(f"Error loading Dim_Time bounds: {e}")
+        raise
+
+def commit_time_bounds(time_bounds, new_dim_time):
+    """Extends the Dim_Time bounds with the calendar rows added by the current run and persists them."""
+    if new_dim_time.empty:
+        return time_bounds
+
+    dates = [new_dim_time['date'].min(), new_dim_time['date'].max()]
+    if time_bounds:
+        dates += [pd.Timestamp(time_bounds[0]), pd.Timestamp(time_bounds[1])]
+    time_bounds = [str(min(dates)), str(max(dates))]
+
+    with _cache_lock:
+        update_time_bounds(time_bounds)
+        _cache['time_bounds'] = time_bounds
+    return time_bounds
+
+def load_user_versions(user_id_df, user_level_df):
+    """Returns every Dim_User version of the users present in the delta, read from PostgreSQL."""
+    try:
+        user_ids = pd.concat([user_id_df['user_id'].astype(object), user_level_df['user_id'].astype(object)]).dropna().unique().tolist()
+        if not user_ids:
+            return pd.DataFrame(columns=DIM_USER_COLUMNS)
+        return load_postgres_table('dim_user', DIM_USER_COLUMNS, 'user_id = ANY(%(user_ids)s)', {'user_ids': user_ids})
+    except Exception as e:
+        logging.error(f"Error loading Dim_User versions: {e}")
+        raise
@@ -1,6 +1,25 @@
+import csv
+import glob
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import logging
+from pandas.api.types import union_categoricals
+from sqlalchemy import inspect
+from scripts.timestamps import parse_timestamps, parse_event_timestamps, to_naive_utc
+from scripts.schemas import RAW_DTYPES, TABLE_SCHEMAS, STAGED_SCHEMAS, PARTITION_COLUMN, PARTITIONED_TABLES
+from utils.db_connection import get_postgres_engine
+from utils.instrumentation import instrumented
 
+# Raw files with these extensions are decompressed while they are read
+COMPRESSED_EXTENSIONS = ('.gz', '.zst')
+
+@instrumented
 def load_csv(file_path):
     """Loads a CSV file into a DataFrame."""
     try:
@@ -11,18 +30,293 @@ def load_csv(file_path):
         logging.error(f"Error loading {file_path}: {e}")
         raise
 
+def filter_new_records(df, last_update_timestamp=None):
+    """Keeps only the rows with an event_timestamp newer than last_update_timestamp."""
+    # Sources without event_timestamp (e.g. user_id) are always loaded in full
+    if not last_update_timestamp or 'event_timestamp' not in df.columns:
+        return df
+
+    df['event_timestamp'] = parse_timestamps(df['event_timestamp'])
+    return df[df['event_timestamp'] > pd.Timestamp(last_update_timestamp)]
+
+class _ByteRangeReader(io.RawIOBase):
+    """Raw reader that stops at a fixed byte offset of the underlying file."""
+
+    def __init__(self, file, end):
+        self._file = file
+        self._end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        remaining = self._end - self._file.tell()
+        if remaining <= 0:
+            return 0
+        data = self._file.read(min(len(buffer), remaining))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+def _hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+def _last_row_start(file, size):
+    """Returns the byte offset where the last row of a file starts."""
+    position, buffer = size, b''
+    while position > 0:
+        # Read the file backwards in blocks until the line break before the last row is found
+        block_size = min(65536, position)
+        position -= block_size
+        file.seek(position)
+        buffer = file.read(block_size) + buffer
+        newline = buffer.rfind(b'\n', 0, len(buffer) - 1 if buffer.endswith(b'\n') else len(buffer))
+        if newline != -1:
+            return position + newline + 1
+    return 0
+
+def _resolve_start_offset(file, file_path, header, checkpoint):
+    """Returns the byte offset to resume reading from, or None when the file must be fully scanned."""
+    if not checkpoint:
+        return None
+    if checkpoint['header_hash'] != _hash_bytes(header):
+        logging.info(f"Header of {file_path} changed since the last checkpoint, falling back to a full scan.")
+        return None
+    if os.path.getsize(file_path) < checkpoint['offset']:
+        logging.info(f"{file_path} was truncated since the last checkpoint, falling back to a full scan.")
+        return None
+
+    # The last consumed row must still be in place, otherwise the file was rewritten
+    file.seek(checkpoint['last_row_start'])
+    last_row = file.read(checkpoint['offset'] - checkpoint['last_row_start'])
+    if _hash_bytes(last_row) != checkpoint['last_row_hash']:
+        logging.info(f"{file_path} was rewritten since the last checkpoint, falling back to a full scan.")
+        return None
+    return checkpoint['offset']
+
+def open_csv_tail(file_path, checkpoints=None, complete_rows_only=False):
+    """Opens a CSV file positioned at the first row not consumed yet.
+
+    Returns the text stream, the header columns, the checkpoint to store once the stream has been
+    fully processed and whether it resumes after a checkpoint. Only the bytes present when the file is
+    opened are read, and with complete_rows_only a last row still being written (without its line
+    break) is left for later.
+    """
+    file = open(file_path, 'rb')
+    stat = os.stat(file_path)
+    header = file.readline()
+    columns = next(csv.reader([header.decode('utf-8-sig')]))
+
+    checkpoint = (checkpoints or {}).get(file_path)
+    start = _resolve_start_offset(file, file_path, header, checkpoint) or len(header)
+    if start > len(header):
+        logging.info(f"Resuming {file_path} from byte {start} of {stat.st_size}")
+
+    end = stat.st_size
+    if complete_rows_only and end > len(header):
+        file.seek(end - 1)
+        if file.read(1) != b'\n':
+            end = max(_last_row_start(file, end), len(header))
+
+    last_row_start = _last_row_start(file, end)
+    file.seek(last_row_start)
+    new_checkpoint = {
+        'offset': end,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'header_hash': _hash_bytes(header),
+        'last_row_start': last_row_start,
+        'last_row_hash': _hash_bytes(file.read(end - last_row_start)),
+    }
+
+    file.seek(start)
+    stream = io.TextIOWrapper(io.BufferedReader(_ByteRangeReader(file, end)), encoding='utf-8')
+    return stream, columns, new_checkpoint, start > len(header)
+
+def open_compressed_csv(file_path):
+    """Opens a gzip or zstd compressed CSV file, which cannot be resumed from an offset and is always read whole.
+
+    Returns the text stream, the header columns, the checkpoint to store once the stream has been
+    fully processed and False, as it never resumes, like open_csv_tail.
+    """
+    stat = os.stat(file_path)
+    stream = io.TextIOWrapper(io.BufferedReader(pa.input_stream(file_path, compression='detect')), encoding='utf-8-sig')
+    columns = next(csv.reader([stream.readline()]))
+    return stream, columns, {'size': stat.st_size, 'mtime': stat.st_mtime}, False
+
+def open_csv_file(file_path, checkpoints=None, complete_rows_only=False):
+    """Opens a raw CSV file at the first row not consumed yet, decompressing .gz and .zst files on the fly."""
+    if file_path.endswith(COMPRESSED_EXTENSIONS):
+        return open_compressed_csv(file_path)
+    return open_csv_tail(file_path, checkpoints, complete_rows_only)
+
+def list_raw_files(file_pattern, checkpoints=None):
+    """Returns the files matching a glob pattern in name order, split into the files to read and the files
+    consumed by earlier runs, whose size and modification time still match their checkpoint."""
+    file_paths = sorted(glob.glob(file_pattern))
+    if not file_paths:
+        raise FileNotFoundError(f"No raw files match {file_pattern}")
+
+    to_read, consumed = [], []
+    for file_path in file_paths:
+        checkpoint = (checkpoints or {}).get(file_path)
+        stat = os.stat(file_path)
+        unchanged = checkpoint and checkpoint['size'] == stat.st_size and checkpoint['mtime'] == stat.st_mtime
+        (consumed if unchanged else to_read).append(file_path)
+    if consumed:
+        logging.info(f"Skipping {len(consumed)} of {len(file_paths)} files matching {file_pattern} already consumed.")
+    return to_read, consumed
+
+def concat_raw_frames(frames):
+    """Concatenates the DataFrames of several raw files, keeping their categorical columns categorical."""
+    if len(frames) == 1:
+        return frames[0]
+    frames = list(frames)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            # Give every frame the union of the categories, so the concatenated column stays categorical
+            categories = union_categoricals([frame[column] for frame in frames]).categories
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def read_raw_files(read_file, file_paths, max_workers=4):
+    """Reads several raw files with read_file on a pool of max_workers threads and returns their results
+    in file order. The decompression and CSV tokenizing release the GIL, so the files are parsed in parallel."""
+    if len(file_paths) <= 1 or max_workers <= 1:
+        return [read_file(file_path) for file_path in file_paths]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        return list(executor.map(read_file, file_paths))
+
+@instrumented
+def load_staged_window(source, staging_path, start_timestamp, end_timestamp):
+    """Loads the raw rows of a fact source staged under staging_path with an event_timestamp in
+    [start_timestamp, end_timestamp), reading only the event date partitions of the window.
+
+    The rows are typed like the rows read from the raw files, so the windows transform them the same way.
+    """
+    try:
+        schema = STAGED_SCHEMAS[source]
+        table_path = os.path.join(staging_path, source)
+        start, end = to_naive_utc(start_timestamp), to_naive_utc(end_timestamp)
+        if os.path.isdir(table_path):
+            partitioning = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.date32())]), flavor='hive')
+            dataset = ds.dataset(table_path, schema=schema.append(pa.field(PARTITION_COLUMN, pa.date32())), format='parquet', partitioning=partitioning)
+            filters = ((ds.field(PARTITION_COLUMN) >= start.date()) & (ds.field(PARTITION_COLUMN) <= end.date())
+                       & (ds.field('event_timestamp') >= start.to_pydatetime()) & (ds.field('event_timestamp') < end.to_pydatetime()))
+            table = dataset.to_table(columns=schema.names, filter=filters)
+        else:
+            table = schema.empty_table()
+        df = table.to_pandas().astype(RAW_DTYPES[source])
+        logging.info(f"Successfully loaded {len(df)} staged rows of {source} between {start_timestamp} and {end_timestamp}")
+        return df
+    except Exception as e:
+        logging.error(f"Error loading staged rows of {source}: {e}")
+        raise
+
+def read_csv_header(file_path, source=None):
+    """Returns an empty DataFrame with the columns and types of a raw CSV file."""
+    stream, columns, _, _ = open_csv_file(file_path)
+    stream.close()
+    return pd.read_csv(io.StringIO(''), header=None, names=columns, dtype=RAW_DTYPES.get(source))
+
 # Function to load only new data since the last update
-def load_csv_incremental(file_path, last_update_timestamp=None):
+@instrumented
+def load_csv_incremental(file_pattern, last_update_timestamp=None, checkpoints=None, source=None, max_workers=4, complete_rows_only=False):
+    """Loads the new records of the CSV files matching a glob pattern, reading max_workers files at a time
+    and skipping the files consumed by earlier runs."""
+    def read_file(file_path):
+        stream, columns, checkpoint, resumed = open_csv_file(file_path, checkpoints, complete_rows_only)
+        with stream:
+            df = pd.read_csv(stream, header=None, names=columns, dtype=RAW_DTYPES.get(source))
+        # Parse event timestamps once, then filter only new records if last_update_timestamp is provided.
+        # The rows after a checkpoint are all new, even those older than the latest row of another source.
+        return filter_new_records(parse_event_timestamps(df), None if resumed else last_update_timestamp), checkpoint
+
     try:
-        df = pd.read_csv(file_path)
-        logging.info(f"Successfully loaded data from {file_path}")
+        file_paths, consumed = list_raw_files(file_pattern, checkpoints)
+        if not file_paths:
+            return filter_new_records(parse_event_timestamps(read_csv_header(consumed[-1], source)), last_update_timestamp)
 
-        # Filter only new records if last_update_timestamp is provided
-        if last_update_timestamp:
-            df['event_timestamp'] = pd.to_datetime(df['event_timestamp'])
-            df = df[df['event_timestamp'] > pd.to_datetime(last_update_timestamp)]
+        results = read_raw_files(read_file, file_paths, max_workers)
+        df = concat_raw_frames([df for df, _ in results])
+        logging.info(f"Successfully loaded data from {len(file_paths)} files matching {file_pattern}")
 
+        if checkpoints is not None:
+            checkpoints.update({file_path: checkpoint for file_path, (_, checkpoint) in zip(file_paths, results)})
         return df
     except Exception as e:
-        logging.error(f"Error loading {file_path}: {e}")
-        raise
\ No newline at end of file
+        logging.error(f"Error loading {file_pattern}: {e}")
+        raise
+
+def iter_csv_incremental(file_pattern, last_update_timestamp=None, chunk_size=100000, checkpoints=None, source=None):
+    """Streams the CSV files matching a glob pattern in chunks, one file after the other, yielding only the
+    new records of each chunk and skipping the files consumed by earlier runs."""
+    try:
+        file_paths, _ = list_raw_files(file_pattern, checkpoints)
+        for file_path in file_paths:
+            rows_read = 0
+            stream, columns, checkpoint, resumed = open_csv_file(file_path, checkpoints)
+            # The rows after a checkpoint are all new, even those older than the latest row of another source
+            file_last_update = None if resumed else last_update_timestamp
+            with stream, pd.read_csv(stream, header=None, names=columns, dtype=RAW_DTYPES.get(source), chunksize=chunk_size) as reader:
+                for chunk in reader:
+                    rows_read += len(chunk)
+                    chunk = filter_new_records(parse_event_timestamps(chunk), file_last_update)
+                    if not chunk.empty:
+                        yield chunk
+            logging.info(f"Successfully streamed {rows_read} rows from {file_path}")
+
+            # The checkpoint of a file only advances once its whole tail has been consumed
+            if checkpoints is not None:
+                checkpoints[file_path] = checkpoint
+    except Exception as e:
+        logging.error(f"Error streaming {file_pattern}: {e}")
+        raise
+
+@instrumented
+def load_parquet_table(table_name, input_path, columns=None, start_timestamp=None, end_timestamp=None):
+    """Loads a processed Parquet table through memory-mapped Arrow, reading only the needed columns
+    and, for fact tables, only the event date partitions within [start_timestamp, end_timestamp]."""
+    try:
+        table_path = os.path.join(input_path, table_name)
+        columns = columns or TABLE_SCHEMAS[table_name].names
+
+        # Filters on event_date prune whole partitions, the ones on event_timestamp use row group statistics
+        filters = None
+        if table_name in PARTITIONED_TABLES:
+            if start_timestamp is not None:
+                start = pd.Timestamp(start_timestamp)
+                filters = (ds.field(PARTITION_COLUMN) >= start.date()) & (ds.field('event_timestamp') >= start.to_pydatetime())
+            if end_timestamp is not None:
+                end = pd.Timestamp(end_timestamp)
+                end_filter = (ds.field(PARTITION_COLUMN) <= end.date()) & (ds.field('event_timestamp') <= end.to_pydatetime())
+                filters = end_filter if filters is None else filters & end_filter
+
+        partitioning = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.date32())]), flavor='hive') if table_name in PARTITIONED_TABLES else None
+        table = pq.read_table(table_path, columns=columns, filters=filters, memory_map=True, partitioning=partitioning)
+        logging.info(f"Successfully loaded {table.num_rows} rows of {table_name} from {table_path}")
+        return table.to_pandas()
+    except Exception as e:
+        logging.error(f"Error loading {table_name} from Parquet: {e}")
+        raise
+
+@instrumented
+def load_postgres_table(table_name, columns, where=None, params=None):
+    """Loads columns of a PostgreSQL table, optionally filtered by a WHERE clause with pyformat params.
+    Returns an empty DataFrame if the table does not exist yet."""
+    try:
+        engine = get_postgres_engine()
+        if not inspect(engine).has_table(table_name):
+            return pd.DataFrame(columns=columns)
+
+        quoted_columns = ', '.join(f'"{column}"' for column in columns)
+        query = f'SELECT {quoted_columns} FROM "{table_name}"' + (f' WHERE {where}' if where else '')
+        df = pd.read_sql(query, engine, params=params)
+        logging.info(f"Successfully loaded {len(df)} rows of {table_name} from PostgreSQL")
+        return df
+    except Exception as e:
+        logging.error(f"Error loading {table_name} from PostgreSQL: {e}")
+        raise
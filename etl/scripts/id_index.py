@@ -0,0 +1,43 @@
+import numpy as np
+
+# Exact membership index of the integer ids already loaded into a fact table, kept as sorted disjoint
+# [start, end] ranges: fact ids are mostly consecutive, so millions of ids fit in a few ranges
+
+def empty_id_index():
+    """Returns an empty id index."""
+    return {'starts': np.empty(0, dtype='int64'), 'ends': np.empty(0, dtype='int64')}
+
+def id_index_from_array(ranges):
+    """Builds an id index from an (n, 2) array of [start, end] ranges, as persisted."""
+    ranges = np.asarray(ranges, dtype='int64').reshape(-1, 2)
+    return {'starts': ranges[:, 0].copy(), 'ends': ranges[:, 1].copy()}
+
+def id_index_to_array(id_index):
+    """Returns the (n, 2) array of [start, end] ranges of an id index, to persist it."""
+    return np.column_stack([id_index['starts'], id_index['ends']])
+
+def id_index_contains(id_index, ids):
+    """Returns a boolean mask of the ids present in the index, with one binary search per id."""
+    ids = np.asarray(ids, dtype='int64')
+    positions = np.searchsorted(id_index['starts'], ids, side='right') - 1
+    found = positions >= 0
+    found[found] = ids[found] <= id_index['ends'][positions[found]]
+    return found
+
+def add_to_id_index(id_index, ids):
+    """Adds ids to the index in place, merging overlapping and adjacent ranges, and returns it."""
+    ids = np.unique(np.asarray(ids, dtype='int64'))
+    if len(ids) == 0:
+        return id_index
+
+    starts = np.concatenate([id_index['starts'], ids])
+    ends = np.concatenate([id_index['ends'], ids])
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+
+    # A range starts a new group unless it overlaps or touches the ranges before it
+    reach = np.maximum.accumulate(ends)
+    group_starts = np.flatnonzero(np.r_[True, starts[1:] > reach[:-1] + 1])
+    id_index['starts'] = starts[group_starts]
+    id_index['ends'] = np.maximum.reduceat(ends, group_starts)
+    return id_index
@@ -1,6 +1,58 @@
+import io
+import os
+import glob
+import uuid
 import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pandas as pd
+from sqlalchemy import inspect
+from scripts.schemas import TABLE_SCHEMAS, STAGED_SCHEMAS, PARTITION_COLUMN, PARTITIONED_TABLES
 from utils.db_connection import get_postgres_engine
+from utils.instrumentation import instrumented
 
+# Columns identifying a row of each table, used to merge new loads into the existing data. The keys of the
+# fact tables include their partition key, as PostgreSQL requires for unique indexes of partitioned tables
+UPSERT_KEYS = {
+    'fact_withdrawals': ['id', 'event_timestamp'],
+    'fact_deposits': ['id', 'event_timestamp'],
+    'fact_events': ['id', 'event_timestamp'],
+    'dim_user': ['user_id', 'valid_from'],
+    'dim_currency': ['currency_name'],
+    'dim_interface': ['interface_name'],
+    'dim_time': ['date'],
+    'dim_event_type': ['event_type_name'],
+}
+
+COPY_BATCH_ROWS = 100000
+
+# Tables whose stored rows are updated by later loads (Dim_User versions closed by a level change), kept
+# in Parquet as a single file rewritten with the merged rows rather than appended to
+REWRITTEN_PARQUET_TABLES = ['dim_user']
+
+# Fact tables are range-partitioned by month of event_timestamp in PostgreSQL, one partition per month
+FACT_PARTITION_KEY = 'event_timestamp'
+
+# Secondary indexes of the fact tables, built after their first bulk load rather than maintained during it.
+# Partitions created later inherit them
+FACT_INDEXES = {
+    'fact_withdrawals': [['user_id'], ['time_id']],
+    'fact_deposits': [['user_id'], ['time_id']],
+    'fact_events': [['user_id'], ['event_type_id', 'event_timestamp'], ['time_id']],
+}
+
+# PostgreSQL column types of the Arrow types of TABLE_SCHEMAS
+POSTGRES_TYPES = {
+    pa.int32(): 'INTEGER',
+    pa.int64(): 'BIGINT',
+    pa.float64(): 'DOUBLE PRECISION',
+    pa.string(): 'TEXT',
+    pa.bool_(): 'BOOLEAN',
+    pa.timestamp('us'): 'TIMESTAMP',
+}
+
+@instrumented
 def save_to_csv(df, file_name):
     """Saves a DataFrame to a CSV file."""
     try:
@@ -10,12 +62,234 @@ def save_to_csv(df, file_name):
         logging.error(f"Error saving to {file_name}: {e}")
         raise RuntimeError(f"Error saving {file_name}: {e}")
 
-def save_to_postgres(df, table_name, if_exists='replace'):
-    """Saves a DataFrame to a PostgreSQL table."""
+@instrumented
+def save_to_parquet(df, table_name, output_path, compression='zstd', file_name=None):
+    """Appends a DataFrame to a Parquet table with its declared schema, partitioning fact tables by event date.
+
+    Files are named after file_name when given, so saving the same data again (e.g. re-running a
+    window of the Airflow DAG) replaces them instead of adding a copy. The tables of
+    REWRITTEN_PARQUET_TABLES are merged with their stored rows by key instead.
+    """
+    try:
+        if df.empty:
+            logging.info(f"No new rows to save to Parquet for {table_name}.")
+            return
+
+        schema = TABLE_SCHEMAS[table_name]
+        table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+        table_path = os.path.join(output_path, table_name)
+
+        if table_name in REWRITTEN_PARQUET_TABLES:
+            _rewrite_parquet_table(table, table_path, UPSERT_KEYS[table_name], compression)
+            logging.info(f"Successfully merged {table_name} into Parquet at {table_path}")
+            return
+
+        # Each run adds its own files, so the rows written by earlier increments are kept
+        file_name = file_name or f"part-{uuid.uuid4().hex}"
+        if table_name in PARTITIONED_TABLES:
+            table = table.append_column(PARTITION_COLUMN, pc.cast(table['event_timestamp'], pa.date32()))
+            # pyarrow refuses to write more than 1024 partitions at once by default, fewer days than a first load can span
+            partitions = max(1024, len(pc.unique(table[PARTITION_COLUMN])))
+            pq.write_to_dataset(
+                table, table_path, partition_cols=[PARTITION_COLUMN], compression=compression,
+                basename_template=f"{file_name}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore',
+                max_partitions=partitions
+            )
+        else:
+            os.makedirs(table_path, exist_ok=True)
+            pq.write_table(table, os.path.join(table_path, f"{file_name}.parquet"), compression=compression)
+
+        logging.info(f"Successfully saved {table_name} to Parquet at {table_path}")
+    except Exception as e:
+        logging.error(f"Error saving {table_name} to Parquet: {e}")
+        raise
+
+def _rewrite_parquet_table(table, table_path, key_columns, compression):
+    """Replaces the rows of a Parquet table that share their keys with the new rows, writing the merged
+    table to a temporary file that atomically replaces the table file."""
+    os.makedirs(table_path, exist_ok=True)
+    table_file = os.path.join(table_path, 'data.parquet')
+    # Files appended before the table was rewritten are merged once, then removed
+    stored_files = sorted(glob.glob(os.path.join(table_path, '*.parquet')))
+    if stored_files:
+        stored = pq.read_table(stored_files, schema=table.schema).to_pandas()
+        new_keys = pd.MultiIndex.from_frame(table.select(key_columns).to_pandas())
+        kept = stored[~pd.MultiIndex.from_frame(stored[key_columns]).isin(new_keys)]
+        table = pa.concat_tables([pa.Table.from_pandas(kept, schema=table.schema, preserve_index=False), table])
+
+    # Files starting with a dot are skipped by Parquet readers while being written
+    temp_file = os.path.join(table_path, f".data-{uuid.uuid4().hex}.parquet")
+    pq.write_table(table, temp_file, compression=compression)
+    os.replace(temp_file, table_file)
+    for stored_file in stored_files:
+        if stored_file != table_file:
+            os.remove(stored_file)
+
+@instrumented
+def save_to_staging(df, source, staging_path, compression='zstd'):
+    """Appends raw rows of a fact source to its staged Parquet dataset under staging_path, partitioned by event date."""
+    try:
+        if df.empty:
+            return
+
+        # Categorical columns are staged as strings, so every file has the same schema
+        schema = STAGED_SCHEMAS[source]
+        df = df[schema.names].astype({column: object for column in schema.names if isinstance(df[column].dtype, pd.CategoricalDtype)})
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        table = table.append_column(PARTITION_COLUMN, pc.cast(table['event_timestamp'], pa.date32()))
+        pq.write_to_dataset(
+            table, os.path.join(staging_path, source), partition_cols=[PARTITION_COLUMN], compression=compression,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore',
+            max_partitions=max(1024, len(pc.unique(table[PARTITION_COLUMN])))
+        )
+    except Exception as e:
+        logging.error(f"Error staging rows of {source}: {e}")
+        raise
+
+def save_chunks_to_parquet(chunks, table_name, output_path, compression='zstd'):
+    """Saves each chunk of a stream as Parquet, yielding the chunks on to the next stage."""
+    for chunk in chunks:
+        save_to_parquet(chunk, table_name, output_path, compression)
+        yield chunk
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def _ensure_upsert_table(engine, df, table_name, key_columns):
+    """Creates the target table from the DataFrame schema if needed, with a unique index on its keys."""
+    if not inspect(engine).has_table(table_name):
+        df.head(0).to_sql(table_name, engine, index=False)
+
+    index_name = _quote(f"{table_name}_{'_'.join(key_columns)}_key")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {_quote(table_name)} ({', '.join(map(_quote, key_columns))})"
+        )
+
+def _month_starts(timestamps):
+    """Returns the first day of each month of a Series of timestamps."""
+    return sorted(month.to_timestamp() for month in timestamps.dropna().dt.to_period('M').unique())
+
+def _partition_name(table_name, month_start):
+    return f"{table_name}_p{month_start:%Y%m}"
+
+def _ensure_fact_table(engine, df, table_name, key_columns):
+    """Creates a fact table partitioned by month of event_timestamp if needed, with the partitions of the
+    months of the DataFrame. Returns False for a table created unpartitioned by an earlier version."""
+    with engine.begin() as connection:
+        columns = ', '.join(f"{_quote(field.name)} {POSTGRES_TYPES[field.type]}" for field in TABLE_SCHEMAS[table_name])
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {_quote(table_name)} ({columns}, PRIMARY KEY ({', '.join(map(_quote, key_columns))})) "
+            f"PARTITION BY RANGE ({_quote(FACT_PARTITION_KEY)})"
+        )
+        kind = connection.exec_driver_sql("SELECT relkind FROM pg_class WHERE oid = to_regclass(%(table)s)", {'table': _quote(table_name)}).scalar()
+        if kind != 'p':
+            return False
+        if df.empty:
+            return True
+
+        for month_start in _month_starts(df[FACT_PARTITION_KEY]):
+            month_end = month_start + pd.offsets.MonthBegin(1)
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {_quote(_partition_name(table_name, month_start))} PARTITION OF {_quote(table_name)} "
+                f"FOR VALUES FROM ('{month_start:%Y-%m-%d}') TO ('{month_end:%Y-%m-%d}')"
+            )
+    return True
+
+def _copy_to_staging(cursor, df, staging_table, columns):
+    """Streams a DataFrame into a staging table with COPY FROM STDIN, one batch of rows at a time."""
+    copy_sql = f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    for start in range(0, len(df), COPY_BATCH_ROWS):
+        buffer = io.StringIO()
+        df.iloc[start:start + COPY_BATCH_ROWS].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+
+@instrumented
+def upsert_to_postgres(df, table_name, key_columns=None):
+    """Bulk loads a DataFrame into a staging table with COPY and merges it into a PostgreSQL table."""
     try:
-        engine = get_postgres_engine()  # No need to pass config path if using default
-        df.to_sql(table_name, engine, index=False, if_exists=if_exists)
-        logging.info(f"Successfully saved {table_name} to PostgreSQL.")
+        key_columns = key_columns or UPSERT_KEYS[table_name]
+        engine = get_postgres_engine()
+        if table_name not in FACT_INDEXES or not _ensure_fact_table(engine, df, table_name, key_columns):
+            _ensure_upsert_table(engine, df, table_name, key_columns)
+        if df.empty:
+            logging.info(f"No new rows to merge into {table_name}.")
+            return 0
+
+        columns = [_quote(column) for column in df.columns]
+        keys = [_quote(column) for column in key_columns]
+        staging_table = _quote(f"staging_{table_name}")
+        updates = [f"{column} = EXCLUDED.{column}" for column in columns if column not in keys]
+        on_conflict = f"DO UPDATE SET {', '.join(updates)}" if updates else "DO NOTHING"
+
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {_quote(table_name)} INCLUDING DEFAULTS) ON COMMIT DROP")
+                _copy_to_staging(cursor, df, staging_table, columns)
+
+                # DISTINCT ON keeps a single row per key, as ON CONFLICT cannot update a row twice
+                cursor.execute(
+                    f"INSERT INTO {_quote(table_name)} ({', '.join(columns)}) "
+                    f"SELECT DISTINCT ON ({', '.join(keys)}) {', '.join(columns)} FROM {staging_table} "
+                    f"ON CONFLICT ({', '.join(keys)}) {on_conflict}"
+                )
+                merged_rows = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        logging.info(f"Successfully merged {merged_rows} of {len(df)} rows into {table_name} in PostgreSQL.")
+        return merged_rows
+    except Exception as e:
+        logging.error(f"Error merging {table_name} into PostgreSQL: {e}")
+        raise
+
+def save_chunks_to_postgres(chunks, table_name):
+    """Merges a stream of DataFrame chunks into a PostgreSQL table, returning the number of rows written."""
+    try:
+        total_rows = 0
+        for chunk in chunks:
+            upsert_to_postgres(chunk, table_name)
+            total_rows += len(chunk)
+        logging.info(f"Successfully saved {total_rows} rows of {table_name} to PostgreSQL.")
+        return total_rows
     except Exception as e:
         logging.error(f"Error saving {table_name} to PostgreSQL: {e}")
         raise
+
+@instrumented
+def index_fact_tables(scopes):
+    """Builds the indexes of the fact tables once they are loaded, and analyzes the partitions the load touched.
+
+    scopes maps each fact table to its rollup scope; the months of its time_id keys are the touched partitions.
+    """
+    try:
+        engine = get_postgres_engine()
+        existing_tables = set(inspect(engine).get_table_names())
+        for table_name, indexes in FACT_INDEXES.items():
+            months = sorted({time_id // 100 for time_id in scopes.get(table_name, {}).get('time_id', ())})
+            if not months or table_name not in existing_tables:
+                logging.info(f"No rows loaded into {table_name} to index.")
+                continue
+
+            # CREATE INDEX on the partitioned table builds the index of every partition, and is a no-op once it exists
+            with engine.begin() as connection:
+                for columns in indexes:
+                    index_name = _quote(f"{table_name}_{'_'.join(columns)}_idx")
+                    connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {index_name} ON {_quote(table_name)} ({', '.join(map(_quote, columns))})")
+
+            # Refresh the planner statistics of the touched months only (the whole table if unpartitioned)
+            partitions = [f"{table_name}_p{month}" for month in months]
+            partitions = [partition for partition in partitions if partition in existing_tables] or [table_name]
+            with engine.begin() as connection:
+                for partition in partitions:
+                    connection.exec_driver_sql(f"ANALYZE {_quote(partition)}")
+            logging.info(f"Successfully indexed {table_name} and analyzed {len(partitions)} of its partitions.")
+    except Exception as e:
+        logging.error(f"Error indexing fact tables: {e}")
+        raise
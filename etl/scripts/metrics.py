@@ -0,0 +1,183 @@
+import sys
+import os
+
+# Add the project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import re
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import requests
+from utils.db_connection import get_postgres_engine
+
+# Dashboard queries shared with Metabase and the benchmarks, the single source of the metrics SQL
+DASHBOARD_QUERIES_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'visualization', 'queries.sql'))
+
+# Dashboard metrics served by the metrics API, each with the column its date range filters on and
+# whether that column is a Dim_Time key or a timestamp (None for the metrics over all users)
+METRICS = {
+    'active_users_per_day': ('r.time_id', 'time_id'),
+    'users_without_deposit': (None, None),
+    'users_with_more_than_5_deposits': (None, None),
+    'last_login_per_user': ('last_login', 'timestamp'),
+    'logins_between_dates': ('time_id', 'time_id'),
+    'unique_currencies_deposited_per_day': ('r.time_id', 'time_id'),
+    'unique_currencies_withdrew_per_day': ('r.time_id', 'time_id'),
+    'total_amount_deposited_per_currency_per_day': ('r.time_id', 'time_id'),
+}
+
+# Clauses following the WHERE clause of a dashboard query
+_CLAUSE_AFTER_WHERE = re.compile(r'\b(?:GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT)\b|$', re.IGNORECASE)
+
+_dashboard_queries = {}
+
+def read_dashboard_queries(file_path=DASHBOARD_QUERIES_FILE):
+    """Returns the dashboard queries of queries.sql keyed by the name of their -- name.sql comment."""
+    with open(file_path) as file:
+        statements = [statement.strip() for statement in file.read().split(';') if statement.strip()]
+
+    queries = {}
+    for index, statement in enumerate(statements):
+        match = re.match(r'--\s*(\S+)\.sql', statement)
+        queries[match.group(1) if match else f'query_{index + 1}'] = statement
+    return queries
+
+def dashboard_query(metric):
+    """Returns the SQL of a metric from queries.sql, read once per process."""
+    if not _dashboard_queries:
+        _dashboard_queries.update(read_dashboard_queries())
+    if metric not in _dashboard_queries:
+        raise KeyError(f"Metric {metric} is not in {DASHBOARD_QUERIES_FILE}")
+    return _dashboard_queries[metric]
+
+def _with_condition(query_sql, condition):
+    """Returns a query with a condition added to its WHERE clause, or a WHERE clause added before its GROUP BY/ORDER BY."""
+    query_sql = re.sub(r'^\s*--.*$', '', query_sql, flags=re.MULTILINE).strip()
+    where = re.search(r'\bWHERE\b', query_sql, re.IGNORECASE)
+    clause_end = _CLAUSE_AFTER_WHERE.search(query_sql, where.end() if where else 0).start()
+    head, tail = query_sql[:clause_end].rstrip(), query_sql[clause_end:]
+    if where:
+        # The existing condition is kept in parentheses, so an OR in it cannot widen the range
+        head = f"{head[:where.start()]}WHERE ({head[where.end():].strip()}) AND {condition}"
+    else:
+        head = f"{head}\nWHERE {condition}"
+    return f"{head}\n{tail}".rstrip()
+
+def parse_date_range(metric, start=None, end=None):
+    """Validates the optional [start, end] dates (inclusive, YYYY-MM-DD) of a metric and returns them as ISO strings.
+
+    Raises KeyError for an unknown metric and ValueError for invalid dates or a range on a metric over all users.
+    """
+    range_column = METRICS[metric][0]
+    if start is None and end is None:
+        return None, None
+    if range_column is None:
+        raise ValueError(f"Metric {metric} does not take a date range")
+    start_date = date.fromisoformat(start) if start else None
+    end_date = date.fromisoformat(end) if end else None
+    if start_date and end_date and start_date > end_date:
+        raise ValueError(f"Start date {start} is after end date {end}")
+    return start_date and start_date.isoformat(), end_date and end_date.isoformat()
+
+def _range_bound(value, kind):
+    """Returns a date as the bound of a time_id or timestamp range condition."""
+    if kind == 'time_id':
+        return int(value.strftime('%Y%m%d'))
+    return datetime(value.year, value.month, value.day)
+
+def metric_query(metric, start=None, end=None):
+    """Returns the SQL and parameters of a metric over the [start, end] dates returned by parse_date_range."""
+    query_sql = dashboard_query(metric)
+    range_column, kind = METRICS[metric]
+    conditions, params = [], {}
+    if start:
+        conditions.append(f"{range_column} >= %(start)s")
+        params['start'] = _range_bound(date.fromisoformat(start), kind)
+    if end:
+        # The end date is included, so the range stops before the next day
+        conditions.append(f"{range_column} < %(end)s")
+        params['end'] = _range_bound(date.fromisoformat(end) + timedelta(days=1), kind)
+    if not conditions:
+        return query_sql, params
+    return _with_condition(query_sql, ' AND '.join(conditions)), params
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__} to JSON")
+
+def query_metric(metric, start=None, end=None, watermark=None):
+    """Runs a metric over a read-only pooled connection and returns it as an encoded JSON document."""
+    try:
+        query_sql, params = metric_query(metric, start, end)
+        with get_postgres_engine().connect() as connection:
+            connection = connection.execution_options(postgresql_readonly=True)
+            rows = [dict(row) for row in connection.exec_driver_sql(query_sql, params).mappings()]
+        document = {'metric': metric, 'start': start, 'end': end, 'watermark': watermark, 'rows': rows}
+        return json.dumps(document, default=_json_value).encode()
+    except Exception as e:
+        logging.error(f"Error querying metric {metric}: {e}")
+        raise
+
+class MetricsCache:
+    """LRU cache of encoded metric results keyed by (metric, params, watermark), evicting the least
+    recently used results once their total size exceeds max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        # A result larger than the whole cache is served but not kept
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def drop_stale(self, watermark):
+        """Drops the results computed at another watermark, which can no longer be requested."""
+        with self._lock:
+            for key in [key for key in self._entries if key[-1] != watermark]:
+                self.size -= len(self._entries.pop(key))
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+def prewarm_metrics_cache(url, timeout=300):
+    """Asks the metrics API at url to recompute the metrics at the new watermark, logging rather than
+    failing the run when the API is not running."""
+    if not url:
+        return
+    try:
+        response = requests.post(f"{url.rstrip('/')}/warm", timeout=timeout)
+        response.raise_for_status()
+        logging.info(f"Metrics API cache warmed: {response.json()}")
+    except Exception as e:
+        logging.warning(f"Could not warm the metrics API cache at {url}: {e}")
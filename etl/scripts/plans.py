@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pandas as pd
+from scripts.extract import load_staged_window
+from scripts.schemas import RAW_DTYPES, PARTITION_COLUMN
+from scripts.timestamps import parse_timestamps, to_naive_utc
+from utils.instrumentation import record_step
+
+try:
+    import polars as pl
+except ImportError:  # Only needed by the polars engine
+    pl = None
+
+# Engines able to run a transformation plan over a staged window, chosen with set_transform_engine
+# (transform.engine in config.yml): pandas loads the window and narrows a row mask, polars scans it lazily
+ENGINES = ['pandas', 'polars']
+_engine = 'pandas'
+
+def set_transform_engine(engine):
+    """Selects the engine running the transformation plans over the staged windows of the current process."""
+    global _engine
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown transform engine {engine}, expected one of {', '.join(ENGINES)}")
+    if engine == 'polars' and pl is None:
+        raise ImportError("The polars transform engine requires the polars package (pip install polars).")
+    _engine = engine
+
+def staged_window(source, staging_path, start, end):
+    """Returns the input of a plan over the staged rows of a fact source in [start, end): the loaded rows
+    with the pandas engine, or the window itself, scanned once the plan is run, with the polars engine."""
+    if _engine == 'polars':
+        return {'source': source, 'staging_path': staging_path, 'start': start, 'end': end}
+    return load_staged_window(source, staging_path, start, end)
+
+def _step_columns(step):
+    """Returns the input columns a plan step reads."""
+    op, args = step[1], step[2:]
+    if op in ('not_null', 'unique'):
+        return list(args[0])
+    if op == 'at_most_quantile':
+        return [args[0], args[1]]
+    return [args[0]]
+
+def _flags(values):
+    return values.to_numpy(dtype=bool, na_value=False)
+
+def _plan_mask(df, steps, cutoffs):
+    """Runs the plan steps, narrowing a single row mask instead of copying the frame at each step."""
+    mask = np.ones(len(df), dtype=bool)
+    for step, op, *args in steps:
+        rows = int(mask.sum())
+        if op == 'not_null':
+            mask &= _flags(df[list(args[0])].notna().all(axis=1))
+        elif op == 'greater':
+            mask &= _flags(df[args[0]] > args[1])
+        elif op == 'at_most':
+            mask &= _flags(df[args[0]] <= args[1])
+        elif op == 'equals':
+            mask &= _flags(df[args[0]] == args[1])
+        elif op == 'unique':
+            # Keep the first of the rows kept so far with the same values
+            positions = np.flatnonzero(mask)
+            mask[positions[_flags(df.iloc[positions][list(args[0])].duplicated(keep='first'))]] = False
+        elif op == 'at_most_quantile':
+            column, group_column, quantile = args
+            if cutoffs is None:
+                limit = df[column][mask].quantile(quantile)
+            else:
+                limit = df[group_column].astype(object).map(cutoffs).astype('float64').fillna(float('inf'))
+            mask &= _flags(df[column] <= limit)
+        else:
+            raise ValueError(f"Unknown plan step {op}")
+        record_step(step, rows, int(mask.sum()))
+    return mask
+
+def _polars_step(frame, op, args, cutoffs):
+    """Adds a plan step to a lazy Polars query."""
+    if op == 'unique':
+        return frame.unique(subset=list(args[0]), keep='first', maintain_order=True)
+    if op == 'not_null':
+        condition = pl.all_horizontal([pl.col(column).is_not_null() for column in args[0]])
+    elif op == 'greater':
+        condition = pl.col(args[0]) > args[1]
+    elif op == 'at_most':
+        condition = pl.col(args[0]) <= args[1]
+    elif op == 'equals':
+        condition = pl.col(args[0]) == args[1]
+    elif op == 'at_most_quantile':
+        column, group_column, quantile = args
+        if cutoffs is None:
+            condition = pl.col(column) <= pl.col(column).quantile(quantile, interpolation='linear')
+        else:
+            limit = pl.col(group_column).replace_strict(list(cutoffs), list(cutoffs.values()), default=float('inf'), return_dtype=pl.Float64)
+            condition = pl.col(column) <= limit.fill_null(float('inf'))
+    else:
+        raise ValueError(f"Unknown plan step {op}")
+    return frame.filter(condition)
+
+def _scan_plan(window, plan, cutoffs):
+    """Runs a plan as one lazy Polars query over the staged Parquet files of a window.
+
+    Only the event date partitions of the window are read, and only the columns the plan reads are
+    decoded from them. The query runs on the streaming engine, so the raw rows of the window are filtered
+    as they are read instead of being loaded first. The row counts of the steps are collected with the result.
+    """
+    source = window['source']
+    table_path = os.path.join(window['staging_path'], source)
+    if not os.path.isdir(table_path):
+        return run_plan(load_staged_window(source, window['staging_path'], window['start'], window['end']), plan, cutoffs)
+
+    start, end = to_naive_utc(window['start']), to_naive_utc(window['end'])
+    frame = pl.scan_parquet(os.path.join(table_path, '**', '*.parquet'), hive_partitioning=True, hive_schema={PARTITION_COLUMN: pl.Date})
+    frame = frame.filter(
+        (pl.col(PARTITION_COLUMN) >= start.date()) & (pl.col(PARTITION_COLUMN) <= end.date())
+        & (pl.col('event_timestamp') >= start.to_pydatetime()) & (pl.col('event_timestamp') < end.to_pydatetime())
+    ).with_columns([pl.col(column).cast(pl.Float64, strict=False) for column in plan.get('numeric', [])])
+
+    counts = [frame.select(pl.len())]
+    for _, op, *args in plan['steps']:
+        frame = _polars_step(frame, op, args, cutoffs)
+        counts.append(frame.select(pl.len()))
+    *step_rows, kept = pl.collect_all(counts + [frame.select(plan['columns'])], engine='streaming')
+
+    for (step, *_), rows, step_count in zip(plan['steps'], step_rows, step_rows[1:]):
+        record_step(step, rows.item(), step_count.item())
+    dtypes = RAW_DTYPES[source]
+    return kept.to_pandas().astype({column: dtypes[column] for column in plan['columns'] if column in dtypes})
+
+def run_plan(df, plan, cutoffs=None):
+    """Runs a transformation plan on a raw DataFrame, or on a staged window from staged_window, and returns
+    the kept rows with the plan's output columns, leaving the caller's frame unchanged.
+
+    A plan is a dict with the ordered 'steps' to keep rows by, each a (name, op, *args) tuple, the
+    'timestamps' and 'numeric' columns converted first and the output 'columns'. Ops are not_null (columns),
+    greater/at_most/equals (column, value), unique (columns, keeping the first row) and
+    at_most_quantile (column, group column, quantile), which cuts at cutoffs[group] when cutoffs is
+    given and at the quantile of the kept rows otherwise. On a DataFrame the steps narrow a single row
+    mask, and the output rows are only taken from df once at the end.
+    """
+    if cutoffs is not None:
+        cutoffs = {group: float(cutoff) for group, cutoff in cutoffs.items() if not pd.isna(cutoff)}
+    if isinstance(df, dict):
+        return _scan_plan(df, plan, cutoffs)
+
+    input_columns = list(dict.fromkeys(plan['columns'] + [column for step in plan['steps'] for column in _step_columns(step)]))
+    converted = {column: parse_timestamps(df[column]) for column in plan.get('timestamps', [])}
+    converted.update({column: pd.to_numeric(df[column], errors='coerce') for column in plan.get('numeric', [])})
+    df = df[input_columns].assign(**converted)
+
+    mask = _plan_mask(df, plan['steps'], cutoffs)
+    return df.loc[mask, plan['columns']]
@@ -0,0 +1,174 @@
+import time
+import logging
+import pandas as pd
+from scripts.timestamps import parse_timestamps
+from scripts.transform import DIMENSION_KEY_COLUMNS
+from utils.instrumentation import instrumented
+
+# Declarative data-quality rules of the processed fact tables. Row-level rules (not_null, unique,
+# ranges, references) are compiled into vectorized masks evaluated in a single pass over the table,
+# references name the columns checked against the reference keys given at validation time. A 'today' date
+# bound is the end of the current UTC day when the check runs, so the rules follow the dates of the data
+QUALITY_RULES = {
+    'fact_withdrawals': {
+        'columns': ['id', 'event_timestamp', 'time_id', 'user_id', 'amount', 'interface_id', 'currency_id', 'tx_status'],
+        'dtypes': {'id': 'int64', 'amount': 'float64'},
+        'not_null': ['user_id', 'event_timestamp', 'amount'],
+        'unique': ['id'],
+        'ranges': {'amount': (0, 1e9), 'event_timestamp': ('2020-01-01', 'today')},
+        'references': ['user_id', 'interface_id', 'currency_id'],
+    },
+    'fact_deposits': {
+        'columns': ['id', 'event_timestamp', 'time_id', 'user_id', 'amount', 'currency_id', 'tx_status'],
+        'dtypes': {'id': 'int64', 'amount': 'float64'},
+        'not_null': ['user_id', 'event_timestamp', 'amount'],
+        'unique': ['id'],
+        'ranges': {'amount': (0, 1e9), 'event_timestamp': ('2020-01-01', 'today')},
+        'references': ['user_id', 'currency_id'],
+    },
+    'fact_events': {
+        'columns': ['id', 'event_timestamp', 'time_id', 'user_id', 'event_type_id'],
+        'dtypes': {'id': 'int64'},
+        'not_null': ['user_id', 'event_timestamp', 'event_type_id'],
+        'unique': ['id'],
+        'ranges': {'event_timestamp': ('2020-01-01', 'today')},
+        'references': ['user_id', 'event_type_id'],
+    },
+}
+
+def _datetime_column(df, column, parsed):
+    """Returns a column as datetimes, parsing it at most once per validation if it is not typed yet."""
+    if column not in parsed:
+        parsed[column] = parse_timestamps(df[column])
+    return parsed[column]
+
+def _date_bound(bound):
+    """Returns a date bound as a naive UTC timestamp, 'today' being the end of the current UTC day."""
+    if bound == 'today':
+        return pd.Timestamp.now(tz='UTC').tz_localize(None).normalize() + pd.Timedelta(days=1)
+    return pd.Timestamp(bound)
+
+def _range_check(column, low, high):
+    """Returns a check of the rows whose column falls outside [low, high], with string bounds read as dates."""
+    is_date_range = isinstance(low, str) or isinstance(high, str)
+
+    def check(df, references, parsed):
+        if is_date_range:
+            values, low_bound, high_bound = _datetime_column(df, column, parsed), _date_bound(low), _date_bound(high)
+        else:
+            values, low_bound, high_bound = df[column], low, high
+        return ((values < low_bound) | (values > high_bound)).to_numpy(dtype=bool)
+    return check
+
+def _reference_check(column):
+    """Returns a check of the rows whose column is not among the reference keys, if any are given."""
+    def check(df, references, parsed):
+        if column not in references:
+            return None
+        return (~df[column].isin(references[column])).to_numpy(dtype=bool)
+    return check
+
+def compile_rules(table_rules):
+    """Compiles the rules of a table into (name, check) pairs.
+
+    Table-level checks return whether the table passes, row-level checks return a boolean mask of the failing rows
+    (or None when they do not apply, e.g. a reference check without reference keys).
+    """
+    checks = []
+    if 'columns' in table_rules:
+        expected_columns = list(table_rules['columns'])
+        checks.append(('schema', lambda df, references, parsed: list(df.columns) == expected_columns))
+    for column, expected_type in table_rules.get('dtypes', {}).items():
+        checks.append((f'dtype:{column}', lambda df, references, parsed, column=column, expected_type=expected_type: str(df[column].dtype) == expected_type))
+    for column in table_rules.get('not_null', []):
+        checks.append((f'not_null:{column}', lambda df, references, parsed, column=column: df[column].isna().to_numpy()))
+    for column in table_rules.get('unique', []):
+        checks.append((f'unique:{column}', lambda df, references, parsed, column=column: df.duplicated(subset=[column]).to_numpy()))
+    for column, (low, high) in table_rules.get('ranges', {}).items():
+        checks.append((f'range:{column}', _range_check(column, low, high)))
+    for column in table_rules.get('references', []):
+        checks.append((f'reference:{column}', _reference_check(column)))
+    return checks
+
+_compiled_rules = {table_name: compile_rules(table_rules) for table_name, table_rules in QUALITY_RULES.items()}
+
+@instrumented
+def validate_table(df, table_name, references=None, sample_size=5):
+    """Runs the compiled rules of a table in one pass and returns a structured report.
+
+    The report holds, per rule, whether it passed, the number of failing rows, a sample of their ids
+    (or row positions) and the time it took.
+    """
+    started = time.perf_counter()
+    references = references or {}
+    parsed = {}
+    row_ids = df['id'].to_numpy() if 'id' in df.columns else None
+    failing_rows = None
+    rule_reports = []
+
+    for rule_name, check in _compiled_rules[table_name]:
+        rule_started = time.perf_counter()
+        try:
+            result = check(df, references, parsed)
+        except KeyError as e:
+            # A column the rule needs is missing, which the schema rule reports
+            rule_reports.append({'rule': rule_name, 'passed': False, 'error': f"missing column {e}",
+                                 'elapsed_seconds': time.perf_counter() - rule_started})
+            continue
+        if result is None:
+            continue
+
+        rule_report = {'rule': rule_name}
+        if isinstance(result, bool):
+            rule_report['passed'] = result
+        else:
+            failing = result.nonzero()[0]
+            rule_report.update(passed=len(failing) == 0, failed_rows=int(len(failing)),
+                               sample=(row_ids[failing[:sample_size]] if row_ids is not None else failing[:sample_size]).tolist())
+            failing_rows = result if failing_rows is None else failing_rows | result
+        rule_report['elapsed_seconds'] = time.perf_counter() - rule_started
+        rule_reports.append(rule_report)
+
+    return {
+        'table': table_name,
+        'rows': len(df),
+        'passed': all(rule_report['passed'] for rule_report in rule_reports),
+        'failed_rows': int(failing_rows.sum()) if failing_rows is not None else 0,
+        'elapsed_seconds': time.perf_counter() - started,
+        'rules': rule_reports,
+    }
+
+def log_quality_report(report):
+    """Logs a data-quality report, with a warning for every failing rule."""
+    for rule_report in report['rules']:
+        if not rule_report['passed']:
+            details = rule_report.get('error') or f"{rule_report.get('failed_rows', 'table')} failing rows, e.g. {rule_report.get('sample', [])}"
+            logging.warning(f"Data-quality rule {rule_report['rule']} failed on {report['table']}: {details}")
+    logging.info(f"Data-quality checks of {report['table']} {'passed' if report['passed'] else 'FAILED'} on "
+                 f"{report['rows']} rows in {report['elapsed_seconds']:.3f}s ({report['failed_rows']} failing rows).")
+
+def dimension_references(dimension_keys):
+    """Returns the reference keys of the fact key columns from the dimension key maps."""
+    return {key_column: list(dimension_keys.get(dimension, {}).values()) for dimension, key_column in DIMENSION_KEY_COLUMNS.values()}
+
+def check_quality(df, dimension_keys, table_name, reports=None, fail_on_error=False, sample_size=5):
+    """Validates a fact table (or chunk) before it is loaded and returns it unchanged.
+
+    The report is logged and appended to reports, and a failing table raises a ValueError if fail_on_error is set.
+    """
+    if df.empty:
+        return df
+
+    references = dimension_references(dimension_keys) if dimension_keys is not None else None
+    report = validate_table(df, table_name, references, sample_size)
+    log_quality_report(report)
+    if reports is not None:
+        reports.append(report)
+    if fail_on_error and not report['passed']:
+        raise ValueError(f"Data-quality checks failed on {table_name}")
+    return df
+
+def check_chunks_quality(chunks, dimension_keys, table_name, reports=None, fail_on_error=False, sample_size=5):
+    """Validates each chunk of a stream before it is loaded, yielding the chunks on to the next stage."""
+    for chunk in chunks:
+        yield check_quality(chunk, dimension_keys, table_name, reports, fail_on_error, sample_size)
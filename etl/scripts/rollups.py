@@ -0,0 +1,90 @@
+import logging
+from sqlalchemy import inspect
+from utils.db_connection import get_postgres_engine
+from utils.instrumentation import instrumented
+
+# Pre-aggregated tables read by the Metabase cards: rollup -> (source fact, scope column, columns DDL, SELECT).
+# Each SELECT recomputes the rollup rows of the scope keys in %(keys)s, so a refresh only touches the
+# days or users present in the delta and re-running it for the same keys gives the same rows. Facts without a
+# currency (missing in the raw data) are left out of the per-currency rollups, which are keyed by currency_id
+ROLLUPS = {
+    'rollup_daily_active_users': (
+        'fact_events', 'time_id',
+        'time_id BIGINT PRIMARY KEY, active_users BIGINT NOT NULL',
+        'SELECT time_id, COUNT(DISTINCT user_id) FROM fact_events '
+        'WHERE time_id = ANY(%(keys)s) GROUP BY time_id',
+    ),
+    'rollup_daily_deposits': (
+        'fact_deposits', 'time_id',
+        'time_id BIGINT, currency_id BIGINT, total_amount DOUBLE PRECISION NOT NULL, '
+        'deposit_count BIGINT NOT NULL, depositors BIGINT NOT NULL, PRIMARY KEY (time_id, currency_id)',
+        'SELECT time_id, currency_id, SUM(amount), COUNT(id), COUNT(DISTINCT user_id) FROM fact_deposits '
+        'WHERE time_id = ANY(%(keys)s) AND currency_id IS NOT NULL GROUP BY time_id, currency_id',
+    ),
+    'rollup_daily_withdrawals': (
+        'fact_withdrawals', 'time_id',
+        'time_id BIGINT, currency_id BIGINT, total_amount DOUBLE PRECISION NOT NULL, '
+        'withdrawal_count BIGINT NOT NULL, withdrawers BIGINT NOT NULL, PRIMARY KEY (time_id, currency_id)',
+        'SELECT time_id, currency_id, SUM(amount), COUNT(id), COUNT(DISTINCT user_id) FROM fact_withdrawals '
+        'WHERE time_id = ANY(%(keys)s) AND currency_id IS NOT NULL GROUP BY time_id, currency_id',
+    ),
+    'rollup_daily_user_logins': (
+        'fact_events', 'time_id',
+        'time_id BIGINT, user_id TEXT, login_count BIGINT NOT NULL, PRIMARY KEY (time_id, user_id)',
+        "SELECT e.time_id, e.user_id, COUNT(e.id) FROM fact_events e "
+        "JOIN dim_event_type et ON et.event_type_id = e.event_type_id "
+        "WHERE et.event_type_name = 'login' AND e.time_id = ANY(%(keys)s) GROUP BY e.time_id, e.user_id",
+    ),
+    'rollup_user_deposits': (
+        'fact_deposits', 'user_id',
+        'user_id TEXT PRIMARY KEY, deposit_count BIGINT NOT NULL, last_deposit TIMESTAMP',
+        'SELECT user_id, COUNT(id), MAX(event_timestamp) FROM fact_deposits '
+        'WHERE user_id = ANY(%(keys)s) GROUP BY user_id',
+    ),
+    'rollup_user_logins': (
+        'fact_events', 'user_id',
+        'user_id TEXT PRIMARY KEY, login_count BIGINT NOT NULL, last_login TIMESTAMP',
+        "SELECT e.user_id, COUNT(e.id), MAX(e.event_timestamp) FROM fact_events e "
+        "JOIN dim_event_type et ON et.event_type_id = e.event_type_id "
+        "WHERE et.event_type_name = 'login' AND e.user_id = ANY(%(keys)s) GROUP BY e.user_id",
+    ),
+}
+
+ROLLUP_SCOPE_COLUMNS = ['time_id', 'user_id']
+
+def rollup_scope(df, scope=None):
+    """Adds the days and users of a fact DataFrame to a rollup scope ({scope column: set of keys}) and returns it."""
+    scope = scope if scope is not None else {column: set() for column in ROLLUP_SCOPE_COLUMNS}
+    for column in ROLLUP_SCOPE_COLUMNS:
+        if column in df.columns:
+            scope[column].update(df[column].dropna().astype(object).unique().tolist())
+    return scope
+
+def _ensure_rollup_table(connection, rollup_name, columns_ddl):
+    """Creates a rollup table if needed. The scope columns of the fact tables are indexed by the loader."""
+    connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS "{rollup_name}" ({columns_ddl})')
+
+@instrumented
+def refresh_rollups(scopes):
+    """Recomputes the rollup rows of the days and users touched by the delta from the loaded fact tables.
+
+    scopes maps each fact table to its rollup scope, as built by rollup_scope.
+    """
+    try:
+        engine = get_postgres_engine()
+        existing_tables = set(inspect(engine).get_table_names())
+        for rollup_name, (fact_table, scope_column, columns_ddl, select_sql) in ROLLUPS.items():
+            keys = sorted(scopes.get(fact_table, {}).get(scope_column, ()))
+            if not keys or fact_table not in existing_tables:
+                logging.info(f"No rows of {fact_table} to refresh {rollup_name} with.")
+                continue
+
+            # Replace the rows of the touched keys in a single transaction, so readers never see them missing
+            with engine.begin() as connection:
+                _ensure_rollup_table(connection, rollup_name, columns_ddl)
+                connection.exec_driver_sql(f'DELETE FROM "{rollup_name}" WHERE {scope_column} = ANY(%(keys)s)', {'keys': keys})
+                inserted = connection.exec_driver_sql(f'INSERT INTO "{rollup_name}" {select_sql}', {'keys': keys}).rowcount
+            logging.info(f"Successfully refreshed {inserted} rows of {rollup_name} for {len(keys)} {scope_column} values.")
+    except Exception as e:
+        logging.error(f"Error refreshing rollup tables: {e}")
+        raise
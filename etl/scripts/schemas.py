@@ -0,0 +1,126 @@
+import pyarrow as pa
+
+# pandas dtypes applied when reading each raw source. Low-cardinality columns and the user_id
+# of the fact sources (repeated across rows) become categoricals, unique user_ids use Arrow strings
+RAW_DTYPES = {
+    'withdrawals': {
+        'id': 'int64',
+        'user_id': 'category',
+        'amount': 'float64',
+        'interface': 'category',
+        'currency': 'category',
+        'tx_status': 'category',
+    },
+    'deposits': {
+        'id': 'int64',
+        'user_id': 'category',
+        'amount': 'float64',
+        'currency': 'category',
+        'tx_status': 'category',
+    },
+    'events': {
+        'id': 'int64',
+        'user_id': 'category',
+        'event_name': 'category',
+    },
+    'user_id': {
+        'user_id': 'string[pyarrow]',
+    },
+    'user_level': {
+        'user_id': 'string[pyarrow]',
+        'jurisdiction': 'category',
+        'level': 'Int16',
+    },
+}
+
+# Arrow schemas of the processed fact and dimension tables persisted as Parquet
+TABLE_SCHEMAS = {
+    'fact_withdrawals': pa.schema([
+        ('id', pa.int64()),
+        ('event_timestamp', pa.timestamp('us')),
+        ('time_id', pa.int64()),
+        ('user_id', pa.string()),
+        ('amount', pa.float64()),
+        ('interface_id', pa.int64()),
+        ('currency_id', pa.int64()),
+        ('tx_status', pa.string()),
+    ]),
+    'fact_deposits': pa.schema([
+        ('id', pa.int64()),
+        ('event_timestamp', pa.timestamp('us')),
+        ('time_id', pa.int64()),
+        ('user_id', pa.string()),
+        ('amount', pa.float64()),
+        ('currency_id', pa.int64()),
+        ('tx_status', pa.string()),
+    ]),
+    'fact_events': pa.schema([
+        ('id', pa.int64()),
+        ('event_timestamp', pa.timestamp('us')),
+        ('time_id', pa.int64()),
+        ('user_id', pa.string()),
+        ('event_type_id', pa.int64()),
+    ]),
+    'dim_user': pa.schema([
+        ('user_id', pa.string()),
+        ('jurisdiction', pa.string()),
+        ('level', pa.int64()),
+        ('valid_from', pa.timestamp('us')),
+        ('valid_to', pa.timestamp('us')),
+        ('is_current', pa.bool_()),
+    ]),
+    'dim_currency': pa.schema([
+        ('currency_name', pa.string()),
+        ('currency_id', pa.int64()),
+    ]),
+    'dim_interface': pa.schema([
+        ('interface_name', pa.string()),
+        ('interface_id', pa.int64()),
+    ]),
+    'dim_time': pa.schema([
+        ('date', pa.timestamp('us')),
+        ('year', pa.int32()),
+        ('month', pa.int32()),
+        ('day', pa.int32()),
+        ('quarter', pa.int32()),
+        ('day_of_week', pa.int32()),
+        ('is_weekend', pa.bool_()),
+        ('time_id', pa.int64()),
+    ]),
+    'dim_event_type': pa.schema([
+        ('event_type_name', pa.string()),
+        ('event_type_id', pa.int64()),
+    ]),
+}
+
+# Arrow schemas of the raw fact rows staged by event date for the windowed runs (see stage_raw_data in
+# main.py), with the raw columns of each fact source
+STAGED_SCHEMAS = {
+    'withdrawals': pa.schema([
+        ('id', pa.int64()),
+        ('event_timestamp', pa.timestamp('us')),
+        ('user_id', pa.string()),
+        ('amount', pa.float64()),
+        ('interface', pa.string()),
+        ('currency', pa.string()),
+        ('tx_status', pa.string()),
+    ]),
+    'deposits': pa.schema([
+        ('id', pa.int64()),
+        ('event_timestamp', pa.timestamp('us')),
+        ('user_id', pa.string()),
+        ('amount', pa.float64()),
+        ('currency', pa.string()),
+        ('tx_status', pa.string()),
+    ]),
+    'events': pa.schema([
+        ('id', pa.int64()),
+        ('event_timestamp', pa.timestamp('us')),
+        ('user_id', pa.string()),
+        ('event_name', pa.string()),
+    ]),
+}
+
+# Fact tables, and the staged raw rows, are partitioned by the date of their event_timestamp
+PARTITION_COLUMN = 'event_date'
+PARTITIONED_TABLES = ['fact_withdrawals', 'fact_deposits', 'fact_events']
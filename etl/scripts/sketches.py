@@ -0,0 +1,57 @@
+import math
+import numpy as np
+
+# Compression of the quantile digests: a digest keeps at most about this many centroids, smaller
+# ones near the tails, so extreme quantiles stay accurate in constant memory
+DIGEST_COMPRESSION = 200
+
+def empty_digest():
+    """Returns an empty quantile digest, as a JSON-serializable dict."""
+    return {'means': [], 'weights': [], 'min': None, 'max': None}
+
+def merge_digest(digest, values, compression=DIGEST_COMPRESSION):
+    """Merges an array of values into a t-digest and returns the compressed digest.
+
+    Centroids and values are sorted together and grouped by the t-digest k1 scale function
+    (k = compression / 2π · asin(2q - 1)), so merging digests built from different runs or chunks
+    gives the same kind of summary as building one from all of their values.
+    """
+    values = np.asarray(values, dtype='float64')
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return digest
+
+    means = np.concatenate([np.asarray(digest['means'], dtype='float64'), values])
+    weights = np.concatenate([np.asarray(digest['weights'], dtype='float64'), np.ones(len(values))])
+    order = np.argsort(means, kind='stable')
+    means, weights = means[order], weights[order]
+
+    # Group neighbouring centroids falling in the same unit of the scale function
+    cumulative = np.cumsum(weights)
+    total = cumulative[-1]
+    midpoints = (cumulative - weights / 2) / total
+    buckets = np.floor(compression / (2 * math.pi) * np.arcsin(2 * midpoints - 1))
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    merged_weights = np.add.reduceat(weights, starts)
+    merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+
+    return {
+        'means': merged_means.tolist(),
+        'weights': merged_weights.tolist(),
+        'min': float(min(values.min(), digest['min'] if digest['min'] is not None else np.inf)),
+        'max': float(max(values.max(), digest['max'] if digest['max'] is not None else -np.inf)),
+    }
+
+def digest_quantile(digest, q):
+    """Returns the q quantile estimated from a digest, or None if it is empty."""
+    if not digest['weights']:
+        return None
+
+    means = np.asarray(digest['means'], dtype='float64')
+    weights = np.asarray(digest['weights'], dtype='float64')
+    total = weights.sum()
+
+    # Interpolate between the centers of the centroids, anchored at the observed min and max
+    positions = np.r_[0.0, np.cumsum(weights) - weights / 2, total]
+    points = np.r_[digest['min'], means, digest['max']]
+    return float(np.interp(q * total, positions, points))
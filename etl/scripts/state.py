@@ -6,21 +6,142 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import json
 import logging
+from datetime import datetime, timezone
+import numpy as np
+from scripts.id_index import empty_id_index, id_index_from_array, id_index_to_array
 
 STATE_FILE = 'last_update.json'
+# Directory of the ids already loaded into each fact table, next to the state file
+ID_INDEX_DIR = 'id_index'
 
-def read_last_update_timestamp():
+def read_state():
+    """Reads the whole pipeline state, returning an empty state if there is no state file yet."""
     if os.path.exists(STATE_FILE):
         with open(STATE_FILE, 'r') as file:
-            state = json.load(file)
-            return state.get('last_update_timestamp', None)
-    return None
+            return json.load(file)
+    return {}
+
+def write_state(state):
+    """Writes the whole pipeline state, replacing the state file atomically for the metrics API reading it."""
+    with open(STATE_FILE + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+def read_last_update_timestamp():
+    return read_state().get('last_update_timestamp', None)
 
 def update_last_update_timestamp(*dfs):
     # Get the latest timestamp from all processed dataframes
-    latest_timestamp = max([df['event_timestamp'].max() for df in dfs if not df.empty])
-    state = {'last_update_timestamp': str(latest_timestamp)}
-    with open(STATE_FILE, 'w') as file:
-        json.dump(state, file)
+    timestamps = [df['event_timestamp'].max() for df in dfs if not df.empty]
+    if not timestamps:
+        logging.info("No new records processed, last update timestamp unchanged.")
+        return
+    latest_timestamp = max(timestamps)
+    state = read_state()
+    state['last_update_timestamp'] = str(latest_timestamp)
+    write_state(state)
 
     logging.info(f"Last update timestamp updated to: {latest_timestamp}")
+
+def read_watermark():
+    """Returns the watermark of the loaded data, which moves whenever a run loads newer facts or refreshes the rollups."""
+    state = read_state()
+    return f"{state.get('last_update_timestamp')}/{state.get('refreshed_at')}"
+
+def update_refreshed_at():
+    """Records that the rollups were refreshed, moving the watermark of the metrics served from them."""
+    state = read_state()
+    state['refreshed_at'] = datetime.now(timezone.utc).isoformat()
+    write_state(state)
+
+def read_pending_scopes():
+    """Returns the rollup scopes of the facts loaded by the follow mode since its last refresh, keyed by fact table."""
+    return {table_name: {column: set(keys) for column, keys in scope.items()}
+            for table_name, scope in read_state().get('pending_scopes', {}).items()}
+
+def update_pending_scopes(scopes):
+    """Stores the rollup scopes of the facts loaded by the follow mode since its last refresh, so a restart
+    refreshes the rollups of the micro-batches committed before it stopped."""
+    state = read_state()
+    state['pending_scopes'] = {table_name: {column: sorted(keys) for column, keys in scope.items()}
+                               for table_name, scope in scopes.items()}
+    write_state(state)
+
+def read_file_checkpoints():
+    """Returns the byte-offset checkpoints of the raw files, keyed by file path."""
+    return read_state().get('file_checkpoints', {})
+
+def update_file_checkpoints(checkpoints):
+    """Stores the byte-offset checkpoints of the raw files consumed by the current run."""
+    state = read_state()
+    state.setdefault('file_checkpoints', {}).update(checkpoints)
+    write_state(state)
+
+    logging.info(f"File checkpoints updated for: {', '.join(checkpoints)}")
+
+def read_staging_checkpoints():
+    """Returns the byte-offset checkpoints of the raw files staged for the windowed runs, keyed by file path."""
+    return read_state().get('staging_checkpoints', {})
+
+def update_staging_state(checkpoints, amount_sketches):
+    """Stores the byte-offset checkpoints of the raw files staged for the windowed runs together with the
+    withdrawal amount digests the staged rows were merged into, so the amounts of a byte range are merged once."""
+    state = read_state()
+    state.setdefault('staging_checkpoints', {}).update(checkpoints)
+    state['amount_sketches'] = amount_sketches
+    write_state(state)
+
+    logging.info(f"Staging checkpoints updated for: {', '.join(checkpoints)}")
+
+def read_dimension_keys():
+    """Returns the surrogate keys assigned to the members of each dimension, keyed by dimension name."""
+    return read_state().get('dimension_keys', {})
+
+def update_dimension_keys(dimension_keys):
+    """Stores the surrogate keys assigned to the members of each dimension."""
+    state = read_state()
+    state['dimension_keys'] = dimension_keys
+    write_state(state)
+
+    logging.info(f"Dimension keys updated for: {', '.join(dimension_keys)}")
+
+def read_time_bounds():
+    """Returns the [first, last] date covered by Dim_Time, or None before its first load."""
+    return read_state().get('time_bounds', None)
+
+def update_time_bounds(time_bounds):
+    """Stores the [first, last] date covered by Dim_Time."""
+    state = read_state()
+    state['time_bounds'] = time_bounds
+    write_state(state)
+
+    logging.info(f"Dim_Time bounds updated to: {time_bounds[0]} - {time_bounds[1]}")
+
+def read_amount_sketches():
+    """Returns the quantile digests of the withdrawal amounts, keyed by currency."""
+    return read_state().get('amount_sketches', {})
+
+def update_amount_sketches(amount_sketches):
+    """Stores the quantile digests of the withdrawal amounts, keyed by currency."""
+    state = read_state()
+    state['amount_sketches'] = amount_sketches
+    write_state(state)
+
+    logging.info(f"Withdrawal amount sketches updated for: {', '.join(amount_sketches)}")
+
+def read_id_index(table_name):
+    """Returns the index of the ids already loaded into a fact table, empty before its first load."""
+    index_file = os.path.join(ID_INDEX_DIR, f'{table_name}.npy')
+    if os.path.exists(index_file):
+        return id_index_from_array(np.load(index_file))
+    return empty_id_index()
+
+def update_id_index(table_name, id_index):
+    """Stores the index of the ids loaded into a fact table, replacing the previous file atomically."""
+    os.makedirs(ID_INDEX_DIR, exist_ok=True)
+    index_file = os.path.join(ID_INDEX_DIR, f'{table_name}.npy')
+    with open(index_file + '.tmp', 'wb') as file:
+        np.save(file, id_index_to_array(id_index))
+    os.replace(index_file + '.tmp', index_file)
+
+    logging.info(f"Id index of {table_name} updated to {len(id_index['starts'])} id ranges.")
@@ -0,0 +1,33 @@
+import pandas as pd
+
+# UTC offset written by the raw files after every event_timestamp (e.g. 2020-01-10 14:11:05.63+00)
+UTC_SUFFIX = '+00'
+
+def parse_timestamps(values):
+    """Returns a Series of timestamps as tz-naive UTC datetimes, parsing strings only once.
+
+    Already typed columns are returned as they are (converted to UTC if tz-aware), so later stages can
+    call it freely. Strings are parsed as ISO 8601, which accepts fractions of any length. When every
+    value is in UTC, the offset is stripped and the naive strings are parsed, which is several times
+    faster than parsing the offsets. Unparseable values become NaT.
+    """
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        return values.dt.tz_convert('UTC').dt.tz_localize(None)
+    if pd.api.types.is_datetime64_dtype(values):
+        return values
+
+    strings = values.astype('string')
+    if strings.str.endswith(UTC_SUFFIX).fillna(True).all():
+        return pd.to_datetime(strings.str.removesuffix(UTC_SUFFIX), errors='coerce', format='ISO8601')
+    return pd.to_datetime(strings, errors='coerce', utc=True, format='ISO8601').dt.tz_localize(None)
+
+def to_naive_utc(value):
+    """Returns a timestamp (or ISO 8601 string, e.g. an Airflow data interval bound) as a tz-naive UTC Timestamp."""
+    timestamp = pd.Timestamp(value)
+    return timestamp.tz_convert('UTC').tz_localize(None) if timestamp.tzinfo is not None else timestamp
+
+def parse_event_timestamps(df):
+    """Parses the event_timestamp column of a raw DataFrame in place, if it has one, and returns it."""
+    if 'event_timestamp' in df.columns:
+        df['event_timestamp'] = parse_timestamps(df['event_timestamp'])
+    return df
@@ -1,61 +1,110 @@
+import threading
 import pandas as pd
 import logging
-
-def transform_fact_withdrawals(withdrawals_df):
-    """Transforms withdrawals data into the Fact_Withdrawals table."""
+from scripts.sketches import empty_digest, merge_digest, digest_quantile
+from scripts.timestamps import parse_timestamps
+from scripts.id_index import id_index_contains, add_to_id_index
+from scripts.plans import run_plan
+from utils.instrumentation import instrumented, record_step
+
+# Fact columns replaced by the integer key of their dimension: column -> (dimension, key column)
+DIMENSION_KEY_COLUMNS = {
+    'currency': ('currency', 'currency_id'),
+    'interface': ('interface', 'interface_id'),
+    'event_name': ('event_type', 'event_type_id'),
+}
+
+_dimension_keys_lock = threading.Lock()
+
+# Type-2 Dim_User columns, and the valid_from of the first version of users with no known level
+DIM_USER_COLUMNS = ['user_id', 'jurisdiction', 'level', 'valid_from', 'valid_to', 'is_current']
+SCD_VALID_FROM = pd.Timestamp('1970-01-01')
+
+# Quantile of the withdrawal amounts of each currency above which withdrawals are dropped as outliers
+OUTLIER_QUANTILE = 0.99
+
+# Plan of each fact transformation, run by scripts/plans.py
+FACT_PLANS = {
+    'fact_withdrawals': {
+        'timestamps': ['event_timestamp'],
+        'numeric': ['amount'],
+        'steps': [
+            ('missing_fields', 'not_null', ['user_id', 'event_timestamp', 'amount']),
+            ('positive_amount', 'greater', 'amount', 0),
+            ('outlier_cut', 'at_most_quantile', 'amount', 'currency', OUTLIER_QUANTILE),
+        ],
+        'columns': ['id', 'event_timestamp', 'user_id', 'amount', 'interface', 'currency', 'tx_status'],
+    },
+    'fact_deposits': {
+        'timestamps': ['event_timestamp'],
+        'numeric': ['amount'],
+        'steps': [
+            ('missing_fields', 'not_null', ['user_id', 'event_timestamp']),
+            ('positive_amount', 'greater', 'amount', 0),
+            ('complete_status', 'equals', 'tx_status', 'complete'),
+            ('duplicate_ids', 'unique', ['id']),
+            ('amount_limit', 'at_most', 'amount', 1e9),
+        ],
+        'columns': ['id', 'event_timestamp', 'user_id', 'amount', 'currency', 'tx_status'],
+    },
+    'fact_events': {
+        'timestamps': ['event_timestamp'],
+        'steps': [
+            ('missing_fields', 'not_null', ['user_id', 'event_timestamp', 'event_name']),
+        ],
+        'columns': ['id', 'event_timestamp', 'user_id', 'event_name'],
+    },
+}
+
+@instrumented
+def merge_amount_sketches(amount_sketches, withdrawals_df):
+    """Merges the positive withdrawal amounts of a delta into the quantile digests of their currencies."""
     try:
-        logging.info("Starting transformation for Fact_Withdrawals...")
-        # Convert event_timestamp to datetime
-        withdrawals_df['event_timestamp'] = pd.to_datetime(withdrawals_df['event_timestamp'], errors='coerce')
-        withdrawals_df['event_timestamp'] = withdrawals_df['event_timestamp'].dt.tz_localize(None)
-
-        # Drop rows with missing critical fields
-        withdrawals_df.dropna(subset=['user_id', 'event_timestamp', 'amount'], inplace=True)
+        if withdrawals_df.empty:
+            return amount_sketches
+
+        amounts = pd.to_numeric(withdrawals_df['amount'], errors='coerce')
+        positive = amounts > 0
+        for currency, currency_amounts in amounts[positive].groupby(withdrawals_df['currency'][positive], observed=True):
+            currency = str(currency)
+            amount_sketches[currency] = merge_digest(amount_sketches.get(currency, empty_digest()), currency_amounts.to_numpy())
+        return amount_sketches
+    except Exception as e:
+        logging.error(f"Error merging withdrawal amount sketches: {e}")
+        raise
 
-        # Convert amount to numeric and handle missing or negative values
-        withdrawals_df['amount'] = pd.to_numeric(withdrawals_df['amount'], errors='coerce')
-        withdrawals_df = withdrawals_df[withdrawals_df['amount'] > 0]  # Remove rows with zero or negative amounts
+@instrumented
+def transform_fact_withdrawals(withdrawals_df, amount_sketches=None):
+    """Transforms withdrawals data into the Fact_Withdrawals table.
 
-        # Filter outliers by setting upper limit for amount (e.g., top 99th percentile)
-        upper_limit = withdrawals_df['amount'].quantile(0.99)
-        withdrawals_df = withdrawals_df[withdrawals_df['amount'] <= upper_limit]
+    Rows missing the user, timestamp or a positive amount are dropped. Outliers are cut at the 99th
+    percentile of the amounts of each currency from amount_sketches, the digests persisted across
+    runs, or at the 99th percentile of the frame itself without them.
+    """
+    try:
+        logging.info("Starting transformation for Fact_Withdrawals...")
+        # The same per-currency cut-off applies to every run and chunk, currencies without a digest are kept
+        cutoffs = None
+        if amount_sketches is not None:
+            cutoffs = {currency: digest_quantile(digest, OUTLIER_QUANTILE) for currency, digest in amount_sketches.items()}
 
-        # Select necessary columns for Fact_Withdrawals
-        fact_withdrawals_table = withdrawals_df[['id', 'event_timestamp', 'user_id', 'amount', 'interface', 'currency', 'tx_status']]
+        fact_withdrawals_table = run_plan(withdrawals_df, FACT_PLANS['fact_withdrawals'], cutoffs)
 
         return fact_withdrawals_table
     except Exception as e:
         logging.error(f"Error transforming Fact_Withdrawals: {e}")
         raise
 
+@instrumented
 def transform_fact_deposits(deposits_df):
-    """Transforms deposits data into the Fact_Deposits table with data quality checks."""
+    """Transforms deposits data into the Fact_Deposits table with data quality checks.
+
+    Keeps the first row of each id among the completed deposits with a user, a timestamp and an
+    amount above 0, then drops amounts above 1 billion.
+    """
     try:
         logging.info("Starting transformation for Fact_Deposits...")
-
-        # Convert event_timestamp to datetime and handle missing values
-        deposits_df['event_timestamp'] = pd.to_datetime(deposits_df['event_timestamp'], errors='coerce')
-        deposits_df['event_timestamp'] = deposits_df['event_timestamp'].dt.tz_localize(None)
-
-        # Remove rows with missing user_id or event_timestamp
-        deposits_df.dropna(subset=['user_id', 'event_timestamp'], inplace=True)
-
-        # Convert amount to numeric and handle missing or negative values
-        deposits_df['amount'] = pd.to_numeric(deposits_df['amount'], errors='coerce')
-        deposits_df = deposits_df[deposits_df['amount'] > 0]  # Remove rows with zero or negative amounts
-
-        # Filter only completed transactions
-        deposits_df = deposits_df[deposits_df['tx_status'] == 'complete']
-
-        # Remove duplicates based on ID
-        deposits_df.drop_duplicates(subset=['id'], inplace=True)
-
-        # Filter amounts within a reasonable range (e.g., up to 1 billion)
-        upper_limit = 1e9
-        deposits_df = deposits_df[deposits_df['amount'] <= upper_limit]
-
-        # Select necessary columns for Fact_Deposits
-        fact_deposits_table = deposits_df[['id', 'event_timestamp', 'user_id', 'amount', 'currency', 'tx_status']]
+        fact_deposits_table = run_plan(deposits_df, FACT_PLANS['fact_deposits'])
 
         logging.info("Fact_Deposits transformation completed.")
         return fact_deposits_table
@@ -64,19 +113,12 @@ def transform_fact_deposits(deposits_df):
         raise
 
 
+@instrumented
 def transform_fact_events(events_df):
-    """Transforms events data into the Fact_Events table."""
+    """Transforms events data into the Fact_Events table, dropping rows missing the user, timestamp or event name."""
     try:
         logging.info("Starting transformation for Fact_Events...")
-        # Convert event_timestamp to datetime
-        events_df['event_timestamp'] = pd.to_datetime(events_df['event_timestamp'], errors='coerce')
-        events_df['event_timestamp'] = events_df['event_timestamp'].dt.tz_localize(None)
-
-        # Drop rows with missing critical fields
-        events_df.dropna(subset=['user_id', 'event_timestamp', 'event_name'], inplace=True)
-
-        # Select necessary columns for Fact_Events
-        fact_events_table = events_df[['id', 'event_timestamp', 'user_id', 'event_name']]
+        fact_events_table = run_plan(events_df, FACT_PLANS['fact_events'])
 
         return fact_events_table
     except Exception as e:
@@ -84,55 +126,75 @@ def transform_fact_events(events_df):
         raise
 
 
-def transform_user_data(user_id_df, user_level_df):
-    """Transforms user data into the Dim_User table."""
+@instrumented
+def transform_user_data(user_id_df, user_level_df, user_versions=None):
+    """Transforms user data into the type-2 Dim_User rows for the new users and level changes of the delta.
+
+    The level changes are merged into the stored versions of their users (user_versions), and each
+    version is valid until the valid_from of the next one. The rows returned are the new versions and
+    the stored versions whose valid_to or is_current changed, so a late level change dated before the
+    current version is inserted as a closed version and closes the version it follows.
+    """
     try:
         logging.info("Starting transformation for Dim_User...")
-        user_level_df['event_timestamp'] = pd.to_datetime(user_level_df['event_timestamp'], errors='coerce')
-        user_level_df['event_timestamp'] = user_level_df['event_timestamp'].dt.tz_localize(None)
-        
-        latest_user_level = user_level_df.sort_values(by='event_timestamp').groupby('user_id').tail(1)
-        dim_user = pd.merge(user_id_df, latest_user_level, on='user_id', how='left')
-        dim_user_table = dim_user[['user_id', 'jurisdiction', 'level']].drop_duplicates()
-        
+        if user_versions is None:
+            user_versions = pd.DataFrame(columns=DIM_USER_COLUMNS)
+
+        # Level changes of the delta, one per user and time
+        changes = user_level_df.assign(valid_from=parse_timestamps(user_level_df['event_timestamp']))
+        changes = changes.dropna(subset=['user_id', 'valid_from']).drop_duplicates(subset=['user_id', 'valid_from'], keep='last')
+        changes = changes.assign(user_id=changes['user_id'].astype(object), is_new=True)
+
+        # Stored versions, remembering their validity to find the ones the changes modify
+        stored = user_versions.assign(
+            user_id=user_versions['user_id'].astype(object), valid_from=pd.to_datetime(user_versions['valid_from']),
+            stored_valid_to=pd.to_datetime(user_versions['valid_to']), stored_is_current=user_versions['is_current'], is_new=False
+        )
+
+        # Versions of each user ordered by time, a change replacing a stored version with the same valid_from
+        history = pd.concat([stored, changes[['user_id', 'jurisdiction', 'level', 'valid_from', 'is_new']]], ignore_index=True)
+        history = history.drop_duplicates(subset=['user_id', 'valid_from'], keep='last')
+        history = history.sort_values(['user_id', 'valid_from'], kind='stable').reset_index(drop=True)
+
+        # A version is closed by the next version of the same user, and the last one is current
+        has_next = history['user_id'].shift(-1).eq(history['user_id']).fillna(False).astype(bool)
+        history = history.assign(valid_to=history['valid_from'].shift(-1).where(has_next), is_current=~has_next)
+        same_valid_to = history['valid_to'].eq(history['stored_valid_to']) | (history['valid_to'].isna() & history['stored_valid_to'].isna())
+        changed = history['is_new'].astype(bool) | ~same_valid_to | history['is_current'].ne(history['stored_is_current'])
+        versions = history[changed]
+
+        # New users without any level yet start with an open version of unknown level
+        known_users = history['user_id']
+        new_users = user_id_df.loc[~user_id_df['user_id'].astype(object).isin(known_users), ['user_id']].drop_duplicates()
+        new_users = new_users.assign(jurisdiction=None, level=pd.NA, valid_from=SCD_VALID_FROM, valid_to=pd.NaT, is_current=True)
+
+        dim_user_table = pd.concat([versions[DIM_USER_COLUMNS], new_users[DIM_USER_COLUMNS]], ignore_index=True)
+        new_versions = int(versions['is_new'].astype(bool).sum())
+        logging.info(f"Dim_User transformation completed: {new_versions} new versions, {len(versions) - new_versions} updated, {len(new_users)} new users.")
         return dim_user_table
     except Exception as e:
         logging.error(f"Error transforming Dim_User: {e}")
         raise
 
 
-def transform_dim_currency(fact_withdrawals_df, fact_deposits_df):
-    """Creates the Dim_Currency table from Fact_Withdrawals and Fact_Deposits."""
+@instrumented
+def transform_dim_currency(dimension_keys, previous_keys=None):
+    """Creates the Dim_Currency rows of the currencies added since previous_keys (all of them if not given)."""
     try:
         logging.info("Starting transformation for Dim_Currency...")
-
-        # Combine currencies from both fact tables
-        combined_currencies = pd.concat([fact_withdrawals_df[['currency']], fact_deposits_df[['currency']]])
-        
-        # Extract unique currencies
-        unique_currencies = combined_currencies.drop_duplicates().reset_index(drop=True)
-        unique_currencies['currency_id'] = unique_currencies.index + 1
-
-        # Rename column for clarity
-        dim_currency = unique_currencies.rename(columns={'currency': 'currency_name'})
-
+        dim_currency = dimension_from_keys(dimension_keys.get('currency', {}), 'currency_name', 'currency_id', (previous_keys or {}).get('currency'))
         return dim_currency
     except Exception as e:
         logging.error(f"Error transforming Dim_Currency: {e}")
         raise
 
 
-def transform_dim_interface(fact_withdrawals_df):
-    """Creates the Dim_Interface table from Fact_Withdrawals and Fact_Deposits."""
+@instrumented
+def transform_dim_interface(dimension_keys, previous_keys=None):
+    """Creates the Dim_Interface rows of the interfaces added since previous_keys (all of them if not given)."""
     try:
         logging.info("Starting transformation for Dim_Interface...")
-
-        # Extract unique interfaces
-        unique_interfaces = fact_withdrawals_df[['interface']].drop_duplicates().reset_index(drop=True)
-        unique_interfaces['interface_id'] = unique_interfaces.index + 1
-
-        # Rename column for clarity
-        dim_interface = unique_interfaces.rename(columns={'interface': 'interface_name'})
+        dim_interface = dimension_from_keys(dimension_keys.get('interface', {}), 'interface_name', 'interface_id', (previous_keys or {}).get('interface'))
 
         logging.info("Dim_Interface transformation completed.")
         return dim_interface
@@ -141,12 +203,16 @@ def transform_dim_interface(fact_withdrawals_df):
         raise
 
 
+@instrumented
 def transform_dim_time(min_date, max_date):
     """Creates the Dim_Time table based on the date range from min_date to max_date."""
     try:
         logging.info("Starting transformation for Dim_Time...")
-        # Generate date range
-        date_range = pd.date_range(start=min_date, end=max_date, freq='D')
+        # Generate date range, one row per calendar day (none when the facts had no rows)
+        if pd.isna(min_date) or pd.isna(max_date):
+            date_range = pd.DatetimeIndex([])
+        else:
+            date_range = pd.date_range(start=pd.Timestamp(min_date).normalize(), end=pd.Timestamp(max_date).normalize(), freq='D')
 
         # Create a DataFrame for Dim_Time
         dim_time = pd.DataFrame(date_range, columns=['date'])
@@ -157,7 +223,7 @@ def transform_dim_time(min_date, max_date):
         dim_time['day_of_week'] = dim_time['date'].dt.dayofweek
         dim_time['is_weekend'] = dim_time['date'].dt.dayofweek >= 5
         dim_time.reset_index(drop=True, inplace=True)
-        dim_time['time_id'] = dim_time.index + 1
+        dim_time['time_id'] = date_key(dim_time['date'])
 
         return dim_time
     except Exception as e:
@@ -165,21 +231,137 @@ def transform_dim_time(min_date, max_date):
         raise
 
 
-def transform_dim_event_type(fact_events_df):
-    """Creates the Dim_Event_Type table from Fact_Events."""
-    try:
-        logging.info("Starting transformation for Dim_Event_Type...")
-        # Extract unique event types
-        unique_event_types = fact_events_df[['event_name']].drop_duplicates()
-        unique_event_types.reset_index(drop=True, inplace=True)
-        unique_event_types['event_type_id'] = unique_event_types.index + 1
+@instrumented
+def transform_dim_time_from_facts(*fact_dfs, time_bounds=None):
+    """Creates the Dim_Time rows needed to cover the event_timestamp range of the given fact tables."""
+    # Fact tables without new rows have no range, and would make the whole range NaT
+    non_empty = [df for df in fact_dfs if not df.empty]
+    min_date = min((df['event_timestamp'].min() for df in non_empty), default=None)
+    max_date = max((df['event_timestamp'].max() for df in non_empty), default=None)
+    return transform_dim_time_extension(min_date, max_date, time_bounds)
+
+
+@instrumented
+def transform_dim_time_extension(min_date, max_date, time_bounds=None):
+    """Creates the Dim_Time rows extending the calendar in time_bounds at its edges to cover min_date to max_date."""
+    if not time_bounds or pd.isna(min_date) or pd.isna(max_date):
+        return transform_dim_time(min_date, max_date)
 
-        # Rename column for clarity
-        dim_event_type = unique_event_types.rename(columns={'event_name': 'event_type_name'})
+    # The calendar is contiguous between its bounds, so only the days outside of them are new
+    first_day, last_day = pd.Timestamp(time_bounds[0]).normalize(), pd.Timestamp(time_bounds[1]).normalize()
+    before = transform_dim_time(min_date, first_day - pd.Timedelta(days=1))
+    after = transform_dim_time(last_day + pd.Timedelta(days=1), max_date)
+    return pd.concat([before, after], ignore_index=True)
 
+
+@instrumented
+def transform_dim_event_type(dimension_keys, previous_keys=None):
+    """Creates the Dim_Event_Type rows of the event types added since previous_keys (all of them if not given)."""
+    try:
+        logging.info("Starting transformation for Dim_Event_Type...")
+        dim_event_type = dimension_from_keys(dimension_keys.get('event_type', {}), 'event_type_name', 'event_type_id', (previous_keys or {}).get('event_type'))
         return dim_event_type
     except Exception as e:
         logging.error(f"Error transforming Dim_Event_Type: {e}")
         raise
 
 
+def transform_chunks(chunks, transform_func):
+    """Applies a fact transformation to each chunk of a stream, yielding the non-empty results."""
+    for chunk in chunks:
+        transformed_chunk = transform_func(chunk)
+        if not transformed_chunk.empty:
+            yield transformed_chunk
+
+
+@instrumented
+def drop_loaded_ids(fact_df, id_index):
+    """Drops the rows of a fact table whose id was loaded by an earlier run or repeats within the frame."""
+    try:
+        if fact_df.empty:
+            return fact_df
+
+        duplicated = id_index_contains(id_index, fact_df['id'].to_numpy()) | fact_df['id'].duplicated().to_numpy()
+        record_step('loaded_ids', len(fact_df), len(fact_df) - int(duplicated.sum()))
+        if duplicated.any():
+            logging.info(f"Dropped {int(duplicated.sum())} rows with already loaded or repeated ids.")
+        return fact_df[~duplicated]
+    except Exception as e:
+        logging.error(f"Error dropping already loaded ids: {e}")
+        raise
+
+
+def drop_loaded_chunk_ids(chunks, id_index):
+    """Drops already loaded ids from each chunk of a stream, adding the ids of each chunk to the index as it goes."""
+    for chunk in chunks:
+        chunk = drop_loaded_ids(chunk, id_index)
+        if not chunk.empty:
+            add_to_id_index(id_index, chunk['id'].to_numpy())
+            yield chunk
+
+
+def date_key(timestamps):
+    """Returns the yyyymmdd integer key of each timestamp, used as the time_id of Dim_Time."""
+    return (timestamps.dt.year * 10000 + timestamps.dt.month * 100 + timestamps.dt.day).astype('int64')
+
+
+def dimension_from_keys(key_map, name_column, id_column, previous_key_map=None):
+    """Builds the dimension rows of a {member: key} map not in previous_key_map, ordered by key."""
+    new_members = [member for member in key_map if member not in (previous_key_map or {})]
+    dimension = pd.DataFrame({name_column: new_members, id_column: [key_map[member] for member in new_members]})
+    return dimension.sort_values(id_column).reset_index(drop=True)
+
+
+@instrumented
+def assign_dimension_keys(dimension_keys, *fact_dfs):
+    """Assigns the next free surrogate key to every dimension member not seen in earlier runs."""
+    try:
+        with _dimension_keys_lock:
+            for column, (dimension, _) in DIMENSION_KEY_COLUMNS.items():
+                key_map = dimension_keys.setdefault(dimension, {})
+                members = set()
+                for fact_df in fact_dfs:
+                    if column in fact_df.columns:
+                        members.update(pd.unique(fact_df[column].dropna()))
+
+                next_key = max(key_map.values(), default=0) + 1
+                for member in sorted(members - key_map.keys()):
+                    key_map[member] = next_key
+                    next_key += 1
+        return dimension_keys
+    except Exception as e:
+        logging.error(f"Error assigning dimension keys: {e}")
+        raise
+
+
+@instrumented
+def resolve_surrogate_keys(fact_df, dimension_keys):
+    """Replaces the dimension columns of a fact table with their integer keys and adds its time_id."""
+    try:
+        # Resolve from a copy of the key maps, as the streams of other fact tables add keys to them concurrently
+        with _dimension_keys_lock:
+            key_maps = {dimension: dict(key_map) for dimension, key_map in dimension_keys.items()}
+
+        columns = []
+        for column in fact_df.columns:
+            if column in DIMENSION_KEY_COLUMNS:
+                dimension, key_column = DIMENSION_KEY_COLUMNS[column]
+                # Series.map with a dict is a vectorized hash lookup, done once per category for categoricals
+                fact_df = fact_df.assign(**{key_column: fact_df[column].map(key_maps[dimension]).astype('Int64')})
+                columns.append(key_column)
+            else:
+                columns.append(column)
+            if column == 'event_timestamp':
+                fact_df = fact_df.assign(time_id=date_key(fact_df['event_timestamp']))
+                columns.append('time_id')
+        return fact_df[columns]
+    except Exception as e:
+        logging.error(f"Error resolving surrogate keys: {e}")
+        raise
+
+
+def resolve_chunk_keys(chunks, dimension_keys):
+    """Assigns and resolves the surrogate keys of each fact chunk of a stream."""
+    for chunk in chunks:
+        assign_dimension_keys(dimension_keys, chunk)
+        yield resolve_surrogate_keys(chunk, dimension_keys)
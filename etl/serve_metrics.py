@@ -0,0 +1,167 @@
+import sys
+import os
+
+# Add the project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import asyncio
+import logging
+import argparse
+import yaml
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import scripts.state as state
+from scripts.metrics import METRICS, MetricsCache, parse_date_range, query_metric
+from utils.logging import setup_logging
+
+# Load configuration
+with open('config/config.yml') as file:
+    config = yaml.safe_load(file)
+
+# Largest request head accepted, dashboards only send short GET requests
+MAX_HEAD_BYTES = 16384
+
+_watermark = {'mtime': None, 'value': None}
+
+def current_watermark():
+    """Returns the watermark of the state file, only reading the file again once it was replaced."""
+    try:
+        mtime = os.stat(state.STATE_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _watermark['mtime'] or _watermark['value'] is None:
+        _watermark['mtime'], _watermark['value'] = mtime, state.read_watermark()
+    return _watermark['value']
+
+class MetricsServer:
+    """Read-only HTTP API serving the dashboard metrics as JSON from a watermark-keyed result cache.
+
+    Requests are handled on one event loop, and the cache misses are queried on a thread pool sized
+    like the database connection pool, with concurrent requests for the same result sharing one query.
+    """
+
+    def __init__(self, cache_max_bytes, workers):
+        self.cache = MetricsCache(cache_max_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}
+
+    async def metric(self, metric, start, end, watermark):
+        """Returns the encoded result of a metric at a watermark and whether it came from the cache."""
+        key = (metric, start, end, watermark)
+        body = self.cache.get(key)
+        if body is not None:
+            return body, 'hit'
+        future = self.pending.get(key)
+        if future is None:
+            future = self.pending[key] = asyncio.get_running_loop().run_in_executor(self.executor, query_metric, metric, start, end, watermark)
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        body = await asyncio.shield(future)
+        self.cache.put(key, body)
+        return body, 'miss'
+
+    async def warm(self):
+        """Computes every metric without a date range at the current watermark and drops the older results."""
+        watermark = current_watermark()
+        self.cache.drop_stale(watermark)
+        await asyncio.gather(*[self.metric(metric, None, None, watermark) for metric in METRICS])
+        logging.info(f"Metrics cache warmed at watermark {watermark}: {self.cache.stats()}")
+        return {'watermark': watermark, 'metrics': len(METRICS), **self.cache.stats()}
+
+    async def route(self, method, target):
+        """Returns the status, body and cache header of a request."""
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+
+        if method == 'GET' and parts == ['metrics']:
+            return 200, json.dumps({'metrics': list(METRICS)}).encode(), None
+        if method == 'GET' and parts == ['health']:
+            return 200, json.dumps({'watermark': current_watermark(), 'cache': self.cache.stats()}).encode(), None
+        if method == 'POST' and parts == ['warm']:
+            return 200, json.dumps(await self.warm()).encode(), None
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'metrics':
+            if parts[1] not in METRICS:
+                return 404, json.dumps({'error': f"Unknown metric {parts[1]}"}).encode(), None
+            try:
+                start, end = parse_date_range(parts[1], query.get('start'), query.get('end'))
+            except ValueError as e:
+                return 400, json.dumps({'error': str(e)}).encode(), None
+            body, cache_status = await self.metric(parts[1], start, end, current_watermark())
+            return 200, body, cache_status
+        return 404, json.dumps({'error': f"No route for {method} {url.path}"}).encode(), None
+
+    async def handle(self, reader, writer):
+        """Serves the requests of a connection, keeping it open between requests unless the client closes it."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = dict(line.lower().split(':', 1) for line in header_lines if ':' in line)
+                try:
+                    method, target, version = request_line.split(' ')
+                except ValueError:
+                    break
+                content_length = headers.get('content-length', '0').strip()
+                if content_length.isdigit():
+                    # Request bodies are not used, but are read to keep the connection in sync
+                    try:
+                        await reader.readexactly(int(content_length))
+                    except (asyncio.IncompleteReadError, ConnectionError):
+                        break
+                    try:
+                        status, body, cache_status = await self.route(method, target)
+                    except Exception as e:
+                        status, body, cache_status = 500, json.dumps({'error': str(e)}).encode(), None
+                else:
+                    # Without a valid length the body cannot be skipped, so the connection is closed after the error
+                    status, body, cache_status = 400, json.dumps({'error': f"Invalid Content-Length {content_length!r}"}).encode(), None
+                keep_alive = (content_length.isdigit() and version == 'HTTP/1.1'
+                              and headers.get('connection', '').strip().lower() != 'close')
+
+                response_head = [
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                    "Content-Type: application/json",
+                    f"Content-Length: {len(body)}",
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}",
+                ]
+                if cache_status:
+                    response_head.append(f"X-Cache: {cache_status}")
+                writer.write(('\r\n'.join(response_head) + '\r\n\r\n').encode() + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+async def serve(host, port, cache_max_bytes, workers):
+    """Warms the cache, then serves the metrics API until interrupted."""
+    metrics_server = MetricsServer(cache_max_bytes, workers)
+    try:
+        await metrics_server.warm()
+    except Exception as e:
+        logging.warning(f"Could not warm the metrics cache on startup: {e}")
+
+    server = await asyncio.start_server(metrics_server.handle, host, port, limit=MAX_HEAD_BYTES)
+    logging.info(f"Serving the metrics API on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    api_config = config.get('api', {})
+    pool_config = config['database'].get('pool', {})
+    parser = argparse.ArgumentParser(description="Serves the dashboard metrics as JSON from a watermark-keyed cache.")
+    parser.add_argument('--host', default=api_config.get('host', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=api_config.get('port', 8050))
+    parser.add_argument('--cache-max-bytes', type=int, default=api_config.get('cache_max_bytes', 64 * 1024 * 1024),
+                        help="total size of the cached results")
+    args = parser.parse_args()
+
+    setup_logging(config['log_file'])
+    # One query thread per connection the pool can open
+    workers = pool_config.get('size', 5) + pool_config.get('max_overflow', 10)
+    asyncio.run(serve(args.host, args.port, args.cache_max_bytes, workers))
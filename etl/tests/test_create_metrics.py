@@ -0,0 +1,72 @@
+import os
+import sys
+
+# The Metabase sync script lives next to the dashboard queries, outside the ETL package
+VISUALIZATION_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'visualization'))
+sys.path.append(VISUALIZATION_PATH)
+
+import create_metrics
+from create_metrics import read_query_cards, sync_metrics, sync_card
+
+QUERIES_FILE = os.path.join(VISUALIZATION_PATH, 'queries.sql')
+
+class StubResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code, self.body, self.text = status_code, body, str(body)
+
+    def json(self):
+        return self.body
+
+class StubSession:
+    """Stands in for the Metabase API session, serving a fixed card list and recording the writes."""
+
+    def __init__(self, cards, failing_names=()):
+        self.cards, self.failing_names, self.writes = cards, set(failing_names), []
+
+    def get(self, url, timeout=None):
+        return StubResponse(200, self.cards)
+
+    def post(self, url, json=None, timeout=None):
+        self.writes.append(('POST', url, json['name']))
+        return StubResponse(500 if json['name'] in self.failing_names else 200, {})
+
+    def put(self, url, json=None, timeout=None):
+        self.writes.append(('PUT', url, json['name']))
+        return StubResponse(200, {})
+
+    def close(self):
+        pass
+
+def card(card_id, name, query_sql, database_id=2, display='bar', archived=False):
+    return {'id': card_id, 'name': name, 'archived': archived, 'display': display,
+            'dataset_query': {'type': 'native', 'native': {'query': query_sql}, 'database': database_id}}
+
+def test_cards_are_created_updated_or_left_unchanged(monkeypatch):
+    queries = {name: query_sql for name, _, query_sql in read_query_cards(QUERIES_FILE)}
+    session = StubSession([
+        # Same query with other whitespace
+        card(1, 'Active Users Per Day', '  ' + queries['Active Users Per Day'].replace('\n', '\n    ')),
+        card(2, 'Users Without Deposit', 'SELECT 1', display='table'),
+        card(3, 'Last Login Per User', queries['Last Login Per User'], database_id=3, display='table'),
+        card(4, 'Logins Between Dates', queries['Logins Between Dates'], display='table'),
+        # Archived cards are created again, and the oldest card of a name is the one updated
+        card(5, 'Users With More Than 5 Deposits', queries['Users With More Than 5 Deposits'], display='table', archived=True),
+        card(9, 'Users Without Deposit', queries['Users Without Deposit'], display='table'),
+    ])
+    monkeypatch.setattr(create_metrics, 'metabase_login', lambda url, pool_size: session)
+
+    summary = sync_metrics('http://metabase', database_id=2, max_workers=2, queries_file=QUERIES_FILE)
+    assert summary == {'created': 4, 'unchanged': 1, 'updated': 3}
+    assert sorted(write for write in session.writes if write[0] == 'PUT') == [
+        ('PUT', 'http://metabase/api/card/2', 'Users Without Deposit'),
+        ('PUT', 'http://metabase/api/card/3', 'Last Login Per User'),
+        ('PUT', 'http://metabase/api/card/4', 'Logins Between Dates'),
+    ]
+    assert {name for method, _, name in session.writes if method == 'POST'} == {
+        'Users With More Than 5 Deposits', 'Unique Currencies Deposited Per Day',
+        'Unique Currencies Withdrew Per Day', 'Total Amount Deposited Per Currency Per Day',
+    }
+
+def test_failed_card_write_is_reported():
+    session = StubSession([], failing_names=['Active Users Per Day'])
+    assert sync_card(session, 'Active Users Per Day', 'bar', 'SELECT 1', 2, {}, 'http://metabase') == 'failed'
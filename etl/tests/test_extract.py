@@ -0,0 +1,171 @@
+import csv
+import gzip
+import io
+import os
+import pandas as pd
+import pyarrow as pa
+import pytest
+from scripts.extract import open_csv_tail, _last_row_start, list_raw_files, load_csv_incremental, iter_csv_incremental, concat_raw_frames
+
+HEADER = 'id,event_name\n'
+
+def write(path, text, mode='w'):
+    with open(path, mode) as file:
+        file.write(text)
+
+def read_tail(path, checkpoints, complete_rows_only=False):
+    """Reads the rows of a CSV file not consumed yet, then advances its checkpoint like the extract does."""
+    stream, columns, checkpoint, resumed = open_csv_tail(str(path), checkpoints, complete_rows_only)
+    with stream:
+        rows = list(csv.reader(stream))
+    checkpoints[str(path)] = checkpoint
+    return columns, rows, resumed
+
+def test_last_row_start():
+    assert _last_row_start(io.BytesIO(b'a\n1\n22\n'), 7) == 4
+    assert _last_row_start(io.BytesIO(b'a\n1\n22'), 6) == 4
+    assert _last_row_start(io.BytesIO(b'a\n'), 2) == 0
+    # The line break before the last row may be several read blocks back
+    data = b'a\n' + b'x' * 200000 + b'\n'
+    assert _last_row_start(io.BytesIO(data), len(data)) == 2
+
+def test_tail_resumes_after_the_checkpoint(tmp_path):
+    path = tmp_path / 'events.csv'
+    write(path, HEADER + '1,login\n2,logout\n')
+    checkpoints = {}
+    assert read_tail(path, checkpoints) == (['id', 'event_name'], [['1', 'login'], ['2', 'logout']], False)
+
+    write(path, '3,signup\n4,login\n', mode='a')
+    assert read_tail(path, checkpoints) == (['id', 'event_name'], [['3', 'signup'], ['4', 'login']], True)
+    # Nothing was appended since
+    assert read_tail(path, checkpoints)[1:] == ([], True)
+
+def test_rewritten_file_is_fully_scanned(tmp_path):
+    path = tmp_path / 'events.csv'
+    write(path, HEADER + '1,login\n2,logout\n')
+    checkpoints = {}
+    read_tail(path, checkpoints)
+
+    # Same size, but the last consumed row changed
+    write(path, HEADER + '1,login\n2,logoff\n')
+    assert read_tail(path, checkpoints)[1:] == ([['1', 'login'], ['2', 'logoff']], False)
+
+    # Rewritten with more rows than were consumed
+    write(path, HEADER + '7,a\n8,b\n9,signup\n')
+    assert read_tail(path, checkpoints)[1:] == ([['7', 'a'], ['8', 'b'], ['9', 'signup']], False)
+
+def test_truncated_file_is_fully_scanned(tmp_path):
+    path = tmp_path / 'events.csv'
+    write(path, HEADER + '1,login\n2,logout\n')
+    checkpoints = {}
+    read_tail(path, checkpoints)
+
+    write(path, HEADER + '5,a\n')
+    assert read_tail(path, checkpoints)[1:] == ([['5', 'a']], False)
+
+def test_changed_header_is_fully_scanned(tmp_path):
+    path = tmp_path / 'events.csv'
+    write(path, HEADER + '1,login\n')
+    checkpoints = {}
+    read_tail(path, checkpoints)
+
+    write(path, 'id,event\n1,login\n2,logout\n')
+    assert read_tail(path, checkpoints) == (['id', 'event'], [['1', 'login'], ['2', 'logout']], False)
+
+def test_partial_last_row_is_left_for_later(tmp_path):
+    path = tmp_path / 'events.csv'
+    write(path, HEADER + '1,login\n2,log')
+    checkpoints = {}
+    assert read_tail(path, checkpoints, complete_rows_only=True)[1:] == ([['1', 'login']], False)
+    assert checkpoints[str(path)]['offset'] == len(HEADER + '1,login\n')
+
+    # Once the writer finishes the row, it is read whole
+    write(path, 'out\n3,signup', mode='a')
+    assert read_tail(path, checkpoints, complete_rows_only=True)[1:] == ([['2', 'logout']], True)
+
+    # Without complete_rows_only the partial row is read as it is
+    assert read_tail(path, {}, complete_rows_only=False)[1][-1] == ['3', 'signup']
+
+EVENTS_HEADER = 'id,event_timestamp,user_id,event_name\n'
+
+def write_events(path, rows, mtime):
+    """Writes raw event rows to a plain, .gz or .zst CSV file with a given modification time."""
+    data = (EVENTS_HEADER + ''.join(f"{row_id},2024-01-01 00:00:{row_id:02d}+00,u{row_id},{name}\n" for row_id, name in rows)).encode()
+    if path.endswith('.gz'):
+        with gzip.open(path, 'wb') as file:
+            file.write(data)
+    elif path.endswith('.zst'):
+        with pa.output_stream(path, compression='zstd') as file:
+            file.write(data)
+    else:
+        write(path, data.decode())
+    os.utime(path, (mtime, mtime))
+
+def test_raw_files_match_their_glob_in_name_order(tmp_path):
+    for name in ['b.csv', 'a.csv.gz', 'c.csv.zst']:
+        write_events(str(tmp_path / name), [(1, 'login')], 1700000000)
+    write(tmp_path / 'notes.txt', 'not raw data')
+
+    to_read, consumed = list_raw_files(str(tmp_path / '*.csv*'))
+    assert [os.path.basename(path) for path in to_read] == ['a.csv.gz', 'b.csv', 'c.csv.zst']
+    assert consumed == []
+    with pytest.raises(FileNotFoundError):
+        list_raw_files(str(tmp_path / '*.json'))
+
+def test_compressed_and_unchanged_files(tmp_path):
+    paths = {name: str(tmp_path / name) for name in ['a.csv.gz', 'b.csv', 'c.csv.zst']}
+    write_events(paths['a.csv.gz'], [(1, 'login'), (2, 'logout')], 1700000000)
+    write_events(paths['b.csv'], [(3, 'signup')], 1700000000)
+    write_events(paths['c.csv.zst'], [(4, 'login')], 1700000000)
+    checkpoints = {}
+    df = load_csv_incremental(str(tmp_path / '*.csv*'), checkpoints=checkpoints, source='events', max_workers=2)
+    assert list(df['id']) == [1, 2, 3, 4]
+    assert isinstance(df['event_name'].dtype, pd.CategoricalDtype)
+    assert set(df['event_name'].cat.categories) == {'login', 'logout', 'signup'}
+    assert set(checkpoints) == set(paths.values())
+
+    # Files whose size and modification time match their checkpoint are skipped
+    to_read, consumed = list_raw_files(str(tmp_path / '*.csv*'), checkpoints)
+    assert to_read == [] and len(consumed) == 3
+    df = load_csv_incremental(str(tmp_path / '*.csv*'), checkpoints=checkpoints, source='events')
+    assert df.empty and list(df.columns) == ['id', 'event_timestamp', 'user_id', 'event_name']
+
+    # A replaced compressed file is read whole again, the others are still skipped
+    write_events(paths['c.csv.zst'], [(4, 'login'), (5, 'signup')], 1700000100)
+    df = load_csv_incremental(str(tmp_path / '*.csv*'), checkpoints=checkpoints, source='events')
+    assert list(df['id']) == [4, 5]
+    assert checkpoints[paths['c.csv.zst']]['mtime'] == 1700000100
+
+def test_concat_raw_frames_merges_categories():
+    first = pd.DataFrame({'id': [1, 2], 'currency': pd.Series(['mxn', 'usd'], dtype='category')})
+    second = pd.DataFrame({'id': [3], 'currency': pd.Series(['btc'], dtype='category')})
+    df = concat_raw_frames([first, second])
+    assert isinstance(df['currency'].dtype, pd.CategoricalDtype)
+    assert list(df['currency']) == ['mxn', 'usd', 'btc']
+    assert list(df.index) == [0, 1, 2]
+    assert concat_raw_frames([first]) is first
+
+def test_streamed_checkpoint_advances_once_the_last_chunk_is_sunk(tmp_path):
+    path = str(tmp_path / 'events.csv')
+    write_events(path, [(row_id, 'login') for row_id in range(1, 6)], 1700000000)
+    pattern = str(tmp_path / '*.csv')
+
+    # A sink failing on a chunk leaves the checkpoint where it was, so the next run reads the file again
+    checkpoints = {}
+    with pytest.raises(RuntimeError):
+        for chunk in iter_csv_incremental(pattern, chunk_size=2, checkpoints=checkpoints, source='events'):
+            if 3 in chunk['id'].tolist():
+                raise RuntimeError('sink failed')
+    assert checkpoints == {}
+
+    # The checkpoint only advances once the sink of the last chunk returned
+    chunks = iter_csv_incremental(pattern, chunk_size=2, checkpoints=checkpoints, source='events')
+    assert [next(chunks)['id'].tolist() for _ in range(3)] == [[1, 2], [3, 4], [5]]
+    assert checkpoints == {}
+    assert next(chunks, None) is None
+    assert checkpoints[path]['offset'] == os.path.getsize(path)
+
+    # The next run streams only the appended rows
+    write(path, '6,2024-01-01 00:00:06+00,u6,logout\n', mode='a')
+    chunks = list(iter_csv_incremental(pattern, chunk_size=2, checkpoints=checkpoints, source='events'))
+    assert [chunk['id'].tolist() for chunk in chunks] == [[6]]
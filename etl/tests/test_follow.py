@@ -0,0 +1,69 @@
+import os
+from unittest import mock
+import pandas as pd
+import main
+import scripts.dimensions as dimensions
+import scripts.state as state
+
+RAW_FILES = {
+    'user_id_sample_data.csv': 'user_id\nu1\n',
+    'user_level_sample_data.csv': 'event_timestamp,user_id,jurisdiction,level\n2024-01-01 09:00:00+00,u1,mx,1\n',
+    'withdrawals_sample_data.csv': 'id,event_timestamp,user_id,amount,interface,currency,tx_status\n1,2024-01-01 10:00:00+00,u1,5.0,app,mxn,complete\n',
+    'deposit_sample_data.csv': 'id,event_timestamp,user_id,amount,currency,tx_status\n1,2024-01-01 10:00:00+00,u1,9.0,mxn,complete\n',
+    'event_sample_data.csv': 'id,event_timestamp,user_id,event_name\n1,2024-01-01 10:00:00+00,u1,login\n',
+}
+
+class FollowClock:
+    """Stands in for the time module of main: each sleep moves the clock on by poll_seconds and appends an
+    event of the next day to the raw events file, then stops the follow mode once appended_days are appended."""
+
+    def __init__(self, events_path, poll_seconds, appended_days):
+        self.now, self.events_path, self.poll_seconds, self.appended_days = 1000.0, events_path, poll_seconds, appended_days
+        self.checkpointed_sizes = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Every micro-batch has committed the checkpoint of the rows it loaded before the next poll
+        checkpoint = state.read_file_checkpoints().get(self.events_path)
+        self.checkpointed_sizes.append((checkpoint['offset'], os.path.getsize(self.events_path)))
+        if not self.appended_days:
+            raise KeyboardInterrupt
+        day = self.appended_days.pop(0)
+        self.now += self.poll_seconds
+        with open(self.events_path, 'a') as file:
+            file.write(f"{day},2024-01-{day:02d} 10:00:00+00,u1,login\n")
+
+def test_follow_mode_refreshes_once_per_interval(tmp_path, monkeypatch):
+    raw_path = tmp_path / 'raw'
+    raw_path.mkdir()
+    for name, text in RAW_FILES.items():
+        (raw_path / name).write_text(text)
+    monkeypatch.setattr(state, 'STATE_FILE', str(tmp_path / 'state.json'))
+    monkeypatch.setattr(state, 'ID_INDEX_DIR', str(tmp_path / 'id_index'))
+    monkeypatch.setattr(dimensions, '_cache', {})
+    for key, value in {'input_data_path': str(raw_path), 'output_data_path': str(tmp_path / 'processed'), 'api': {},
+                       'instrumentation': {}, 'scheduler': {'max_workers': 2, 'max_processes': 0}}.items():
+        monkeypatch.setitem(main.config, key, value)
+
+    clock = FollowClock(str(raw_path / 'event_sample_data.csv'), poll_seconds=10, appended_days=list(range(2, 10)))
+    monkeypatch.setattr(main, 'time', clock)
+    refreshes = []
+    sink = mock.MagicMock(return_value=0)
+    with mock.patch.object(dimensions, 'load_postgres_table', side_effect=lambda table_name, columns, *args: pd.DataFrame(columns=columns)), \
+            mock.patch.multiple(main, upsert_to_postgres=sink, index_fact_tables=mock.DEFAULT, prewarm_metrics_cache=mock.DEFAULT,
+                                refresh_rollups=mock.MagicMock(side_effect=lambda scopes: refreshes.append((clock.now, sorted(scopes['fact_events']['time_id']))))):
+        main.run_follow_pipeline(max_rows=1, max_seconds=1, poll_seconds=10, refresh_seconds=60)
+
+    # One micro-batch per appended row, each loading its rows once and committing their checkpoint
+    loaded_events = [call.args[0] for call in sink.call_args_list if call.kwargs['table_name'] == 'fact_events' and len(call.args[0])]
+    assert [df['id'].tolist() for df in loaded_events] == [[day] for day in range(1, 10)]
+    assert len(clock.checkpointed_sizes) == 9 and all(offset == size for offset, size in clock.checkpointed_sizes)
+
+    # The rollups are refreshed on the first poll, once the interval elapsed and on exit, over the batches since the last refresh
+    assert refreshes == [(1000.0, [20240101]), (1060.0, list(range(20240102, 20240108))), (1080.0, [20240108, 20240109])]
+    assert state.read_pending_scopes() == {}
@@ -0,0 +1,29 @@
+import numpy as np
+from scripts.id_index import add_to_id_index, empty_id_index, id_index_contains, id_index_from_array, id_index_to_array
+
+def test_contains_matches_a_set_of_the_added_ids():
+    rng = np.random.default_rng(3)
+    index, added = empty_id_index(), set()
+    # Mostly consecutive batches of ids with gaps, added out of order like re-delivered files
+    for start in rng.permutation(np.arange(0, 100000, 1000)):
+        ids = np.arange(start, start + rng.integers(200, 1000))
+        add_to_id_index(index, ids)
+        added.update(ids.tolist())
+
+    queried = rng.integers(-10, 100010, 50000)
+    assert id_index_contains(index, queried).tolist() == [value in added for value in queried.tolist()]
+
+def test_adjacent_and_overlapping_ids_are_merged():
+    index = add_to_id_index(empty_id_index(), [5, 1, 2, 3, 9])
+    assert id_index_to_array(index).tolist() == [[1, 3], [5, 5], [9, 9]]
+    add_to_id_index(index, [4, 6, 7, 8, 2])
+    assert id_index_to_array(index).tolist() == [[1, 9]]
+
+def test_empty_index():
+    assert not id_index_contains(empty_id_index(), [0, 1]).any()
+    assert id_index_to_array(add_to_id_index(empty_id_index(), [])).shape == (0, 2)
+
+def test_persisted_ranges_round_trip():
+    index = add_to_id_index(empty_id_index(), [10, 11, 12, 20, 30, 31])
+    restored = id_index_from_array(id_index_to_array(index))
+    assert id_index_contains(restored, [9, 10, 12, 13, 20, 31, 32]).tolist() == [False, True, True, False, True, True, False]
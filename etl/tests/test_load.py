@@ -0,0 +1,48 @@
+import os
+import pandas as pd
+import pytest
+from scripts.load import upsert_to_postgres
+from utils.db_connection import get_postgres_engine, dispose_engines
+
+# Runs against the database of config.yml (or the DATABASE_* variables), e.g. the Postgres container of
+# docker-compose.yml with DATABASE_HOST=localhost
+pytestmark = pytest.mark.skipif(not os.environ.get('RUN_POSTGRES_TESTS'), reason="set RUN_POSTGRES_TESTS=1 to run against PostgreSQL")
+
+TABLE_NAME = 'test_upsert_items'
+
+@pytest.fixture
+def engine():
+    engine = get_postgres_engine()
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{TABLE_NAME}"')
+    yield engine
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{TABLE_NAME}"')
+    dispose_engines()
+
+def table_rows(engine):
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.exec_driver_sql(f'SELECT * FROM "{TABLE_NAME}" ORDER BY id')]
+
+def test_upsert_merges_rows_on_their_keys(engine):
+    # Rows repeated within a delta are merged once, as ON CONFLICT cannot update a row twice
+    first = pd.DataFrame({'id': [1, 2, 2], 'name': ['a', 'b', 'b'], 'amount': [1.0, 2.0, 2.0]})
+    assert upsert_to_postgres(first, TABLE_NAME, key_columns=['id']) == 2
+
+    second = pd.DataFrame({'id': [2, 3], 'name': ['b', 'c'], 'amount': [20.0, 3.0]})
+    assert upsert_to_postgres(second, TABLE_NAME, key_columns=['id']) == 2
+    assert table_rows(engine) == [(1, 'a', 1.0), (2, 'b', 20.0), (3, 'c', 3.0)]
+
+def test_upsert_of_key_columns_only_skips_loaded_rows(engine):
+    upsert_to_postgres(pd.DataFrame({'id': [1, 2], 'name': ['a', 'b']}), TABLE_NAME, key_columns=['id', 'name'])
+    assert upsert_to_postgres(pd.DataFrame({'id': [2, 3], 'name': ['b', 'c']}), TABLE_NAME, key_columns=['id', 'name']) == 1
+    assert table_rows(engine) == [(1, 'a'), (2, 'b'), (3, 'c')]
+
+def test_copy_keeps_nulls_and_quoted_values(engine):
+    df = pd.DataFrame({'id': [1, 2], 'name': ['a, "quoted"\nvalue', None], 'amount': [None, 1.5]})
+    upsert_to_postgres(df, TABLE_NAME, key_columns=['id'])
+    assert table_rows(engine) == [(1, 'a, "quoted"\nvalue', None), (2, None, 1.5)]
+
+def test_empty_delta_creates_the_table(engine):
+    assert upsert_to_postgres(pd.DataFrame({'id': pd.Series(dtype='int64')}), TABLE_NAME, key_columns=['id']) == 0
+    assert table_rows(engine) == []
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from scripts.metrics import METRICS, metric_query, prewarm_metrics_cache, read_dashboard_queries, _with_condition
+from serve_metrics import MetricsServer
+
+def test_metrics_are_the_dashboard_queries():
+    queries = read_dashboard_queries()
+    assert set(METRICS) <= set(queries)
+    for metric in METRICS:
+        query_sql, params = metric_query(metric)
+        assert query_sql == queries[metric] and params == {}
+
+def test_date_range_is_added_to_the_where_clause():
+    query_sql, params = metric_query('logins_between_dates', '2024-01-01', '2024-01-31')
+    assert 'FROM rollup_daily_user_logins\nWHERE time_id >= %(start)s AND time_id < %(end)s\nGROUP BY user_id' in query_sql
+    assert params == {'start': 20240101, 'end': 20240201}
+
+    query_sql, params = metric_query('active_users_per_day', end='2024-01-31')
+    assert 'JOIN dim_time t ON t.time_id = r.time_id\nWHERE r.time_id < %(end)s\nORDER BY active_date' in query_sql
+    assert params == {'end': 20240201}
+
+def test_date_range_keeps_the_query_condition():
+    query_sql = _with_condition('SELECT a FROM t WHERE b OR c ORDER BY a', 'd >= 1')
+    assert query_sql == 'SELECT a FROM t WHERE (b OR c) AND d >= 1\nORDER BY a'
+
+def request(head):
+    """Sends a raw request head to a metrics server on a free port and returns the raw response."""
+    async def exchange():
+        server = await asyncio.start_server(MetricsServer(1024, 1).handle, '127.0.0.1', 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(head)
+            response = await reader.read()
+            writer.close()
+            return response
+    return asyncio.run(exchange())
+
+def test_invalid_content_length_is_rejected():
+    for content_length in [b'abc', b'-5']:
+        response = request(b'GET /metrics HTTP/1.1\r\nContent-Length: ' + content_length + b'\r\n\r\n')
+        head, body = response.split(b'\r\n\r\n', 1)
+        assert head.startswith(b'HTTP/1.1 400 Bad Request') and b'Connection: close' in head
+        assert 'Content-Length' in json.loads(body)['error']
+
+def test_request_body_is_skipped():
+    response = request(b'GET /metrics HTTP/1.1\r\nContent-Length: 4\r\nConnection: close\r\n\r\nbody')
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert json.loads(body) == {'metrics': list(METRICS)}
+
+def test_prewarm_posts_to_the_metrics_api():
+    requests_seen = []
+
+    class WarmHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            requests_seen.append(self.path)
+            body = json.dumps({'metrics': len(METRICS)}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), WarmHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        prewarm_metrics_cache(f"http://127.0.0.1:{server.server_port}/")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert requests_seen == ['/warm']
+    # A stopped API is logged, not raised
+    prewarm_metrics_cache(f"http://127.0.0.1:{server.server_port}", timeout=1)
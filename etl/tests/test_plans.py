@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from scripts.load import save_to_staging
+from scripts.plans import run_plan, set_transform_engine, staged_window
+from scripts.timestamps import parse_timestamps
+from scripts.transform import FACT_PLANS
+
+def raw_transactions(rows=2000, seed=7):
+    """Returns raw withdrawal-like rows with missing fields, non-positive amounts, duplicate ids and unknown currencies."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'id': rng.integers(0, rows // 2, rows),
+        'event_timestamp': pd.Series(pd.date_range('2024-01-01', periods=rows, freq='min').strftime('%Y-%m-%d %H:%M:%S+00')),
+        'user_id': pd.Series(rng.choice(['a', 'b', 'c', None], rows), dtype='category'),
+        'amount': rng.normal(100, 80, rows).round(2).astype(str),
+        'interface': pd.Series(rng.choice(['app', 'web'], rows), dtype='category'),
+        'currency': pd.Series(rng.choice(['mxn', 'usd', 'btc', None], rows), dtype='category'),
+        'tx_status': pd.Series(rng.choice(['complete', 'failed'], rows), dtype='category'),
+    })
+    df.loc[rng.choice(rows, 20, replace=False), 'event_timestamp'] = None
+    df.loc[rng.choice(rows, 20, replace=False), 'amount'] = 'not a number'
+    return df
+
+def sequential_transform(df, plan, cutoffs=None):
+    """Applies the plan steps one after the other on copies of the frame, like the transforms did before plans."""
+    df = df.copy()
+    for column in plan.get('timestamps', []):
+        df[column] = parse_timestamps(df[column])
+    for column in plan.get('numeric', []):
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    for _, op, *args in plan['steps']:
+        if op == 'not_null':
+            df = df.dropna(subset=list(args[0]))
+        elif op == 'greater':
+            df = df[df[args[0]] > args[1]]
+        elif op == 'at_most':
+            df = df[df[args[0]] <= args[1]]
+        elif op == 'equals':
+            df = df[df[args[0]] == args[1]]
+        elif op == 'unique':
+            df = df.drop_duplicates(subset=list(args[0]))
+        elif op == 'at_most_quantile':
+            column, group_column, quantile = args
+            if cutoffs is None:
+                limit = df[column].quantile(quantile)
+            else:
+                limit = df[group_column].astype(object).map(cutoffs).astype('float64').fillna(float('inf'))
+            df = df[df[column] <= limit]
+    return df[plan['columns']]
+
+def test_plans_match_sequential_transforms():
+    raw = raw_transactions()
+    for table_name in ['fact_withdrawals', 'fact_deposits']:
+        plan = FACT_PLANS[table_name]
+        assert_frame_equal(run_plan(raw, plan), sequential_transform(raw, plan))
+
+def test_plan_with_currency_cutoffs():
+    raw = raw_transactions()
+    cutoffs = {'mxn': 120.0, 'usd': 90.0}
+    plan = FACT_PLANS['fact_withdrawals']
+    result = run_plan(raw, plan, cutoffs)
+    assert_frame_equal(result, sequential_transform(raw, plan, cutoffs))
+    # Currencies without a cut-off keep all their amounts
+    assert (result.loc[result['currency'] == 'mxn', 'amount'] <= 120.0).all()
+    assert result.loc[result['currency'] == 'btc', 'amount'].max() > 120.0
+
+def test_plan_leaves_input_unchanged():
+    raw = raw_transactions()
+    before = raw.copy()
+    run_plan(raw, FACT_PLANS['fact_withdrawals'])
+    assert_frame_equal(raw, before)
+
+def staged_transactions(staging_path, source):
+    """Stages the raw transactions of a fact source in three appends, each spread over the same days."""
+    raw = raw_transactions()
+    raw['event_timestamp'] = parse_timestamps(raw['event_timestamp'])
+    raw['amount'] = pd.to_numeric(raw['amount'], errors='coerce')
+    raw = raw.dropna(subset=['event_timestamp'])
+    raw = raw.sample(frac=1, random_state=3)
+    for part in range(3):
+        save_to_staging(raw.iloc[part::3], source, staging_path)
+
+@pytest.mark.parametrize('source, cutoffs', [('withdrawals', None), ('withdrawals', {'mxn': 120.0, 'usd': 90.0}), ('deposits', None)])
+def test_engines_return_the_same_staged_window_rows(tmp_path, source, cutoffs):
+    pytest.importorskip('polars')
+    staged_transactions(str(tmp_path), source)
+    plan = FACT_PLANS[f"fact_{source}"]
+    results = {}
+    try:
+        for engine in ['pandas', 'polars']:
+            set_transform_engine(engine)
+            window = staged_window(source, str(tmp_path), '2024-01-01T06:00:00+00:00', '2024-01-02T12:00:00+00:00')
+            results[engine] = run_plan(window, plan, cutoffs).reset_index(drop=True)
+    finally:
+        set_transform_engine('pandas')
+    assert isinstance(window, dict)
+    assert 0 < len(results['polars']) < 2000
+    assert_frame_equal(results['polars'], results['pandas'], check_categorical=False)
+
+def test_unknown_engine_is_rejected():
+    with pytest.raises(ValueError):
+        set_transform_engine('spark')
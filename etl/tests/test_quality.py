@@ -0,0 +1,10 @@
+import pandas as pd
+from scripts.quality import validate_table
+
+def test_event_timestamps_are_checked_up_to_today():
+    today = pd.Timestamp.now(tz='UTC').tz_localize(None).normalize()
+    timestamps = pd.Series([pd.Timestamp('2019-12-31'), today + pd.Timedelta(hours=12), today + pd.Timedelta(days=2)]).astype('datetime64[us]')
+    df = pd.DataFrame({'id': [1, 2, 3], 'event_timestamp': timestamps, 'time_id': 1, 'user_id': 'a', 'event_type_id': 1})
+    report = validate_table(df, 'fact_events')
+    range_report = next(rule for rule in report['rules'] if rule['rule'] == 'range:event_timestamp')
+    assert range_report['sample'] == [1, 3]
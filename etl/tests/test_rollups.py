@@ -0,0 +1,116 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+import scripts.rollups as rollups
+from scripts.rollups import ROLLUPS, ROLLUP_SCOPE_COLUMNS, rollup_scope, refresh_rollups
+from scripts.schemas import TABLE_SCHEMAS
+from utils.db_connection import get_postgres_engine, dispose_engines
+
+# The refresh runs against the database of config.yml (or the DATABASE_* variables), in a schema of its own
+requires_postgres = pytest.mark.skipif(not os.environ.get('RUN_POSTGRES_TESTS'), reason="set RUN_POSTGRES_TESTS=1 to run against PostgreSQL")
+
+TEST_SCHEMA = 'test_rollups'
+
+def test_rollup_scope_accumulates_the_delta_keys():
+    scope = rollup_scope(pd.DataFrame({'time_id': np.array([20240101, 20240101], dtype='int64'), 'user_id': ['a', None]}))
+    assert scope == {'time_id': {20240101}, 'user_id': {'a'}}
+    assert all(type(key) is int for key in scope['time_id'])
+
+    # A frame without a scope column only adds to the other one
+    rollup_scope(pd.DataFrame({'user_id': pd.Series(['b', 'a'], dtype='category')}), scope)
+    assert scope == {'time_id': {20240101}, 'user_id': {'a', 'b'}}
+
+def _top_level_items(sql):
+    """Splits a comma-separated SQL list on the commas outside parentheses."""
+    items, depth, current = [], 0, ''
+    for char in sql:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and depth == 0:
+            items.append(current.strip())
+            current = ''
+        else:
+            current += char
+    return items + [current.strip()]
+
+def test_rollup_queries_match_their_tables():
+    for rollup_name, (fact_table, scope_column, columns_ddl, select_sql) in ROLLUPS.items():
+        assert fact_table in TABLE_SCHEMAS and scope_column in ROLLUP_SCOPE_COLUMNS
+        assert scope_column in TABLE_SCHEMAS[fact_table].names
+        columns = [item.split()[0] for item in _top_level_items(columns_ddl) if not item.startswith('PRIMARY KEY')]
+        assert columns[0] == scope_column, rollup_name
+
+        # The SELECT fills every column of the rollup, and only recomputes the rows of the scope keys
+        select_list = re.match(r'SELECT (.*?) FROM ', select_sql).group(1)
+        assert len(_top_level_items(select_list)) == len(columns), rollup_name
+        assert re.search(rf'\b{scope_column} = ANY\(%\(keys\)s\)', select_sql), rollup_name
+
+@pytest.fixture
+def schema_engine(monkeypatch):
+    """Creates the fact tables the rollups read in an empty schema, and refreshes the rollups there."""
+    url = get_postgres_engine().url
+    with get_postgres_engine().begin() as connection:
+        connection.exec_driver_sql(f'DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE')
+        connection.exec_driver_sql(f'CREATE SCHEMA {TEST_SCHEMA}')
+    engine = create_engine(url, connect_args={'options': f'-c search_path={TEST_SCHEMA}'})
+    with engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE dim_event_type (event_type_name TEXT, event_type_id BIGINT)')
+        connection.exec_driver_sql("INSERT INTO dim_event_type VALUES ('login', 1), ('logout', 2)")
+        connection.exec_driver_sql('CREATE TABLE fact_events (id BIGINT, event_timestamp TIMESTAMP, time_id BIGINT, user_id TEXT, event_type_id BIGINT)')
+        connection.exec_driver_sql('CREATE TABLE fact_deposits (id BIGINT, event_timestamp TIMESTAMP, time_id BIGINT, user_id TEXT, '
+                                   'amount DOUBLE PRECISION, currency_id BIGINT, tx_status TEXT)')
+    monkeypatch.setattr(rollups, 'get_postgres_engine', lambda: engine)
+    yield engine
+    engine.dispose()
+    with get_postgres_engine().begin() as connection:
+        connection.exec_driver_sql(f'DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE')
+    dispose_engines()
+
+def insert_rows(engine, table_name, rows):
+    """Inserts fact rows and returns them as the DataFrame of the delta they were loaded from."""
+    df = pd.DataFrame(rows)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f'INSERT INTO {table_name} ({", ".join(df.columns)}) VALUES ({", ".join(["%s"] * len(df.columns))})',
+            [tuple(None if pd.isna(value) else value for value in row) for row in df.itertuples(index=False)]
+        )
+    return df
+
+def rollup_rows(engine, rollup_name):
+    with engine.connect() as connection:
+        return sorted(tuple(row) for row in connection.exec_driver_sql(f'SELECT * FROM {rollup_name}'))
+
+@requires_postgres
+def test_refresh_recomputes_only_the_scope_keys(schema_engine):
+    def event(row_id, day, user_id, event_type_id):
+        return {'id': row_id, 'event_timestamp': f'2024-01-0{day} 10:00', 'time_id': 20240100 + day, 'user_id': user_id, 'event_type_id': event_type_id}
+
+    events = insert_rows(schema_engine, 'fact_events', [event(1, 1, 'a', 1), event(2, 1, 'a', 1), event(3, 1, 'b', 2), event(4, 2, 'b', 1)])
+    deposits = insert_rows(schema_engine, 'fact_deposits', [
+        {'id': 1, 'event_timestamp': '2024-01-01 10:00', 'time_id': 20240101, 'user_id': 'a', 'amount': 10.0, 'currency_id': 1, 'tx_status': 'complete'},
+        {'id': 2, 'event_timestamp': '2024-01-01 12:00', 'time_id': 20240101, 'user_id': 'b', 'amount': 5.0, 'currency_id': 1, 'tx_status': 'complete'},
+        {'id': 3, 'event_timestamp': '2024-01-02 12:00', 'time_id': 20240102, 'user_id': 'a', 'amount': 7.0, 'currency_id': None, 'tx_status': 'complete'},
+    ])
+    scopes = {'fact_events': rollup_scope(events), 'fact_deposits': rollup_scope(deposits)}
+    refresh_rollups(scopes)
+    assert rollup_rows(schema_engine, 'rollup_daily_active_users') == [(20240101, 2), (20240102, 1)]
+    assert rollup_rows(schema_engine, 'rollup_daily_user_logins') == [(20240101, 'a', 2), (20240102, 'b', 1)]
+    # Deposits without a currency are left out of the per-currency rollup
+    assert rollup_rows(schema_engine, 'rollup_daily_deposits') == [(20240101, 1, 15.0, 2, 2)]
+    assert [row[:2] for row in rollup_rows(schema_engine, 'rollup_user_deposits')] == [('a', 2), ('b', 1)]
+
+    # Refreshing the same scopes again gives the same rows
+    refresh_rollups(scopes)
+    assert rollup_rows(schema_engine, 'rollup_daily_active_users') == [(20240101, 2), (20240102, 1)]
+
+    # A later delta only replaces the rows of its own days and users, the rows of the other days are kept
+    # even if their facts changed since
+    with schema_engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE fact_events SET user_id = 'a' WHERE id = 3")
+    late = insert_rows(schema_engine, 'fact_events', [event(5, 2, 'a', 1)])
+    refresh_rollups({'fact_events': rollup_scope(late)})
+    assert rollup_rows(schema_engine, 'rollup_daily_active_users') == [(20240101, 2), (20240102, 2)]
+    assert rollup_rows(schema_engine, 'rollup_daily_user_logins') == [(20240101, 'a', 2), (20240102, 'a', 1), (20240102, 'b', 1)]
+    assert [row[:2] for row in rollup_rows(schema_engine, 'rollup_user_logins')] == [('a', 3), ('b', 1)]
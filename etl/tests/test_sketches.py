@@ -0,0 +1,32 @@
+import json
+import numpy as np
+from scripts.sketches import digest_quantile, empty_digest, merge_digest
+
+def test_quantiles_are_within_rank_error():
+    rng = np.random.default_rng(11)
+    values = rng.lognormal(4, 1.2, 200000)
+    # Merged chunk by chunk, as the runs merge the withdrawal amounts of each delta
+    digest = empty_digest()
+    for chunk in np.array_split(values, 40):
+        digest = merge_digest(digest, chunk)
+
+    assert len(digest['means']) < 1000
+    assert sum(digest['weights']) == len(values)
+    sorted_values = np.sort(values)
+    for q in [0.01, 0.1, 0.5, 0.9, 0.99, 0.999]:
+        estimate = digest_quantile(digest, q)
+        rank = np.searchsorted(sorted_values, estimate) / len(values)
+        # Tails are kept with smaller centroids, so their error is smaller too
+        assert abs(rank - q) <= 0.005 * max(4 * q * (1 - q), 0.1), (q, rank)
+
+def test_extremes_and_missing_values():
+    digest = merge_digest(empty_digest(), [3.0, np.nan, 1.0, 2.0])
+    assert sum(digest['weights']) == 3
+    assert digest_quantile(digest, 0) == 1.0 and digest_quantile(digest, 1) == 3.0
+    assert digest_quantile(empty_digest(), 0.5) is None
+    assert merge_digest(digest, [np.nan]) is digest
+
+def test_digest_survives_the_state_file():
+    digest = merge_digest(empty_digest(), np.arange(1000.0))
+    restored = json.loads(json.dumps(digest))
+    assert digest_quantile(merge_digest(restored, [5000.0]), 0.5) == digest_quantile(merge_digest(digest, [5000.0]), 0.5)
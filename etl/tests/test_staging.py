@@ -0,0 +1,45 @@
+import pandas as pd
+from scripts.extract import load_staged_window
+from scripts.load import save_to_staging
+from scripts.schemas import RAW_DTYPES
+from main import date_ranges, plan_windows
+
+def raw_events(ids, timestamps, event_names):
+    return pd.DataFrame({
+        'id': ids,
+        'event_timestamp': pd.to_datetime(timestamps),
+        'user_id': pd.Series(['a'] * len(ids), dtype='category'),
+        'event_name': pd.Series(event_names, dtype='category'),
+    })
+
+def test_staged_window_reads_only_its_rows(tmp_path):
+    save_to_staging(raw_events([1, 2], ['2023-01-31 23:59:59', '2023-02-01 00:00:00'], ['login', 'logout']), 'events', str(tmp_path))
+    # Files staged later may hold other categories of the same columns
+    save_to_staging(raw_events([3, 4], ['2023-02-28 12:00:00', '2023-03-01 00:00:00'], ['signup', None]), 'events', str(tmp_path))
+
+    df = load_staged_window('events', str(tmp_path), '2023-02-01T00:00:00+00:00', '2023-03-01T00:00:00+00:00')
+    assert sorted(df['id']) == [2, 3]
+    assert set(df['event_name']) == {'logout', 'signup'}
+    assert {column: str(dtype) for column, dtype in df.dtypes.items() if column in RAW_DTYPES['events']} == RAW_DTYPES['events']
+
+def test_staged_window_without_staged_rows(tmp_path):
+    df = load_staged_window('withdrawals', str(tmp_path), '2023-02-01', '2023-03-01')
+    assert df.empty
+    assert list(df.columns) == ['id', 'event_timestamp', 'user_id', 'amount', 'interface', 'currency', 'tx_status']
+
+def test_staged_days_are_merged_into_ranges():
+    days = pd.to_datetime(['2023-01-03', '2023-01-01', '2023-01-02', '2023-01-05'])
+    assert date_ranges(days) == [{'start': '2023-01-01T00:00:00', 'end': '2023-01-04T00:00:00'},
+                                 {'start': '2023-01-05T00:00:00', 'end': '2023-01-06T00:00:00'}]
+
+def test_windows_cover_the_interval_and_the_staged_dates():
+    staged_ranges = [{'start': '2024-08-30T00:00:00', 'end': '2024-09-02T00:00:00'},  # history before the first run
+                     {'start': '2024-10-15T00:00:00', 'end': '2024-10-16T00:00:00'},  # late rows of an earlier day
+                     {'start': '2024-10-30T00:00:00', 'end': '2024-10-31T00:00:00'}]  # rows of the interval
+    windows = plan_windows('2024-10-30T00:00:00+00:00', '2024-10-31T00:00:00+00:00', 'MS', staged_ranges)
+    assert [(window['start'][:10], window['end'][:10]) for window in windows] == [
+        ('2024-08-30', '2024-09-01'), ('2024-09-01', '2024-09-02'), ('2024-10-15', '2024-10-16'), ('2024-10-30', '2024-10-31')]
+
+def test_windows_cover_whole_days():
+    windows = plan_windows('2024-10-30T06:00:00+00:00', '2024-10-31T06:00:00+00:00', 'MS', [])
+    assert windows == [{'start': '2024-10-30T00:00:00', 'end': '2024-11-01T00:00:00'}]
@@ -0,0 +1,29 @@
+import pandas as pd
+from pandas.testing import assert_series_equal
+from scripts.timestamps import parse_timestamps, to_naive_utc
+
+def reference(values):
+    """Parses timestamps with their offsets, the slow path the UTC fast path replaces."""
+    return pd.to_datetime(pd.Series(values), errors='coerce', utc=True, format='ISO8601').dt.tz_localize(None)
+
+def test_utc_fast_path_matches_parsing_the_offsets():
+    values = ['2020-01-10 14:11:05.63+00', '2020-01-10 14:11:05+00', '2021-12-31 23:59:59.123456+00', None]
+    result = parse_timestamps(pd.Series(values))
+    assert_series_equal(result, reference(values), check_dtype=False)
+    assert result.isna().tolist() == [False, False, False, True]
+
+def test_other_offsets_are_converted_to_utc():
+    values = ['2020-01-10 14:11:05+00', '2020-01-10 08:11:05-06', 'not a timestamp']
+    result = parse_timestamps(pd.Series(values))
+    assert_series_equal(result, reference(values), check_dtype=False)
+    assert result[0] == result[1] and pd.isna(result[2])
+
+def test_parsed_columns_are_returned_as_they_are():
+    parsed = parse_timestamps(pd.Series(['2020-01-10 14:11:05+00']))
+    assert parse_timestamps(parsed) is parsed
+    aware = pd.Series(pd.to_datetime(['2020-01-10 08:11:05-06:00']))
+    assert parse_timestamps(aware).tolist() == parsed.tolist()
+
+def test_to_naive_utc():
+    assert to_naive_utc('2024-01-01T06:00:00-06:00') == pd.Timestamp('2024-01-01 12:00')
+    assert to_naive_utc(pd.Timestamp('2024-01-01 12:00')) == pd.Timestamp('2024-01-01 12:00')
@@ -0,0 +1,98 @@
+import pandas as pd
+import scripts.state as state
+from scripts.transform import transform_dim_time_from_facts, transform_user_data, assign_dimension_keys, resolve_surrogate_keys
+
+def facts(*timestamps):
+    return pd.DataFrame({'event_timestamp': pd.to_datetime(list(timestamps)).astype('datetime64[us]')})
+
+def test_dim_time_skips_facts_without_rows():
+    dim_time = transform_dim_time_from_facts(facts(), facts('2023-09-10 06:00', '2023-09-12 08:00'), facts())
+    assert dim_time['time_id'].tolist() == [20230910, 20230911, 20230912]
+
+def test_dim_time_extends_time_bounds():
+    dim_time = transform_dim_time_from_facts(facts(), facts('2023-09-08', '2023-09-12'), time_bounds=['2023-09-09', '2023-09-11'])
+    assert dim_time['time_id'].tolist() == [20230908, 20230912]
+
+def test_dim_time_without_new_facts():
+    assert transform_dim_time_from_facts(facts(), facts()).empty
+
+def level_changes(*rows):
+    return pd.DataFrame([{'event_timestamp': f"{day} 00:00:00+00", 'user_id': user_id, 'jurisdiction': 'mx', 'level': level}
+                         for user_id, day, level in rows])
+
+def stored_versions(*rows):
+    return pd.DataFrame([{'user_id': user_id, 'jurisdiction': 'mx', 'level': level, 'valid_from': pd.Timestamp(valid_from),
+                          'valid_to': pd.Timestamp(valid_to) if valid_to else pd.NaT, 'is_current': valid_to is None}
+                         for user_id, level, valid_from, valid_to in rows])
+
+def test_late_level_change_is_inserted_closed():
+    stored = stored_versions(('a', 1, '2023-01-01', '2023-06-01'), ('a', 2, '2023-06-01', None))
+    dim_user = transform_user_data(pd.DataFrame({'user_id': ['a']}), level_changes(('a', '2023-03-01', 3)), stored)
+    rows = dim_user.sort_values('valid_from')[['level', 'valid_from', 'valid_to', 'is_current']].values.tolist()
+    # The late version is valid until the current one, and closes the version it follows
+    assert rows == [[1, pd.Timestamp('2023-01-01'), pd.Timestamp('2023-03-01'), False],
+                    [3, pd.Timestamp('2023-03-01'), pd.Timestamp('2023-06-01'), False]]
+
+def test_level_change_closes_current_version():
+    stored = stored_versions(('a', 1, '2023-01-01', None))
+    dim_user = transform_user_data(pd.DataFrame({'user_id': ['a', 'b']}), level_changes(('a', '2023-03-01', 2), ('a', '2023-04-01', 3)), stored)
+    current = dim_user[dim_user['is_current']]
+    assert sorted(current['user_id']) == ['a', 'b']
+    assert current.loc[current['user_id'] == 'a', 'level'].tolist() == [3]
+    assert dim_user.loc[dim_user['valid_from'] == pd.Timestamp('2023-01-01'), 'valid_to'].tolist() == [pd.Timestamp('2023-03-01')]
+    assert len(dim_user) == 4
+
+def test_late_level_change_before_the_first_version():
+    stored = stored_versions(('a', 2, '2023-06-01', None))
+    dim_user = transform_user_data(pd.DataFrame({'user_id': ['a']}), level_changes(('a', '2023-03-01', 1)), stored)
+    # Only the late version is written, the stored one keeps its validity
+    assert dim_user[['level', 'valid_from', 'valid_to', 'is_current']].values.tolist() == [
+        [1, pd.Timestamp('2023-03-01'), pd.Timestamp('2023-06-01'), False]]
+
+def test_redelivered_level_change_replaces_its_version():
+    stored = stored_versions(('a', 1, '2023-01-01', '2023-03-01'), ('a', 2, '2023-03-01', None))
+    dim_user = transform_user_data(pd.DataFrame({'user_id': ['a']}), level_changes(('a', '2023-03-01', 2)), stored)
+    assert dim_user[['level', 'valid_from', 'valid_to', 'is_current']].values.tolist() == [
+        [2, pd.Timestamp('2023-03-01'), pd.NaT, True]]
+
+def test_first_level_closes_the_version_of_unknown_level():
+    stored = stored_versions(('a', pd.NA, '1970-01-01', None))
+    dim_user = transform_user_data(pd.DataFrame({'user_id': ['a']}), level_changes(('a', '2023-03-01', 1)), stored)
+    rows = dim_user.sort_values('valid_from')[['valid_from', 'valid_to', 'is_current']].values.tolist()
+    assert rows == [[pd.Timestamp('1970-01-01'), pd.Timestamp('2023-03-01'), False],
+                    [pd.Timestamp('2023-03-01'), pd.NaT, True]]
+
+def test_new_user_with_a_level_has_no_version_of_unknown_level():
+    dim_user = transform_user_data(pd.DataFrame({'user_id': ['a']}), level_changes(('a', '2023-03-01', 1)))
+    assert dim_user[['user_id', 'level', 'is_current']].values.tolist() == [['a', 1, True]]
+
+def withdrawals(currencies, interfaces):
+    return pd.DataFrame({
+        'id': range(len(currencies)),
+        'event_timestamp': pd.to_datetime(['2023-09-10'] * len(currencies)),
+        'currency': pd.Series(currencies, dtype='category'),
+        'interface': pd.Series(interfaces, dtype='category'),
+    })
+
+def test_keys_assigned_at_staging_are_resolved_by_later_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(state, 'STATE_FILE', str(tmp_path / 'state.json'))
+
+    # The staging run assigns the keys of the new members and persists them
+    staged = withdrawals(['usd', 'mxn', None], ['web', None, 'app'])
+    state.update_dimension_keys(assign_dimension_keys(state.read_dimension_keys(), staged))
+    first_keys = state.read_dimension_keys()
+    assert first_keys['currency'] == {'mxn': 1, 'usd': 2}
+    assert first_keys['interface'] == {'app': 1, 'web': 2}
+
+    # A later window run resolves the staged rows with the persisted keys, missing members stay missing
+    fact_df = resolve_surrogate_keys(staged, state.read_dimension_keys())
+    assert fact_df['currency_id'].tolist() == [2, 1, pd.NA]
+    assert fact_df['interface_id'].tolist() == [2, pd.NA, 1]
+
+    # The next staging run keeps the existing keys and numbers the new members after the current max
+    later = withdrawals(['btc', 'usd', 'ars', None], ['web', 'web', 'app', None])
+    state.update_dimension_keys(assign_dimension_keys(state.read_dimension_keys(), later))
+    dimension_keys = state.read_dimension_keys()
+    assert dimension_keys['currency'] == {'mxn': 1, 'usd': 2, 'ars': 3, 'btc': 4}
+    assert dimension_keys['interface'] == first_keys['interface']
+    assert resolve_surrogate_keys(later, dimension_keys)['currency_id'].tolist() == [4, 2, 3, pd.NA]
@@ -1,5 +1,14 @@
+import os
+import threading
+import time
+from functools import lru_cache
 import yaml
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# Engines shared by the whole process, keyed by their connection settings
+_engines = {}
+_engines_lock = threading.Lock()
 
 def load_config(file_path='config/config.yml'):
     """Loads the configuration from a YAML file."""
@@ -10,23 +19,115 @@ def load_config(file_path='config/config.yml'):
     except Exception as e:
         raise RuntimeError(f"Error loading config file: {e}")
 
-def get_postgres_engine(config_path='config/config.yml'):
-    """Creates a PostgreSQL engine based on the config file."""
-    try:
-        config = load_config(config_path)
-        db_config = config.get('database', {})
+@lru_cache(maxsize=None)
+def _load_cached_config(file_path):
+    return load_config(file_path)
+
+class _MeteredQueuePool(QueuePool):
+    """QueuePool that records how many checkouts happened and how long they waited for a connection."""
+
+    metrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.metrics is not None:
+                waited = time.perf_counter() - started
+                with self.metrics['lock']:
+                    self.metrics['checkouts'] += 1
+                    self.metrics['total_wait_seconds'] += waited
+                    self.metrics['max_wait_seconds'] = max(self.metrics['max_wait_seconds'], waited)
+
+def _get_connection_settings(config_path):
+    """Reads the connection URL and pool settings for PostgreSQL."""
+    config = _load_cached_config(config_path)
+    db_config = config.get('database', {})
+
+    # Environment variables (as set in docker-compose.yml) take precedence over the config file,
+    # e.g. DATABASE_HOST=localhost to load into the Postgres container from the host
+    db_user = os.environ.get('DATABASE_USER', db_config.get('user', 'admin'))
+    db_password = os.environ.get('DATABASE_PASSWORD', db_config.get('password', 'password'))
+    db_host = os.environ.get('DATABASE_HOST', db_config.get('host', 'localhost'))
+    db_port = os.environ.get('DATABASE_PORT', db_config.get('port', 5432))
+    db_name = os.environ.get('DATABASE_NAME', db_config.get('name', 'etl_db'))
 
-        db_user = db_config.get('user', 'admin')
-        db_password = db_config.get('password', 'password')
-        db_host = db_config.get('host', 'localhost')
-        db_port = db_config.get('port', 5432)
-        db_name = db_config.get('name', 'etl_db')
+    # Create the PostgreSQL connection URL, pinned to psycopg2 as the loader relies on its COPY support
+    db_url = f"postgresql+psycopg2://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
 
-        # Create the PostgreSQL connection URL
-        db_url = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+    pool_config = db_config.get('pool', {})
+    return (
+        db_url,
+        pool_config.get('size', 5),
+        pool_config.get('max_overflow', 10),
+        pool_config.get('timeout', 30),
+        pool_config.get('recycle', 1800),
+        pool_config.get('pre_ping', True),
+        pool_config.get('statement_timeout_ms', 0),
+    )
 
-        # Create and return the SQLAlchemy engine
-        return create_engine(db_url)
+def _create_pooled_engine(settings):
+    """Creates a SQLAlchemy engine with a metered connection pool."""
+    db_url, pool_size, max_overflow, pool_timeout, pool_recycle, pre_ping, statement_timeout_ms = settings
+    connect_args = {'options': f"-c statement_timeout={statement_timeout_ms}"} if statement_timeout_ms else {}
+    engine = create_engine(
+        db_url,
+        poolclass=_MeteredQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pre_ping,
+        connect_args=connect_args,
+    )
+
+    metrics = {'lock': threading.Lock(), 'checkouts': 0, 'connections': 0, 'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+    engine.pool.metrics = metrics
+
+    @event.listens_for(engine, 'connect')
+    def count_connection(dbapi_connection, connection_record):
+        with metrics['lock']:
+            metrics['connections'] += 1
+
+    return engine
+
+def get_postgres_engine(config_path='config/config.yml'):
+    """Returns the shared PostgreSQL engine for the connection settings in the config file."""
+    try:
+        settings = _get_connection_settings(config_path)
+        with _engines_lock:
+            if settings not in _engines:
+                _engines[settings] = _create_pooled_engine(settings)
+            return _engines[settings]
     except Exception as e:
         raise RuntimeError(f"Error creating PostgreSQL engine: {e}")
 
+def get_pool_metrics():
+    """Returns the checkout and wait metrics of every pooled engine, keyed by its URL without password."""
+    with _engines_lock:
+        engines = list(_engines.values())
+
+    pool_metrics = {}
+    for engine in engines:
+        metrics = engine.pool.metrics
+        with metrics['lock']:
+            pool_metrics[engine.url.render_as_string(hide_password=True)] = {
+                'checkouts': metrics['checkouts'],
+                'connections': metrics['connections'],
+                'total_wait_seconds': round(metrics['total_wait_seconds'], 6),
+                'max_wait_seconds': round(metrics['max_wait_seconds'], 6),
+                'checked_out': engine.pool.checkedout(),
+                'pool_size': engine.pool.size(),
+                'overflow': engine.pool.overflow(),
+            }
+    return pool_metrics
+
+def dispose_engines():
+    """Closes the pooled connections of every engine and clears the registry and config cache."""
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.dispose()
+    _load_cached_config.cache_clear()
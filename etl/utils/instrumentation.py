@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, where peak RSS is not reported
+    resource = None
+
+# Records of the instrumented calls of the current run, and the per-thread stack of running stages
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+# Aggregated stage metrics exported to the Prometheus textfile: (report field, metric name, help)
+STAGE_METRICS = [
+    ('calls', 'etl_stage_calls', 'Number of calls of the ETL stage in the last run.'),
+    ('wall_seconds', 'etl_stage_wall_seconds', 'Wall-clock time spent in the ETL stage in the last run.'),
+    ('cpu_seconds', 'etl_stage_cpu_seconds', 'CPU time spent in the ETL stage in the last run.'),
+    ('rows_in', 'etl_stage_rows_in', 'Rows received by the ETL stage in the last run.'),
+    ('rows_out', 'etl_stage_rows_out', 'Rows returned by the ETL stage in the last run.'),
+    ('bytes_in', 'etl_stage_bytes_in', 'Bytes of the DataFrames received by the ETL stage in the last run.'),
+    ('bytes_out', 'etl_stage_bytes_out', 'Bytes of the DataFrames returned by the ETL stage in the last run.'),
+    ('peak_rss_bytes', 'etl_stage_peak_rss_bytes', 'Peak resident memory of the process running the ETL stage.'),
+    ('rows_per_second', 'etl_stage_rows_per_second', 'Rows received per wall-clock second by the ETL stage.'),
+]
+
+def _frames(args, kwargs):
+    return [value for value in list(args) + list(kwargs.values()) if isinstance(value, pd.DataFrame)]
+
+def _frame_size(frames):
+    """Returns the rows and (shallow) bytes of a list of DataFrames."""
+    return sum(len(df) for df in frames), int(sum(df.memory_usage(index=False).sum() for df in frames))
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ru_maxrss is in KiB on Linux
+
+def _add_record(record):
+    collector = getattr(_local, 'collector', None)
+    if collector is not None:
+        collector.append(record)
+    else:
+        with _records_lock:
+            _records.append(record)
+
+def instrumented(func):
+    """Decorator recording the wall and CPU time, rows and bytes in and out, and peak RSS of each call."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        rows_in, bytes_in = _frame_size(_frames(args, kwargs))
+        record = {'stage': func.__name__, 'rows_in': rows_in, 'bytes_in': bytes_in, 'steps': {}, 'failed': True}
+        stack = _local.__dict__.setdefault('stages', [])
+        stack.append(record)
+        wall_started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, pd.DataFrame):
+                record['rows_out'], record['bytes_out'] = _frame_size([result])
+            record['failed'] = False
+            return result
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall_started
+            record['cpu_seconds'] = time.thread_time() - cpu_started
+            record['peak_rss_bytes'] = _peak_rss_bytes()
+            stack.pop()
+            _add_record(record)
+    return wrapper
+
+def record_step(step, rows_before, rows_after):
+    """Records how many rows a filter step of the running instrumented stage kept out of those it received."""
+    stack = getattr(_local, 'stages', None)
+    if stack:
+        steps = stack[-1]['steps']
+        kept = steps.setdefault(step, {'rows_in': 0, 'rows_out': 0})
+        kept['rows_in'] += rows_before
+        kept['rows_out'] += rows_after
+
+@contextmanager
+def collect_records():
+    """Collects the records of the instrumented calls made by the current thread in a list, instead of the
+    run records, so a worker process can return them to the process that writes the report."""
+    previous = getattr(_local, 'collector', None)
+    _local.collector = []
+    try:
+        yield _local.collector
+    finally:
+        _local.collector = previous
+
+def add_records(records):
+    """Adds records collected elsewhere (e.g. in a worker process) to the records of the current run."""
+    for record in records:
+        _add_record(record)
+
+def reset_records():
+    """Clears the records, at the start of a run."""
+    with _records_lock:
+        _records.clear()
+
+def build_run_report():
+    """Aggregates the records of the run by stage into the run report."""
+    with _records_lock:
+        records = list(_records)
+
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(record['stage'], {
+            'calls': 0, 'failed_calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows_in': 0, 'rows_out': 0,
+            'bytes_in': 0, 'bytes_out': 0, 'peak_rss_bytes': 0, 'steps': {},
+        })
+        stage['calls'] += 1
+        stage['failed_calls'] += record['failed']
+        for field in ['wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out', 'bytes_in', 'bytes_out']:
+            stage[field] += record.get(field, 0)
+        stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], record['peak_rss_bytes'] or 0)
+        for step, rows in record['steps'].items():
+            stage_step = stage['steps'].setdefault(step, {'rows_in': 0, 'rows_out': 0})
+            stage_step['rows_in'] += rows['rows_in']
+            stage_step['rows_out'] += rows['rows_out']
+
+    for stage in stages.values():
+        stage['rows_per_second'] = stage['rows_in'] / stage['wall_seconds'] if stage['wall_seconds'] else 0.0
+    return {'stages': stages}
+
+def _write_atomically(file_path, content):
+    """Writes a file through a temporary file and a rename, so readers never see it half-written."""
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(file_path + '.tmp', 'w') as file:
+        file.write(content)
+    os.replace(file_path + '.tmp', file_path)
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def prometheus_text(report):
+    """Renders a run report in the Prometheus text exposition format, for the node exporter textfile collector."""
+    lines = [
+        '# HELP etl_run_success Whether the last ETL run succeeded.',
+        '# TYPE etl_run_success gauge',
+        f"etl_run_success {int(report['succeeded'])}",
+        '# HELP etl_run_duration_seconds Wall-clock duration of the last ETL run.',
+        '# TYPE etl_run_duration_seconds gauge',
+        f"etl_run_duration_seconds {report['duration_seconds']}",
+        '# HELP etl_run_timestamp_seconds Unix time at which the last ETL run finished.',
+        '# TYPE etl_run_timestamp_seconds gauge',
+        f"etl_run_timestamp_seconds {report['finished_at']}",
+    ]
+    for field, metric, help_text in STAGE_METRICS:
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge']
+        for stage_name, stage in sorted(report['stages'].items()):
+            lines.append(f'{metric}{{stage="{_prometheus_label(stage_name)}"}} {stage[field]}')
+    lines += ['# HELP etl_step_rows_removed Rows removed by each filter step of an ETL stage in the last run.',
+              '# TYPE etl_step_rows_removed gauge']
+    for stage_name, stage in sorted(report['stages'].items()):
+        for step, rows in sorted(stage['steps'].items()):
+            lines.append(f'etl_step_rows_removed{{stage="{_prometheus_label(stage_name)}",step="{_prometheus_label(step)}"}} {rows["rows_in"] - rows["rows_out"]}')
+    return '\n'.join(lines) + '\n'
+
+def write_run_report(started_at, succeeded, report_path=None, prometheus_textfile=None, **extra):
+    """Writes the run report as JSON and as a Prometheus textfile, and returns it."""
+    try:
+        finished_at = time.time()
+        report = {
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'duration_seconds': finished_at - started_at,
+            'succeeded': succeeded,
+            **extra,
+            **build_run_report(),
+        }
+        if report_path:
+            _write_atomically(report_path, json.dumps(report, indent=2, default=str))
+        if prometheus_textfile:
+            _write_atomically(prometheus_textfile, prometheus_text(report))
+        logging.info(f"Run report written with {len(report['stages'])} instrumented stages.")
+        return report
+    except Exception as e:
+        # A missing report must not fail a run whose data has already been loaded
+        logging.error(f"Error writing run report: {e}")
@@ -1,7 +1,12 @@
 import logging
 
+_configured = {'log_file': None}
+
 def setup_logging(log_file):
-    """Sets up logging configuration."""
+    """Sets up logging configuration, once per process."""
+    if _configured['log_file'] == log_file:
+        return
+    _configured['log_file'] = log_file
     logging.basicConfig(
         filename=log_file,                
         filemode='a',                       
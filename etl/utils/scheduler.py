@@ -0,0 +1,67 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from utils.instrumentation import collect_records, add_records
+
+IO_TASK = 'io'
+CPU_TASK = 'cpu'
+
+# Worker processes are started from a fresh interpreter rather than forked, as a fork taken while the
+# IO threads run can copy a lock one of them holds (such as a logging handler lock) and deadlock
+PROCESS_START_METHOD = 'spawn'
+
+def _timed_call(func, *args):
+    """Calls func and returns its result along with the wall-clock time it took and the records of its
+    instrumented calls, which are collected in the worker and added to the run records by the caller."""
+    started = time.perf_counter()
+    with collect_records() as records:
+        result = func(*args)
+    return result, time.perf_counter() - started, records
+
+def run_task_graph(tasks, max_workers=4, max_processes=0, initializer=None, initargs=()):
+    """Runs a graph of tasks as soon as their dependencies are done and returns their results by name.
+
+    tasks maps each task name to a (func, dependencies, kind) tuple, where func is called with the
+    results of its dependencies in order. IO tasks run in a thread pool of max_workers threads and
+    CPU tasks in a process pool of max_processes processes (or in the thread pool if it is 0), each
+    process calling initializer(*initargs) once it starts.
+    """
+    results, timings, running = {}, {}, {}
+    pending = dict(tasks)
+    started = time.perf_counter()
+
+    threads = ThreadPoolExecutor(max_workers=max_workers)
+    processes = ProcessPoolExecutor(max_workers=max_processes, mp_context=multiprocessing.get_context(PROCESS_START_METHOD),
+                                    initializer=initializer, initargs=initargs) if max_processes else None
+    try:
+        while pending or running:
+            # Submit every task whose dependencies have all completed
+            for name, (func, dependencies, kind) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    executor = processes if kind == CPU_TASK and processes else threads
+                    args = [results[dependency] for dependency in dependencies]
+                    running[executor.submit(_timed_call, func, *args)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Tasks with unknown or circular dependencies: {', '.join(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], timings[name], records = future.result()
+                    add_records(records)
+                except Exception as e:
+                    logging.error(f"Task {name} failed: {e}")
+                    raise
+                logging.info(f"Task {name} finished in {timings[name]:.3f}s")
+    finally:
+        threads.shutdown(cancel_futures=True)
+        if processes:
+            processes.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Task graph finished in {elapsed:.3f}s (sum of task times {sum(timings.values()):.3f}s)")
+    return results
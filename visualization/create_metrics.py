@@ -1,4 +1,7 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import yaml
 
 # Load Metabase credentials from config file
@@ -9,29 +12,57 @@ MB_URL = config['metabase']['url']
 MB_USER = config['metabase']['username']
 MB_PASS = config['metabase']['password']
 
-# Log in to Metabase and get session token
-def metabase_login():
-    login_url = f"{MB_URL}/api/session"
-    payload = {
-        "username": MB_USER,
-        "password": MB_PASS
-    }
-    response = requests.post(login_url, json=payload)
+# Seconds to wait for each Metabase API call
+REQUEST_TIMEOUT = 30
+
+# Card name and display of each query of queries.sql, in file order
+QUERY_CARDS = [
+    ["Active Users Per Day", "bar"],
+    ["Users Without Deposit", "table"],
+    ["Users With More Than 5 Deposits", "table"],
+    ["Last Login Per User", "table"],
+    ["Logins Between Dates", "bar"],
+    ["Unique Currencies Deposited Per Day", "bar"],
+    ["Unique Currencies Withdrew Per Day", "bar"],
+    ["Total Amount Deposited Per Currency Per Day", "bar"]
+]
+
+# Log in to Metabase once and return a session sending its token with every request
+def metabase_login(url=MB_URL, username=MB_USER, password=MB_PASS, pool_size=4):
+    session = requests.Session()
+    # Keep up to pool_size connections open, one per concurrent request
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    response = session.post(f"{url}/api/session", json={"username": username, "password": password}, timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
-        return response.json().get('id')
+        session.headers.update({'X-Metabase-Session': response.json().get('id')})
+        return session
     else:
         raise Exception("Failed to log in to Metabase")
-        
 
-# Create metric in Metabase
-def create_metric(query_name, query_sql, database_id):
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Metabase-Session': metabase_login()
-    }
-    create_card_url = f"{MB_URL}/api/card"
-    payload = {
-        "name": query_name[0],
+# Read the queries of the SQL file with the name and display of their card
+def read_query_cards(file_path='queries.sql'):
+    with open(file_path) as file:
+        queries = [query.strip() for query in file.read().split(';') if query.strip()]
+    return [(name, display, query_sql) for (name, display), query_sql in zip(QUERY_CARDS, queries)]
+
+# Get the existing cards, keyed by name (the oldest one if a name was created several times)
+def list_cards(session, url=MB_URL):
+    response = session.get(f"{url}/api/card", timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(f"Failed to list Metabase cards: {response.text}")
+
+    cards = {}
+    for card in sorted(response.json(), key=lambda card: card['id']):
+        if not card.get('archived'):
+            cards.setdefault(card['name'], card)
+    return cards
+
+def card_payload(name, display, query_sql, database_id):
+    return {
+        "name": name,
         "dataset_query": {
             "type": "native",
             "native": {
@@ -39,35 +70,66 @@ def create_metric(query_name, query_sql, database_id):
             },
             "database": database_id
         },
-        "display": query_name[1],
+        "display": display,
         "visualization_settings": {},
-        "description": f"Metric for {query_name[0]}" 
+        "description": f"Metric for {name}"
     }
-    response = requests.post(create_card_url, json=payload, headers=headers)
+
+# Whether an existing card differs from its payload in SQL (ignoring whitespace), database or display
+def card_changed(card, payload):
+    dataset_query = card.get('dataset_query') or {}
+    return (
+        ' '.join((dataset_query.get('native') or {}).get('query', '').split()) != ' '.join(payload['dataset_query']['native']['query'].split())
+        or dataset_query.get('database') != payload['dataset_query']['database']
+        or card.get('display') != payload['display']
+    )
+
+# Create a card missing from Metabase or update one whose query changed, returning what was done
+def sync_card(session, name, display, query_sql, database_id, existing_cards, url=MB_URL):
+    payload = card_payload(name, display, query_sql, database_id)
+    card = existing_cards.get(name)
+    if card is None:
+        response = session.post(f"{url}/api/card", json=payload, timeout=REQUEST_TIMEOUT)
+        action = 'created'
+    elif card_changed(card, payload):
+        response = session.put(f"{url}/api/card/{card['id']}", json=payload, timeout=REQUEST_TIMEOUT)
+        action = 'updated'
+    else:
+        print(f"Metric '{name}' is up to date.")
+        return 'unchanged'
+
     if response.status_code == 200:
-        print(f"Metric '{query_name[0]}' created successfully.")
+        print(f"Metric '{name}' {action} successfully.")
+        return action
     else:
-        print(f"Failed to create metric '{query_name[0]}': {response.text}")
-
-# Read queries from the SQL file and create metrics
-def create_metrics_from_file():
-    with open('queries.sql') as file:
-        queries = file.read().split(';')
-
-    query_names = [
-        ["Active Users Per Day", "bar"],
-        ["Users Without Deposit", "table"],
-        ["Users With More Than 5 Deposits", "table"],
-        ["Last Login Per User", "table"],
-        ["Logins Between Dates", "bar"],
-        ["Unique Currencies Deposited Per Day", "bar"],
-        ["Unique Currencies Withdrew Per Day", "bar"],
-        ["Total Amount Deposited Per Currency Per Day", "bar"]
-    ]
-
-    for i, query_sql in enumerate(queries):
-        if query_sql.strip():
-            create_metric(query_names[i], query_sql.strip(), database_id=2)  # Adjust DB ID as needed
+        print(f"Failed to sync metric '{name}': {response.text}")
+        return 'failed'
+
+# Create or update the cards of the SQL file, at most max_workers at a time, and count the actions
+def sync_metrics(url=MB_URL, database_id=2, max_workers=4, queries_file='queries.sql'):
+    session = metabase_login(url, pool_size=max_workers)
+    try:
+        existing_cards = list_cards(session, url)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            actions = list(executor.map(
+                lambda card: sync_card(session, *card, database_id, existing_cards, url),
+                read_query_cards(queries_file)
+            ))
+    finally:
+        session.close()
+
+    summary = {action: actions.count(action) for action in sorted(set(actions))}
+    print(f"Metabase sync finished: {summary}")
+    return summary
 
 if __name__ == "__main__":
-    create_metrics_from_file()
+    parser = argparse.ArgumentParser(description="Creates or updates the Metabase cards of queries.sql.")
+    parser.add_argument('--url', default=MB_URL, help="Metabase URL, e.g. a local stub server")
+    parser.add_argument('--database-id', type=int, default=2, help="Metabase id of the ETL database")  # Adjust DB ID as needed
+    parser.add_argument('--max-workers', type=int, default=4, help="cards synced concurrently")
+    parser.add_argument('--queries', default='queries.sql', help="SQL file of the queries")
+    args = parser.parse_args()
+
+    summary = sync_metrics(args.url, args.database_id, args.max_workers, args.queries)
+    if summary.get('failed'):
+        raise SystemExit(1)